@@ -10,25 +10,37 @@ import gspread
 import datetime
 import functools
 import traceback
+import copy
+import gzip
+import hmac
+import base64
+import binascii
+import hashlib
 import difflib
+import bisect
+import heapq
+import math
 import threading
 import time
 import random
 import requests
 import uuid
 from apscheduler.schedulers.background import BackgroundScheduler
+from concurrent.futures import ThreadPoolExecutor, wait
 import logging
-from flask import Flask, request, json
+from flask import Flask, Response, request, json
 from telebot import TeleBot, types
-from collections import defaultdict
+from collections import defaultdict, deque
 from telebot.apihelper import ApiTelegramException
+from telebot.util import extract_command
 from google.oauth2 import service_account
 from datetime import timezone, timedelta
 IST = timezone(timedelta(hours=5, minutes=30))
 from supabase import create_client, Client
 from urllib.parse import quote
 from html import escape, unescape
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
+from collections.abc import MutableMapping
 from postgrest.exceptions import APIError
 import httpx
 from httpcore import RemoteProtocolError
@@ -63,7 +75,8 @@ GOOGLE_SHEETS_CREDENTIALS_PATH = os.getenv('GOOGLE_SHEETS_CREDENTIALS_PATH')
 GOOGLE_SHEET_KEY = os.getenv('GOOGLE_SHEET_KEY')
 SUPABASE_URL = os.getenv("SUPABASE_URL")
 SUPABASE_KEY = os.getenv("SUPABASE_KEY")
-ANALYSIS_WEBAPP_URL = os.getenv('ANALYSIS_WEBAPP_URL')
+# Falls back to the copy of webapp/ this server hosts at /webapp/
+ANALYSIS_WEBAPP_URL = os.getenv('ANALYSIS_WEBAPP_URL') or (f"{SERVER_URL.rstrip('/')}/webapp/" if SERVER_URL else None)
 # Master switch to pause daily inactivity/appreciation checks
 PAUSE_DAILY_CHECKS = True
 
@@ -191,6 +204,442 @@ try:
 except Exception as e:
     print(f"❌ FATAL: Could not initialize Supabase client. Error: {e}")
 
+# =============================================================================
+# 3.1. SUPABASE DATA-ACCESS LAYER (POOLING, TIMEOUTS, RETRIES & METRICS)
+# =============================================================================
+# Every supabase.table(...)...execute() and supabase.rpc(...).execute() call in
+# this file runs through instrumented_execute() below, the same way section 2.5
+# patches Telegram requests. This gives all queries one tuned httpx pool,
+# per-operation timeouts, retries for idempotent reads, and latency/error
+# metrics per table or RPC (see /dbstats). Identical reads that are already in
+# flight are merged into one request (singleflight). A write starts a new
+# generation for its table (or, for RPCs, for everything), so a read issued
+# after a write never joins a flight that started before it.
+SUPABASE_CONNECT_TIMEOUT = 5.0
+SUPABASE_TIMEOUTS = {'read': 10.0, 'write': 15.0, 'rpc': 20.0}  # seconds, per operation kind
+SUPABASE_POOL_LIMITS = httpx.Limits(max_connections=20, max_keepalive_connections=10, keepalive_expiry=60)
+SUPABASE_HTTP2 = os.getenv('SUPABASE_HTTP2', '1') == '1'
+SUPABASE_READ_RETRIES = 3
+SUPABASE_RETRY_BACKOFF = 0.4  # seconds, doubled after every failed attempt
+# RPCs that only read data, so retrying them is as safe as retrying a GET
+READ_ONLY_RPCS = {
+    'check_user_permission', 'get_active_users_for_practice', 'get_activity_report', 'get_all_time_rankers',
+    'get_group_performance_summary', 'get_pending_reviews_for_today', 'get_practice_report',
+    'get_random_law_entries', 'get_topic_leaderboard', 'get_unified_user_analysis', 'get_unified_user_stats',
+    'get_users_for_daily_reminder', 'get_users_for_final_warning', 'get_users_for_removal_notice',
+    'get_users_to_appreciate', 'get_users_to_warn', 'get_web_quiz_analytics', 'get_weekly_rankers', 'smart_search',
+}
+DB_LATENCY_BUCKETS_MS = (25, 50, 100, 250, 500, 1000, 2500, 5000)
+db_metrics = {}  # (name, operation) -> {'calls', 'errors', 'retries', 'coalesced', 'total_ms', 'max_ms', 'buckets'}
+db_metrics_lock = threading.Lock()
+_inflight_reads = {}  # singleflight_key -> {'done': Event, 'result', 'error', 'followers'} for reads currently on the wire
+_write_generations = defaultdict(int)  # table name (or '*' for write RPCs) -> completed writes
+singleflight_lock = threading.Lock()
+_db_call_context = threading.local()
+
+
+def describe_db_call(http_method, path, headers=None):
+    """Maps a PostgREST request to a (name, operation) pair, e.g. ('questions', 'select') or ('get_weekly_rankers', 'rpc')."""
+    parts = [p for p in str(path or '').split('?')[0].split('/') if p]
+    if len(parts) >= 2 and parts[-2] == 'rpc':
+        return parts[-1], 'rpc'
+    name = parts[-1] if parts else 'unknown'
+    method = str(http_method or 'GET').upper()
+    if method == 'POST' and 'merge-duplicates' in str((headers or {}).get('prefer', '')):
+        return name, 'upsert'
+    return name, {'GET': 'select', 'HEAD': 'count', 'POST': 'insert', 'PATCH': 'update', 'DELETE': 'delete'}.get(method, method.lower())
+
+
+def _is_transient_db_error(error):
+    """Connection drops, timeouts and 5xx responses are worth retrying; 4xx/logic errors are not."""
+    if isinstance(error, (httpx.TransportError, RemoteProtocolError)):
+        return True
+    return isinstance(error, APIError) and str(getattr(error, 'code', '')).startswith('5')
+
+
+def _get_db_stats(name, operation):
+    """Returns (creating if needed) the metrics entry for a table/RPC. Caller holds db_metrics_lock."""
+    return db_metrics.setdefault((name, operation), {
+        'calls': 0, 'errors': 0, 'retries': 0, 'coalesced': 0, 'total_ms': 0.0, 'max_ms': 0.0,
+        'buckets': [0] * (len(DB_LATENCY_BUCKETS_MS) + 1)
+    })
+
+
+def record_db_call(name, operation, elapsed_ms, failed=False, retries=0):
+    """Adds one call to the per-table/RPC latency histogram and error counters."""
+    with db_metrics_lock:
+        stats = _get_db_stats(name, operation)
+        stats['calls'] += 1
+        stats['errors'] += 1 if failed else 0
+        stats['retries'] += retries
+        stats['total_ms'] += elapsed_ms
+        stats['max_ms'] = max(stats['max_ms'], elapsed_ms)
+        stats['buckets'][bisect.bisect_left(DB_LATENCY_BUCKETS_MS, elapsed_ms)] += 1
+
+
+def db_latency_percentile(stats, percentile=0.95):
+    """Upper bound (ms) of the histogram bucket holding the given percentile, or None for the overflow bucket."""
+    target = stats['calls'] * percentile
+    running = 0
+    for bound, count in zip(DB_LATENCY_BUCKETS_MS + (None,), stats['buckets']):
+        running += count
+        if running >= target:
+            return bound
+    return None
+
+
+def get_db_metrics(sort_by='total_ms', limit=None):
+    """Returns a snapshot of the query metrics, hottest first."""
+    with db_metrics_lock:
+        rows = [dict(stats, name=name, operation=operation, buckets=list(stats['buckets'])) for (name, operation), stats in db_metrics.items()]
+    rows.sort(key=lambda row: row[sort_by], reverse=True)
+    return rows[:limit] if limit else rows
+
+
+def _apply_operation_timeout(request):
+    """httpx request hook: reads, writes and RPCs each get their own timeout."""
+    if '/rpc/' in request.url.path:
+        kind = 'rpc'
+    elif request.method in ('GET', 'HEAD'):
+        kind = 'read'
+    else:
+        kind = 'write'
+    request.extensions['timeout'] = httpx.Timeout(SUPABASE_TIMEOUTS[kind], connect=SUPABASE_CONNECT_TIMEOUT).as_dict()
+
+
+def singleflight_key(builder):
+    """Identity of a read: method, path, filters/projection (query params), body and the headers that shape the result."""
+    headers = getattr(builder, 'headers', None) or {}
+    body = getattr(builder, 'json', None)
+    return (
+        str(getattr(builder, 'http_method', 'GET')).upper(),
+        str(getattr(builder, 'path', '')),
+        str(getattr(builder, 'params', '')),
+        json.dumps(body, sort_keys=True, default=str) if body else '',
+        tuple(str(headers.get(h, '')) for h in ('range', 'prefer', 'accept')),
+    )
+
+
+def note_db_write(name, operation):
+    """Called when a write finishes: later reads of that table start their own flight."""
+    with singleflight_lock:
+        _write_generations['*' if operation == 'rpc' else name] += 1
+
+
+def run_singleflight(key, name, operation, fetch, wait_timeout):
+    """
+    Runs fetch() once for all identical reads that are in flight at the same
+    time. Followers wait for the leader and get their own copy of its result
+    (or its exception); each merged call is counted as 'coalesced'. The leader
+    keeps the object it returns, and followers copy an untouched snapshot, so
+    the leader's caller may mutate its result. A follower that waits longer
+    than wait_timeout stops waiting and fetches for itself.
+    """
+    with singleflight_lock:
+        key = (key, _write_generations[name], _write_generations['*'])
+        flight = _inflight_reads.get(key)
+        leader = flight is None
+        if leader:
+            flight = _inflight_reads[key] = {'done': threading.Event(), 'result': None, 'error': None, 'followers': 0}
+        else:
+            flight['followers'] += 1
+
+    if not leader:
+        if not flight['done'].wait(wait_timeout):
+            print(f"⚠️ Coalesced {operation} on '{name}' waited {wait_timeout:.0f}s for its leader; fetching separately.")
+            return fetch()
+        with db_metrics_lock:
+            _get_db_stats(name, operation)['coalesced'] += 1
+        if flight['error'] is not None:
+            raise flight['error']
+        return copy.deepcopy(flight['result'])
+
+    result = None
+    try:
+        result = fetch()
+        return result
+    except Exception as e:
+        flight['error'] = e
+        raise
+    finally:
+        with singleflight_lock:
+            _inflight_reads.pop(key, None)
+            followers = flight['followers']
+        if followers and flight['error'] is None:
+            flight['result'] = copy.deepcopy(result)
+        flight['done'].set()
+
+
+def _instrument_execute(original_execute):
+    """Wraps a PostgREST builder's execute() with timing, metrics, read retries and singleflight."""
+    @functools.wraps(original_execute)
+    def instrumented_execute(self, *args, **kwargs):
+        # maybe_single() calls single().execute() internally; only measure the outer call
+        if getattr(_db_call_context, 'active', False):
+            return original_execute(self, *args, **kwargs)
+
+        method = str(getattr(self, 'http_method', 'GET')).upper()
+        name, operation = describe_db_call(method, getattr(self, 'path', ''), getattr(self, 'headers', None))
+        idempotent = method in ('GET', 'HEAD') or (operation == 'rpc' and name in READ_ONLY_RPCS)
+        attempts = SUPABASE_READ_RETRIES if idempotent else 1
+
+        def fetch():
+            started = time.perf_counter()
+            _db_call_context.active = True
+            try:
+                for attempt in range(attempts):
+                    try:
+                        result = original_execute(self, *args, **kwargs)
+                        record_db_call(name, operation, (time.perf_counter() - started) * 1000, retries=attempt)
+                        return result
+                    except Exception as e:
+                        if attempt + 1 < attempts and _is_transient_db_error(e):
+                            print(f"⚠️ Supabase {operation} on '{name}' failed ({type(e).__name__}), retry {attempt + 1}/{attempts - 1}...")
+                            time.sleep(SUPABASE_RETRY_BACKOFF * (2 ** attempt) + random.uniform(0, 0.2))
+                            continue
+                        record_db_call(name, operation, (time.perf_counter() - started) * 1000, failed=True, retries=attempt)
+                        raise
+            finally:
+                _db_call_context.active = False
+
+        if not idempotent:
+            try:
+                return fetch()
+            finally:
+                note_db_write(name, operation)
+        if getattr(_db_call_context, 'fresh', False):
+            return fetch()
+        # Longest a healthy leader can take: every attempt timing out, plus the backoffs
+        wait_timeout = (SUPABASE_TIMEOUTS['rpc' if operation == 'rpc' else 'read'] + SUPABASE_CONNECT_TIMEOUT) * attempts \
+            + SUPABASE_RETRY_BACKOFF * (2 ** attempts)
+        return run_singleflight(singleflight_key(self), name, operation, fetch, wait_timeout)
+    instrumented_execute._db_instrumented = True
+    return instrumented_execute
+
+
+def install_supabase_data_layer(client):
+    """Routes all PostgREST calls through the instrumented execute() and a shared, tuned connection pool."""
+    try:
+        from postgrest._sync import request_builder as postgrest_builders
+        patched = 0
+        for attr in dir(postgrest_builders):
+            builder_class = getattr(postgrest_builders, attr)
+            if isinstance(builder_class, type) and 'execute' in builder_class.__dict__ \
+                    and not getattr(builder_class.__dict__['execute'], '_db_instrumented', False):
+                builder_class.execute = _instrument_execute(builder_class.__dict__['execute'])
+                patched += 1
+        print(f"✅ Supabase data layer: instrumented {patched} query builders.")
+    except Exception as e:
+        print(f"⚠️ Could not instrument Supabase query builders: {e}")
+
+    if not client:
+        return
+    try:
+        old_session = client.postgrest.session
+        try:
+            import h2  # noqa: F401  (HTTP/2 is optional and needs the 'h2' package)
+            use_http2 = SUPABASE_HTTP2
+        except ImportError:
+            use_http2 = False
+        client.postgrest.session = httpx.Client(
+            base_url=old_session.base_url,
+            headers=old_session.headers,
+            timeout=httpx.Timeout(SUPABASE_TIMEOUTS['read'], connect=SUPABASE_CONNECT_TIMEOUT),
+            limits=SUPABASE_POOL_LIMITS,
+            http2=use_http2,
+            follow_redirects=True,
+            event_hooks={'request': [_apply_operation_timeout]}
+        )
+        old_session.close()
+        print(f"✅ Supabase data layer: pooled client ready (HTTP/2: {'on' if use_http2 else 'off'}).")
+    except Exception as e:
+        print(f"⚠️ Could not install the pooled Supabase HTTP client: {e}")
+
+
+install_supabase_data_layer(supabase)
+
+# =============================================================================
+# 3.2. READ-THROUGH REFERENCE CACHE
+# =============================================================================
+# Small tables that rarely change (quiz presets, the quiz schedule, study tips,
+# delegated permissions) are served from memory. Entries expire after a
+# per-namespace TTL, the cache is size-bounded (LRU), and every writer in this
+# file calls invalidate_cache() so the bot never shows its own stale data.
+REFERENCE_CACHE_TTLS = {
+    'quiz_presets': 30 * 60,
+    'quiz_schedule': 10 * 60,
+    'study_tips': 30 * 60,
+    'user_permissions': 10 * 60,
+    'permission_checks': 5 * 60,
+    'rankers': 5 * 60,
+    'activity_report': 10 * 60,
+    'quiz_sets': 6 * 60 * 60,
+}
+REFERENCE_CACHE_DEFAULT_TTL = 5 * 60
+REFERENCE_CACHE_MAX_ENTRIES = 1024
+reference_cache = OrderedDict()  # (namespace, key) -> (expires_at, value)
+reference_cache_stats = defaultdict(lambda: {'hits': 0, 'misses': 0})
+reference_cache_lock = threading.Lock()
+
+
+def cached_read(namespace, key, loader, force_refresh=False):
+    """Returns the cached value for (namespace, key), calling loader() on a miss or expiry."""
+    cache_key = (namespace, key)
+    if not force_refresh:
+        with reference_cache_lock:
+            entry = reference_cache.get(cache_key)
+            if entry and entry[0] > time.time():
+                reference_cache.move_to_end(cache_key)
+                reference_cache_stats[namespace]['hits'] += 1
+                return entry[1]
+
+    # A forced refresh usually follows a write, so it must not join an older in-flight read
+    outer_fresh = getattr(_db_call_context, 'fresh', False)
+    _db_call_context.fresh = force_refresh or outer_fresh
+    try:
+        value = loader()
+    finally:
+        _db_call_context.fresh = outer_fresh
+    with reference_cache_lock:
+        reference_cache_stats[namespace]['misses'] += 1
+        reference_cache[cache_key] = (time.time() + REFERENCE_CACHE_TTLS.get(namespace, REFERENCE_CACHE_DEFAULT_TTL), value)
+        reference_cache.move_to_end(cache_key)
+        while len(reference_cache) > REFERENCE_CACHE_MAX_ENTRIES:
+            reference_cache.popitem(last=False)
+    return value
+
+
+def update_cached(namespace, key, transform):
+    """Applies a write-through change to a cached value (no-op if it isn't cached)."""
+    with reference_cache_lock:
+        entry = reference_cache.get((namespace, key))
+        if entry:
+            reference_cache[(namespace, key)] = (entry[0], transform(entry[1]))
+
+
+def invalidate_cache(namespace, key=None):
+    """Drops one key, or the whole namespace when key is None."""
+    with reference_cache_lock:
+        if key is not None:
+            reference_cache.pop((namespace, key), None)
+            return
+        for cache_key in [k for k in reference_cache if k[0] == namespace]:
+            del reference_cache[cache_key]
+
+
+def get_quiz_presets(force_refresh=False):
+    """All quiz_presets rows, ordered by id."""
+    return cached_read('quiz_presets', '*', lambda: supabase.table('quiz_presets').select('*').order('id').execute().data or [], force_refresh)
+
+
+def get_quiz_preset(set_name):
+    """One preset by set_name, or None."""
+    return next((preset for preset in get_quiz_presets() if preset.get('set_name') == set_name), None)
+
+
+def get_quiz_schedule(date_str, force_refresh=False):
+    """quiz_schedule rows for a 'YYYY-MM-DD' date, ordered by quiz_time."""
+    return cached_read('quiz_schedule', date_str, lambda: supabase.table('quiz_schedule').select('*').eq('quiz_date', date_str).order('quiz_time').execute().data or [], force_refresh)
+
+
+def get_unused_study_tips():
+    """Unused study_tips rows (id, content, category), ordered by id."""
+    return cached_read('study_tips', 'unused', lambda: supabase.table('study_tips').select('id, content, category').eq('used', False).order('id').execute().data or [])
+
+
+def mark_study_tip_used(tip_id):
+    """Flags a tip as used and removes it from the cached list."""
+    supabase.table('study_tips').update({'used': True}).eq('id', tip_id).execute()
+    update_cached('study_tips', 'unused', lambda tips: [tip for tip in tips if tip.get('id') != tip_id])
+
+
+def get_user_permissions(user_id):
+    """Command names delegated to a user via /promote."""
+    return cached_read('user_permissions', user_id, lambda: [row['command_name'] for row in supabase.table('user_permissions').select('command_name').eq('user_id', user_id).execute().data or []])
+
+
+def check_user_permission(user_id, command_name):
+    """Cached result of the check_user_permission RPC."""
+    return cached_read('permission_checks', (user_id, command_name), lambda: bool(supabase.rpc('check_user_permission', {'p_user_id': user_id, 'p_command_name': command_name}).execute().data))
+
+
+def invalidate_user_permissions(user_id):
+    """Called by /promote, /revoke and /demote after they change user_permissions."""
+    invalidate_cache('user_permissions', user_id)
+    invalidate_cache('permission_checks')
+
+# =============================================================================
+# 3.3. CONCURRENT QUERY FAN-OUT
+# =============================================================================
+# Handlers that need several independent queries run them together on a small
+# shared pool, so the wait is the slowest call instead of the sum of all calls.
+# Background work (stats refreshes, web result side effects) gets its own pool
+# so it can never queue ahead of a user who is waiting on a command.
+FANOUT_MAX_WORKERS = 8
+BACKGROUND_MAX_WORKERS = 4
+FANOUT_DEFAULT_DEADLINE = 20.0  # seconds for the whole batch
+fanout_pool = ThreadPoolExecutor(max_workers=FANOUT_MAX_WORKERS, thread_name_prefix='db-fanout')
+background_pool = ThreadPoolExecutor(max_workers=BACKGROUND_MAX_WORKERS, thread_name_prefix='db-background')
+
+
+def run_concurrently(tasks, deadline=FANOUT_DEFAULT_DEADLINE, pool=None):
+    """
+    Runs {name: callable} in parallel with one shared deadline.
+    Returns (results, errors): each name lands in exactly one of the two
+    dicts, so callers can carry on with partial data. Calls still running
+    at the deadline are reported as TimeoutError. Background callers pass
+    pool=background_pool.
+    """
+    pool = pool or fanout_pool
+    futures = {pool.submit(func): name for name, func in tasks.items()}
+    done, not_done = wait(futures, timeout=deadline)
+    results, errors = {}, {}
+    for future in done:
+        name = futures[future]
+        try:
+            results[name] = future.result()
+        except Exception as e:
+            errors[name] = e
+    for future in not_done:
+        errors[futures[future]] = TimeoutError(f"'{futures[future]}' did not finish within {deadline}s")
+    return results, errors
+
+# =============================================================================
+# 3.4. KEYSET TABLE SCANS
+# =============================================================================
+# A plain select() returns at most PostgREST's row cap, and OFFSET paging
+# skips or repeats rows when the table changes mid-scan. scan_table() pages
+# by "key > last key seen" and yields rows one at a time, so memory stays at
+# about one page. The next page is fetched in the background while the
+# caller works through the current one. Scans only end on an empty page, so
+# a server cap below page_size can't cut them short.
+SCAN_PAGE_SIZE = 1000
+scan_prefetch_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix='db-scan')
+
+
+def scan_table(table_name, columns='*', key='id', page_size=SCAN_PAGE_SIZE, where=None, prefetch=True):
+    """
+    Yields every row of table_name in `key` order. `key` must be unique and
+    sortable (id, user_id). `where` may add filters, e.g. lambda q: q.eq('used', False).
+    """
+    if columns != '*' and key not in [c.strip() for c in columns.split(',')]:
+        columns = f"{columns}, {key}"
+
+    def fetch_page(after):
+        query = supabase.table(table_name).select(columns)
+        if where:
+            query = where(query)
+        if after is not None:
+            query = query.gt(key, after)
+        return query.order(key).limit(page_size).execute().data or []
+
+    page = fetch_page(None)
+    while page:
+        after = page[-1][key]
+        next_page = scan_prefetch_pool.submit(fetch_page, after) if prefetch else None
+        yield from page
+        page = next_page.result() if next_page else fetch_page(after)
+
 # --- Global In-Memory Storage ---
 active_polls = []
 scheduled_tasks = []
@@ -202,15 +651,16 @@ last_daily_content_day = -1    # Tracks the day morning content (law/def) was se
 last_daily_resource_day = -1   # Tracks the day evening resource file was sent
 PAUSE_AUTO_SCHEDULES = False   # Master switch to pause auto-posts for the day
 pause_command_date = None      # Stores the date when the pause command was last used
-# Temporary storage for batch photo uploads
-photo_batches = {} # Stores photos by media_group_id or user_id
-batch_timers = {} # Stores timers to process the batch
+# Temporary storage for batch photo/file uploads (see add_to_media_batch)
+MEDIA_BATCH_QUIET_SECONDS = 2.0  # A batch is processed once no new file arrived for this long
+MEDIA_BATCH_TTL = 10 * 60        # Batches older than this are dropped, whatever state they are in
+media_batches = {}  # (user_id, kind) -> {'items': [], 'seen': set(), 'timer', 'created_at', 'on_complete'}
+media_batch_lock = threading.Lock()
 # Stores the current state of a team battle quiz
 team_battle_session = {}
 # Global Variables for Quiz Marathon System
 QUIZ_SESSIONS = {}
 QUIZ_PARTICIPANTS = {}
-user_states = {}
 pending_definitions = defaultdict(dict)
 session_lock = threading.Lock()
 # Legend Tier Thresholds (percentiles)
@@ -227,10 +677,748 @@ CHAT_ACTIVITY_WINDOW = 300 # 5 minutes in seconds
 CHAT_REMINDER_COOLDOWN = 1800 # 30 minutes in seconds
 last_exam_reminder_time = 0
 
+# =============================================================================
+# 3.5. CONVERSATION STATE STORE & STEP ROUTING
+# =============================================================================
+USER_STATE_TTL = 60 * 60  # A conversation untouched for an hour is abandoned
+
+
+class ConversationStateStore(MutableMapping):
+    """
+    The user_id -> state mapping behind every multi-step flow. Works like a
+    plain dict, but is safe to use from timer threads and forgets conversations
+    (entries with a 'step' or 'action') that have not been written, routed to or
+    had a button pressed for `ttl` seconds. Entries that only hold data, like the
+    'last_report_data' kept for /activity_report, never expire. Deadlines sit on
+    a min-heap, so sweep() only ever looks at entries that are actually due.
+
+    It is not a dict subclass: the entries live in a private dict and every
+    read, write and iteration goes through the methods below, so none of them
+    can skip the lock or the expiry check. keys(), values() and items() return
+    snapshots, so callers can iterate while other threads write.
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._states = {}
+        self._deadlines = {}
+        self._expiry_heap = []  # (deadline, user_id); stale pairs are skipped when popped
+        self._lock = threading.RLock()
+
+    def touch(self, user_id):
+        with self._lock:
+            if user_id in self._states:
+                deadline = time.time() + self.ttl
+                self._deadlines[user_id] = deadline
+                heapq.heappush(self._expiry_heap, (deadline, user_id))
+
+    def _expire(self, user_id):
+        """Caller holds self._lock and has checked the deadline. Returns True if the entry was removed."""
+        del self._deadlines[user_id]
+        state = self._states.get(user_id)
+        if isinstance(state, dict) and not (state.get('step') or state.get('action')):
+            return False
+        self._states.pop(user_id, None)
+        return True
+
+    def _expire_if_due(self, user_id):
+        deadline = self._deadlines.get(user_id)
+        if deadline is not None and deadline <= time.time():
+            with self._lock:
+                if self._deadlines.get(user_id) == deadline:
+                    self._expire(user_id)
+
+    def sweep(self):
+        """Removes every expired entry and returns how many were removed."""
+        removed = 0
+        now = time.time()
+        with self._lock:
+            while self._expiry_heap and self._expiry_heap[0][0] <= now:
+                deadline, user_id = heapq.heappop(self._expiry_heap)
+                if self._deadlines.get(user_id) == deadline and self._expire(user_id):
+                    removed += 1
+        return removed
+
+    def __setitem__(self, user_id, state):
+        with self._lock:
+            self._states[user_id] = state
+            self.touch(user_id)
+
+    def __getitem__(self, user_id):
+        self._expire_if_due(user_id)
+        return self._states[user_id]
+
+    def get(self, user_id, default=None):
+        self._expire_if_due(user_id)
+        return self._states.get(user_id, default)
+
+    def __contains__(self, user_id):
+        self._expire_if_due(user_id)
+        return user_id in self._states
+
+    def __delitem__(self, user_id):
+        with self._lock:
+            del self._states[user_id]
+            self._deadlines.pop(user_id, None)
+
+    def pop(self, user_id, *default):
+        with self._lock:
+            self._deadlines.pop(user_id, None)
+            return self._states.pop(user_id, *default)
+
+    def setdefault(self, user_id, default=None):
+        with self._lock:
+            self._expire_if_due(user_id)
+            if user_id not in self._states:
+                self[user_id] = default
+            return self._states[user_id]
+
+    def update(self, *args, **kwargs):
+        with self._lock:
+            for user_id, state in dict(*args, **kwargs).items():
+                self[user_id] = state
+
+    def clear(self):
+        with self._lock:
+            self._states.clear()
+            self._deadlines.clear()
+            self._expiry_heap.clear()
+
+    def items(self):
+        with self._lock:
+            self.sweep()
+            return list(self._states.items())
+
+    def keys(self):
+        with self._lock:
+            self.sweep()
+            return list(self._states)
+
+    def values(self):
+        with self._lock:
+            self.sweep()
+            return list(self._states.values())
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        with self._lock:
+            self.sweep()
+            return len(self._states)
+
+    def __repr__(self):
+        with self._lock:
+            return f"{type(self).__name__}({self._states!r})"
+
+
+user_states = ConversationStateStore(USER_STATE_TTL)
+
+# ('step' | 'action', value) -> route. Handlers register with conversation_step/conversation_action
+# and one message handler looks the user's state up here, instead of TeleBot running a
+# user_states filter per flow on every message.
+conversation_routes = {}
+
+
+def _register_conversation_route(field, values, content_types, func, accepts_forwards):
+    def decorator(handler):
+        route = {'handler': handler, 'content_types': set(content_types or ['text']), 'func': func,
+                 'accepts_forwards': accepts_forwards, 'order': len(conversation_routes)}
+        for value in values:
+            if (field, value) in conversation_routes:
+                print(f"⚠️ Conversation route {field}={value} is registered twice; keeping {conversation_routes[(field, value)]['handler'].__name__}.")
+                continue
+            conversation_routes[(field, value)] = route
+        return handler
+    return decorator
+
+
+def conversation_step(*steps, content_types=None, func=None, accepts_forwards=False):
+    """Routes messages from users whose state has one of these 'step' values to the handler."""
+    return _register_conversation_route('step', steps, content_types, func, accepts_forwards)
+
+
+def conversation_action(*actions, content_types=None, func=None, accepts_forwards=False):
+    """Routes messages from users whose state has one of these 'action' values to the handler."""
+    return _register_conversation_route('action', actions, content_types, func, accepts_forwards)
+
+
+def find_conversation_route(msg):
+    """
+    Returns the route for the sender's current state, or None. Commands are never
+    routed, so /cancel and friends keep working in the middle of a flow. When both
+    the action and the step have a route, the one registered first wins.
+
+    The router is registered ahead of every other message handler, so a user in a
+    flow always reaches it. Two catch-all handlers used to sit between the flows:
+    - handle_forwarded_message (an admin forwarding in a DM starts a quoted reply).
+      It still wins over every route not registered with accepts_forwards=True, as
+      it did for the flows defined after it.
+    - forward_user_reply_to_admin (any DM from a regular member goes to the admin).
+      It used to swallow a member's answers to /testme and /newdef in a DM. Those
+      answers now reach their flow, which is the one behaviour change.
+    """
+    if not msg.from_user or (msg.text and msg.text.startswith('/')):
+        return None
+    state = user_states.get(msg.from_user.id)
+    if not state:
+        return None
+    admin_forward = None
+    best = None
+    for key in (('action', state.get('action')), ('step', state.get('step'))):
+        route = conversation_routes.get(key)
+        if route and not route['accepts_forwards']:
+            if admin_forward is None:
+                admin_forward = bool((msg.forward_from or msg.forward_from_chat) and msg.chat.type == 'private' and is_admin(msg.from_user.id))
+            if admin_forward:
+                continue
+        if (route and msg.content_type in route['content_types']
+                and (route['func'] is None or route['func'](msg))
+                and (best is None or route['order'] < best['order'])):
+            best = route
+    return best
+
+
+def _has_conversation_route(msg):
+    """Handler filter; keeps the route on the message so the handler doesn't look it up again."""
+    msg.conversation_route = find_conversation_route(msg)
+    return msg.conversation_route is not None
+
+
+@bot.message_handler(
+    func=_has_conversation_route,
+    content_types=['text', 'photo', 'video', 'document', 'audio', 'sticker', 'animation', 'voice', 'video_note']
+)
+def route_conversation_message(msg: types.Message):
+    route = getattr(msg, 'conversation_route', None) or find_conversation_route(msg)
+    if route:
+        user_states.touch(msg.from_user.id)
+        route['handler'](msg)
+
+# =============================================================================
+# 3.6. DURABLE NEXT-STEP HANDLERS
+# =============================================================================
+# register_next_step_handler only keeps the callback in TeleBot's memory, so a
+# deploy or crash strands everyone mid-flow. Each registration is mirrored to a
+# bot_state row ('next_step:<chat_id>' -> {"h": name, "a": args, "k": kwargs, "exp": epoch})
+# and re-registered on that chat's next message after a restart. Most steps also
+# read the flow's user_states entry, which lives only in memory, so that entry is
+# stored with the step ("u": user_id, "s": state). A step whose state couldn't be
+# stored is not restored; the message then goes through the normal handlers.
+# Nothing is written while a handler runs: the webhook collects the update's
+# registrations and consumed steps, and hands the last one per chat to the
+# background writer once TeleBot returns, so the record (and the state stored
+# with it) is built after the handler has finished changing them.
+NEXT_STEP_TTL = USER_STATE_TTL
+NEXT_STEP_KEY_PREFIX = 'next_step:'
+restorable_next_steps = set()  # chat_ids with a stored handler not yet loaded into TeleBot
+next_step_lock = threading.Lock()
+# One writer keeps a chat's delete/upsert in the order they were issued
+next_step_writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='next-step-store')
+_next_step_batch = threading.local()  # .writes: chat_id -> step or None while the webhook handles an update
+
+original_register_next_step_handler_by_chat_id = bot.register_next_step_handler_by_chat_id  # Save the original function
+
+
+def _next_step_record(chat_id, step):
+    """The stored JSON for (handler name, args, kwargs, expiry), with the chat's conversation state."""
+    name, args, kwargs, expires = step
+    record = {'h': name, 'a': args, 'k': kwargs, 'exp': expires}
+    user_id, state = _conversation_for_chat(chat_id)
+    if user_id is False:
+        record['u'] = None  # Several flows in this chat; none of them can be restored safely
+    elif user_id is not None:
+        record['u'] = user_id
+        try:
+            # Only keep states that come back unchanged (no sets, int keys, objects...)
+            if json.loads(json.dumps(state)) == state:
+                record['s'] = state
+        except (TypeError, ValueError, RuntimeError):  # RuntimeError: the next update changed it mid-dump
+            pass
+    return json.dumps(record, separators=(',', ':'))
+
+
+def _write_next_step(chat_id, step):
+    try:
+        if step is None:
+            supabase.table('bot_state').delete().eq('key', f"{NEXT_STEP_KEY_PREFIX}{chat_id}").execute()
+        else:
+            supabase.table('bot_state').upsert({'key': f"{NEXT_STEP_KEY_PREFIX}{chat_id}", 'value': _next_step_record(chat_id, step)}).execute()
+    except Exception as e:
+        print(f"⚠️ Could not persist next-step handler for chat {chat_id}: {e}")
+
+
+def _queue_next_step_write(chat_id, step):
+    """Stores (step) or deletes (None) a chat's step: at the end of the current update, or now if there isn't one."""
+    writes = getattr(_next_step_batch, 'writes', None)
+    if writes is not None:
+        writes[chat_id] = step  # A step consumed and re-registered in one update is a single upsert
+    else:
+        next_step_writer.submit(_write_next_step, chat_id, step)
+
+
+def start_next_step_batch():
+    """Webhook: collect this update's next-step writes instead of issuing them."""
+    _next_step_batch.writes = {}
+
+
+def flush_next_step_batch():
+    """Webhook, after TeleBot returns: hands the collected writes to the background writer."""
+    writes = getattr(_next_step_batch, 'writes', None) or {}
+    _next_step_batch.writes = None
+    for chat_id, step in writes.items():
+        next_step_writer.submit(_write_next_step, chat_id, step)
+
+
+def _conversation_for_chat(chat_id):
+    """(user_id, state) of the user_states entry a step in this chat belongs to, or (None, None)."""
+    state = user_states.get(chat_id)
+    if state is not None:
+        return chat_id, state
+    # Group flows are keyed by user and remember their chat
+    matches = [(user_id, state) for user_id, state in user_states.items()
+               if isinstance(state, dict) and state.get('chat_id') == chat_id]
+    if len(matches) == 1:
+        return matches[0]
+    return (False, None) if matches else (None, None)  # False: more than one candidate
+
+
+def _durable_step_callback(chat_id, callback):
+    """Wraps a step callback so its stored copy is dropped once TeleBot hands it a message."""
+    def run_step(message, *args, **kwargs):
+        if supabase:
+            _queue_next_step_write(chat_id, None)
+        return callback(message, *args, **kwargs)
+    return run_step
+
+
+def durable_register_next_step_handler_by_chat_id(chat_id, callback, *args, **kwargs):
+    """
+    A patched version of register_next_step_handler_by_chat_id that also stores the
+    step. Only module-level callbacks with JSON-serialisable arguments can be stored;
+    anything else still works, it just won't survive a restart.
+    """
+    with next_step_lock:
+        restorable_next_steps.discard(chat_id)
+    if supabase:
+        name = getattr(callback, '__name__', None)
+        if name and globals().get(name) is callback:
+            try:
+                json.dumps([args, kwargs])  # Fail here, not in the writer, if they can't be stored
+                _queue_next_step_write(chat_id, (name, list(args), kwargs, int(time.time() + NEXT_STEP_TTL)))
+                callback = _durable_step_callback(chat_id, callback)
+            except (TypeError, ValueError):
+                print(f"⚠️ Next step {name} for chat {chat_id} has arguments that can't be stored; it won't survive a restart.")
+    return original_register_next_step_handler_by_chat_id(chat_id, callback, *args, **kwargs)
+
+
+# TeleBot.register_next_step_handler goes through the by_chat_id variant, so this covers both
+bot.register_next_step_handler_by_chat_id = durable_register_next_step_handler_by_chat_id
+
+
+def load_pending_next_steps():
+    """Startup: notes which chats have a stored step. The steps themselves are read lazily."""
+    if not supabase:
+        return
+    try:
+        keys = scan_table('bot_state', columns='key', key='key', where=lambda q: q.like('key', f"{NEXT_STEP_KEY_PREFIX}%"))
+        chat_ids = {int(row['key'][len(NEXT_STEP_KEY_PREFIX):]) for row in keys}
+        with next_step_lock:
+            restorable_next_steps.update(chat_ids)
+        print(f"✅ {len(chat_ids)} stored next-step handler(s) waiting to be restored.")
+    except Exception as e:
+        print(f"⚠️ Could not load stored next-step handlers: {e}")
+
+
+def restore_next_step_handler(message):
+    """
+    Called by the webhook before TeleBot sees the update. If this chat had a step
+    pending when the bot last stopped, it is registered again (with its user_states
+    entry) so the message lands in the same flow. Expired or unknown steps, and
+    steps whose state wasn't stored, are just deleted.
+    """
+    if not message or not restorable_next_steps:
+        return
+    chat_id = message.chat.id
+    with next_step_lock:
+        if chat_id not in restorable_next_steps:
+            return
+        restorable_next_steps.discard(chat_id)
+    try:
+        response = supabase.table('bot_state').select('value').eq('key', f"{NEXT_STEP_KEY_PREFIX}{chat_id}").execute()
+        if not response.data:
+            return
+        stored = json.loads(response.data[0]['value'])
+        callback = globals().get(stored['h'])
+        if stored['exp'] < time.time() or not callable(callback):
+            _queue_next_step_write(chat_id, None)
+            return
+        if 'u' in stored and stored['u'] not in user_states:
+            if 's' not in stored:
+                print(f"ℹ️ Not restoring next step {stored['h']} for chat {chat_id}: its conversation state was lost.")
+                _queue_next_step_write(chat_id, None)
+                return
+            user_states[stored['u']] = stored['s']
+        original_register_next_step_handler_by_chat_id(chat_id, _durable_step_callback(chat_id, callback), *stored['a'], **stored['k'])
+        print(f"✅ Restored next step {stored['h']} for chat {chat_id}.")
+    except Exception as e:
+        print(f"⚠️ Could not restore next-step handler for chat {chat_id}: {e}")
+
+
+def purge_expired_next_steps():
+    """Deletes stored steps whose users never came back."""
+    if not supabase:
+        return
+    try:
+        now = time.time()
+        expired = [row['key'] for row in scan_table('bot_state', columns='key, value', key='key', where=lambda q: q.like('key', f"{NEXT_STEP_KEY_PREFIX}%"))
+                   if json.loads(row['value'])['exp'] < now]
+        for start in range(0, len(expired), 200):
+            supabase.table('bot_state').delete().in_('key', expired[start:start + 200]).execute()
+        with next_step_lock:
+            restorable_next_steps.difference_update(int(k[len(NEXT_STEP_KEY_PREFIX):]) for k in expired)
+        if expired:
+            print(f"🧹 Purged {len(expired)} expired next-step handler(s).")
+    except Exception as e:
+        print(f"⚠️ Could not purge expired next-step handlers: {e}")
+
+# =============================================================================
+# 3.7. COMPILED UPDATE DISPATCH
+# =============================================================================
+# TeleBot tests every registered handler's filters in order until one matches.
+# compile_dispatch_table() indexes the handlers once at startup (commands and
+# content types for messages, exact/prefix callback_data for callback queries), so
+# each update only runs the filters of handlers that could match it, still in
+# registration order. Handlers whose filters can't be indexed are always tested.
+# Every DISPATCH_SAMPLE_EVERY-th update also times the filters the old loop would
+# have run on the skipped handlers, so /dbstats compares real before/after costs.
+DISPATCH_SAMPLE_EVERY = 20
+dispatch_tables = {}  # update_type -> compiled table
+dispatch_stats = {}   # update_type -> {'updates', 'candidates', 'handlers', 'total_us', 'sampled', 'skipped', 'skipped_us'}
+dispatch_stats_lock = threading.Lock()
+callback_ack_texts = {}  # callback_data value or prefix -> toast sent if the handler hasn't answered in time
+
+
+def callback_data_filter(*prefixes, exact=(), ack_text=None):
+    """
+    callback_query_handler filter matching call.data that starts with one of the
+    prefixes or equals one of the exact values. The keys are kept on the filter so
+    the compiled dispatch table can index the handler. ack_text is the toast the
+    automatic acknowledgement shows for these buttons (see section 3.8).
+    """
+    exact = frozenset(exact)
+    if ack_text:
+        for key in (*prefixes, *exact):
+            callback_ack_texts[key] = ack_text
+
+    def check(call):
+        return call.data in exact or call.data.startswith(prefixes)
+    check.dispatch_keys = (prefixes, exact)
+    return check
+
+
+def _handler_label(handler):
+    function = handler['function']
+    function = getattr(function, '__wrapped__', function)
+    return f"{function.__name__} (line {function.__code__.co_firstlineno})"
+
+
+def _compile_message_handlers(handlers):
+    by_command = defaultdict(list)
+    by_content_type = defaultdict(list)
+    for index, handler in enumerate(handlers):
+        filters = handler['filters']
+        if filters.get('commands'):
+            for command in filters['commands']:
+                by_command[command].append(index)
+        else:
+            for content_type in filters.get('content_types') or ['text']:
+                by_content_type[content_type].append(index)
+
+    for command, indexes in by_command.items():
+        if len(indexes) > 1:
+            labels = ', '.join(_handler_label(handlers[i]) for i in indexes)
+            print(f"⚠️ /{command} is registered {len(indexes)} times: {labels}. Only the first handler whose filters pass runs.")
+    return {'handlers': handlers, 'size': len(handlers), 'select': _select_message_handlers,
+            'by_command': dict(by_command), 'by_content_type': dict(by_content_type), 'cache': {}}
+
+
+def _select_message_handlers(table, message):
+    command = extract_command(message.text) if message.content_type == 'text' and message.text else None
+    key = (message.content_type, command if command in table['by_command'] else None)
+    candidates = table['cache'].get(key)
+    if candidates is None:
+        indexes = sorted(table['by_content_type'].get(key[0], []) + table['by_command'].get(key[1], []))
+        candidates = table['cache'][key] = [table['handlers'][i] for i in indexes]
+    return candidates
+
+
+def _compile_callback_handlers(handlers):
+    exact, prefixes, ambiguous = defaultdict(list), defaultdict(list), []
+    for index, handler in enumerate(handlers):
+        keys = getattr(handler['filters'].get('func'), 'dispatch_keys', None)
+        if keys is None or len(handler['filters']) > 1:
+            ambiguous.append(index)
+            continue
+        for prefix in keys[0]:
+            prefixes[prefix].append(index)
+        for value in keys[1]:
+            exact[value].append(index)
+
+    for kind, keyed in (('prefix', prefixes), ('callback_data', exact)):
+        for key, indexes in keyed.items():
+            if len(indexes) > 1:
+                labels = ', '.join(_handler_label(handlers[i]) for i in indexes)
+                print(f"⚠️ Callback {kind} '{key}' is registered {len(indexes)} times: {labels}. Only the first one runs.")
+            # A shorter prefix registered earlier catches everything this key would
+            for prefix, prefix_indexes in prefixes.items():
+                if prefix != key and key.startswith(prefix) and prefix_indexes[0] < indexes[0]:
+                    print(f"⚠️ Callback {kind} '{key}' of {_handler_label(handlers[indexes[0]])} is unreachable: "
+                          f"prefix '{prefix}' of {_handler_label(handlers[prefix_indexes[0]])} matches first.")
+    return {'handlers': handlers, 'size': len(handlers), 'select': _select_callback_handlers,
+            'exact': dict(exact), 'prefixes': dict(prefixes), 'ambiguous': ambiguous,
+            'prefix_lengths': sorted({len(prefix) for prefix in prefixes})}
+
+
+def _select_callback_handlers(table, call):
+    data = call.data or ''
+    indexes = list(table['ambiguous']) + table['exact'].get(data, [])
+    for length in table['prefix_lengths']:
+        if length > len(data):
+            break
+        indexes += table['prefixes'].get(data[:length], [])
+    return [table['handlers'][i] for i in sorted(set(indexes))]
+
+
+def compile_dispatch_table():
+    """Startup, after every handler is registered: builds the dispatch tables and reports duplicate registrations."""
+    dispatch_tables['message'] = _compile_message_handlers(bot.message_handlers)
+    dispatch_tables['callback_query'] = _compile_callback_handlers(bot.callback_query_handlers)
+    print(f"✅ Compiled dispatch: {len(bot.message_handlers)} message handlers "
+          f"({len(dispatch_tables['message']['by_command'])} commands), {len(bot.callback_query_handlers)} callback handlers "
+          f"({len(dispatch_tables['callback_query']['ambiguous'])} unindexed).")
+
+
+original_notify_command_handlers = bot._notify_command_handlers  # Save the original function
+
+
+class _TrackedCandidates(list):
+    """
+    Candidate list that remembers how far TeleBot's loop got. The loop stops at the
+    first match, so the iterator only runs to the end when no candidate matched.
+    """
+    last_tested = None
+    exhausted = False
+
+    def __iter__(self):
+        for handler in list.__iter__(self):
+            self.last_tested = handler
+            yield handler
+        self.exhausted = True
+
+    @property
+    def matched(self):
+        return self.last_tested is not None and not self.exhausted
+
+
+def _time_skipped_filters(table, candidates, update):
+    """
+    Tests the handlers the full list would have tried before TeleBot's loop stopped,
+    minus the candidates, and returns (count, µs). These filters fail on their
+    content type, command or callback_data key before any func runs, so testing
+    them has no side effects. One that passes means the index is wrong.
+    """
+    handlers = table['handlers']
+    # With no match the full loop would have tested every handler, not stopped at the last candidate
+    stop = handlers.index(candidates.last_tested) if candidates.matched else len(handlers) - 1
+    candidate_ids = {id(handler) for handler in candidates}
+    skipped = [handler for handler in handlers[:stop + 1] if id(handler) not in candidate_ids]
+    started = time.perf_counter()
+    for handler in skipped:
+        if bot._test_message_handler(handler, update):
+            print(f"⚠️ Dispatch table skipped {_handler_label(handler)}, which matches this update. Rebuilding it is needed.")
+    return len(skipped), (time.perf_counter() - started) * 1_000_000
+
+
+def compiled_notify_command_handlers(handlers, new_messages, update_type):
+    """
+    A patched version of TeleBot's handler loop that hands it only the candidate
+    handlers for each update. Falls back to the full list if the table is missing
+    or the handlers changed after it was compiled.
+    """
+    table = dispatch_tables.get(update_type)
+    if table is None or table['handlers'] is not handlers or len(handlers) != table['size']:
+        return original_notify_command_handlers(handlers, new_messages, update_type)
+
+    for update in new_messages:
+        started = time.perf_counter()
+        try:
+            candidates = _TrackedCandidates(table['select'](table, update))
+        except Exception as e:
+            print(f"⚠️ Dispatch lookup failed, using the full handler list: {e}")
+            original_notify_command_handlers(handlers, [update], update_type)
+            continue
+        elapsed_us = (time.perf_counter() - started) * 1_000_000
+        with dispatch_stats_lock:
+            stats = dispatch_stats.setdefault(update_type, {'updates': 0, 'candidates': 0, 'handlers': 0, 'total_us': 0.0,
+                                                            'sampled': 0, 'skipped': 0, 'skipped_us': 0.0})
+            stats['updates'] += 1
+            stats['candidates'] += len(candidates)
+            stats['handlers'] = len(handlers)
+            stats['total_us'] += elapsed_us
+            sample = stats['updates'] % DISPATCH_SAMPLE_EVERY == 1
+        original_notify_command_handlers(candidates, [update], update_type)
+        if sample:
+            try:
+                skipped, skipped_us = _time_skipped_filters(table, candidates, update)
+            except Exception as e:
+                print(f"⚠️ Could not time skipped dispatch filters: {e}")
+                continue
+            with dispatch_stats_lock:
+                stats['sampled'] += 1
+                stats['skipped'] += skipped
+                stats['skipped_us'] += skipped_us
+
+
+bot._notify_command_handlers = compiled_notify_command_handlers
+
+# =============================================================================
+# 3.8. CALLBACK QUERY AUTO-ACK
+# =============================================================================
+# Telegram shows a spinner on a pressed button until answerCallbackQuery is called,
+# and many handlers only answer after their Supabase work (or never). Handlers still
+# run one at a time on the webhook thread, as TeleBot runs them, but a timer
+# acknowledges the query once CALLBACK_ACK_GRACE runs out, unless the handler has
+# answered by then. The acknowledgement carries the ack_text the handler declared
+# with callback_data_filter, if any. Telegram accepts one answer per query, so a
+# later answer is dropped, except a show_alert one, which is sent as a message.
+CALLBACK_ACK_GRACE = 0.3  # Seconds a handler gets to send its own answer
+callback_acks = {}  # callback_query_id -> {'acked': bool, 'user_id', 'chat_id'}
+callback_ack_lock = threading.Lock()
+
+original_answer_callback_query = bot.answer_callback_query  # Save the original functions
+original_process_new_callback_query = bot.process_new_callback_query
+
+
+def _claim_callback_ack(callback_query_id):
+    """True if the caller gets to answer this query; False if it was already answered."""
+    with callback_ack_lock:
+        ack = callback_acks.get(callback_query_id)
+        if ack is None:
+            return True
+        if ack['acked']:
+            return False
+        ack['acked'] = True
+    return True
+
+
+def _declared_ack_text(data):
+    """The ack_text declared for this callback_data: an exact match, else the longest matching prefix."""
+    if not data or not callback_ack_texts:
+        return None
+    if data in callback_ack_texts:
+        return callback_ack_texts[data]
+    for length in range(len(data) - 1, 0, -1):
+        if data[:length] in callback_ack_texts:
+            return callback_ack_texts[data[:length]]
+    return None
+
+
+def _auto_ack_callback(call):
+    if _claim_callback_ack(call.id):
+        try:
+            original_answer_callback_query(call.id, _declared_ack_text(call.data))
+        except ApiTelegramException as e:
+            print(f"⚠️ Could not acknowledge callback query: {e.description}")
+
+
+def _send_late_alert(ack, text):
+    """Delivers an alert that came too late to be shown on the button, in a DM if possible."""
+    for chat_id in dict.fromkeys(filter(None, (ack['user_id'], ack['chat_id']))):
+        try:
+            bot.send_message(chat_id, text)
+            return
+        except ApiTelegramException as e:
+            print(f"⚠️ Could not deliver late callback alert to {chat_id}: {e.description}")
+
+
+def tracked_answer_callback_query(callback_query_id, *args, **kwargs):
+    """
+    A patched version of answer_callback_query that skips the API call when the
+    query was already acknowledged, instead of failing with 'query is too old'.
+    """
+    if _claim_callback_ack(callback_query_id):
+        return original_answer_callback_query(callback_query_id, *args, **kwargs)
+    text = kwargs.get('text') or (args[0] if args else None)
+    show_alert = kwargs.get('show_alert') or (args[1] if len(args) > 1 else False)
+    if text and show_alert:
+        with callback_ack_lock:
+            ack = callback_acks.get(callback_query_id)
+        if ack:
+            _send_late_alert(ack, text)
+            return False
+    if text:
+        print(f"ℹ️ Callback query already acknowledged; dropped late toast: {text}")
+    return False
+
+
+def auto_ack_process_new_callback_query(new_callback_queries):
+    """
+    A patched version of process_new_callback_query. Each query is handled on the
+    calling (webhook) thread in order, exactly as before, while a timer acknowledges
+    it if the handler hasn't answered within CALLBACK_ACK_GRACE.
+    """
+    for call in new_callback_queries:
+        with callback_ack_lock:
+            callback_acks[call.id] = {'acked': False, 'user_id': call.from_user.id,
+                                      'chat_id': call.message.chat.id if call.message else None}
+        timer = threading.Timer(CALLBACK_ACK_GRACE, _auto_ack_callback, args=(call,))
+        timer.daemon = True
+        timer.start()
+        # A button press keeps the presser's conversation alive, like a routed message does
+        user_states.touch(call.from_user.id)
+        try:
+            original_process_new_callback_query([call])
+        except Exception as e:
+            print(f"❌ Error in callback handler for '{call.data}': {e}")
+            report_error_to_admin(f"Error handling callback '{call.data}':\n{traceback.format_exc()}")
+        finally:
+            timer.cancel()
+            # Handlers that never answer still get their spinner stopped
+            _auto_ack_callback(call)
+            with callback_ack_lock:
+                callback_acks.pop(call.id, None)
+
+
+bot.answer_callback_query = tracked_answer_callback_query
+bot.process_new_callback_query = auto_ack_process_new_callback_query
+
 # =============================================================================
 # 4. GOOGLE SHEETS INTEGRATION
 # =============================================================================
-def get_gsheet():
+GSHEET_CLIENT_TTL = 6 * 60 * 60      # Re-authorise the long-lived client every 6 hours
+GLOSSARY_REFRESH_SECONDS = 15 * 60   # Re-read the Glossary worksheet every 15 minutes
+_gsheet_client = {'workbook': None, 'created_at': 0}
+gsheet_lock = threading.Lock()
+
+
+def get_gsheet(force_refresh=False):
+    """
+    Returns a long-lived, authorised workbook handle. gspread refreshes the
+    access token by itself, so we only re-authorise after GSHEET_CLIENT_TTL.
+    """
+    with gsheet_lock:
+        is_fresh = time.time() - _gsheet_client['created_at'] < GSHEET_CLIENT_TTL
+        if _gsheet_client['workbook'] and is_fresh and not force_refresh:
+            return _gsheet_client['workbook']
+        workbook = _open_gsheet()
+        if workbook:
+            _gsheet_client['workbook'] = workbook
+            _gsheet_client['created_at'] = time.time()
+        return workbook
+
+
+def _open_gsheet():
     """Connects to Google Sheets using the modern google-auth library."""
     try:
         scope = [
@@ -279,6 +1467,100 @@ def initialize_gsheet():
             print("❌ Could not get sheet object to initialize.")
     except Exception as e:
         print(f"❌ Initial sheet check failed: {e}")
+
+
+# --- In-Memory Glossary Index ---
+# /define, /newdef and the daily "Term of the Day" used to hit the Glossary
+# worksheet on every call (find, col_values, get_all_values). We keep the
+# whole sheet in memory, keyed by normalised term, and track the max ID locally.
+glossary_index = {
+    'by_term': {},   # normalised term -> {'id', 'term', 'definition', 'category'}
+    'entries': [],   # all entries, in sheet order
+    'max_id': 0,
+    'loaded_at': 0
+}
+glossary_lock = threading.RLock()
+
+
+def normalize_glossary_term(term):
+    """'  Going   Concern. ' and 'going concern' map to the same key."""
+    return re.sub(r'\s+', ' ', str(term or '')).strip(' .,:;!?').lower()
+
+
+def load_glossary(force=False):
+    """(Re)loads the Glossary worksheet into memory if it is stale. Returns True if usable."""
+    with glossary_lock:
+        if not force and glossary_index['loaded_at'] and time.time() - glossary_index['loaded_at'] < GLOSSARY_REFRESH_SECONDS:
+            return True
+        try:
+            workbook = get_gsheet()
+            if not workbook:
+                return bool(glossary_index['loaded_at'])
+            all_values = workbook.worksheet('Glossary').get_all_values()
+        except Exception as e:
+            print(f"⚠️ Could not refresh glossary index: {e}")
+            # Drop the cached client in case its session went bad; keep serving the old index
+            _gsheet_client['workbook'] = None
+            return bool(glossary_index['loaded_at'])
+
+        by_term, entries, max_id = {}, [], 0
+        for row in all_values[1:]:
+            if len(row) < 3 or not row[1].strip():
+                continue
+            entry = {
+                'id': row[0],
+                'term': row[1],
+                'definition': row[2],
+                'category': row[3] if len(row) > 3 and row[3] else 'General'
+            }
+            entries.append(entry)
+            by_term.setdefault(normalize_glossary_term(row[1]), entry)
+            if str(row[0]).isdigit():
+                max_id = max(max_id, int(row[0]))
+
+        glossary_index.update({'by_term': by_term, 'entries': entries, 'max_id': max_id, 'loaded_at': time.time()})
+        print(f"✅ Glossary index loaded with {len(entries)} terms.")
+        return True
+
+
+def glossary_lookup(term):
+    """Returns the glossary entry for a term (case/space-insensitive), or None."""
+    load_glossary()
+    return glossary_index['by_term'].get(normalize_glossary_term(term))
+
+
+def glossary_suggestions(term, limit=3):
+    """Returns up to `limit` known terms that look like the given one."""
+    load_glossary()
+    keys = difflib.get_close_matches(normalize_glossary_term(term), list(glossary_index['by_term'].keys()), n=limit, cutoff=0.7)
+    return [glossary_index['by_term'][k]['term'] for k in keys]
+
+
+def glossary_random_entry():
+    """Returns a random glossary entry, or None if the glossary is empty."""
+    load_glossary()
+    entries = glossary_index['entries']
+    return random.choice(entries) if entries else None
+
+
+def glossary_append(term, definition, category):
+    """
+    Appends a new term to the Glossary sheet using the locally tracked max ID
+    and updates the index. Returns False if the sheet is unreachable.
+    """
+    with glossary_lock:
+        load_glossary()
+        workbook = get_gsheet()
+        if not workbook:
+            return False
+        next_id = glossary_index['max_id'] + 1
+        workbook.worksheet('Glossary').append_row([str(next_id), term, definition, category])
+
+        entry = {'id': str(next_id), 'term': term, 'definition': definition, 'category': category or 'General'}
+        glossary_index['entries'].append(entry)
+        glossary_index['by_term'].setdefault(normalize_glossary_term(term), entry)
+        glossary_index['max_id'] = next_id
+        return True
 # =============================================================================
 # 5. HELPER FUNCTIONS
 # =============================================================================
@@ -321,8 +1603,7 @@ def has_permission(user_id, command_name):
     if is_admin(user_id):
         return True
     try:
-        res = supabase.rpc('check_user_permission', {'p_user_id': user_id, 'p_command_name': command_name}).execute()
-        return res.data
+        return check_user_permission(user_id, command_name)
     except Exception as e:
         print(f"Error in has_permission check for {user_id} on '{command_name}': {e}")
         return False
@@ -330,13 +1611,126 @@ def has_any_permission(user_id):
     """Checks if a user has been granted any permission in the database."""
     try:
         # Check if any row exists for this user_id in the permissions table
-        res = supabase.table('user_permissions').select('id', count='exact').eq('user_id', user_id).limit(1).execute()
-        return res.count > 0
+        return len(get_user_permissions(user_id)) > 0
     except Exception as e:
         print(f"Error checking for any permission for user {user_id}: {e}")
         return False
 
 
+# =============================================================================
+# 5.1. EDIT COALESCER (FLOOD-SAFE MESSAGE EDITS)
+# =============================================================================
+# Countdowns, /testme waiting rooms and Vault navigation edit the same message
+# again and again. Every edit goes through here, keyed by (chat_id, message_id):
+# only the latest pending content is kept, no-op edits are dropped by content
+# hash, and each message is flushed at most once per EDIT_MIN_INTERVAL.
+EDIT_MIN_INTERVAL = 1.0   # Minimum seconds between two edits of the same message
+EDIT_STATE_TTL = 3600     # Forget per-message bookkeeping after 1 hour of silence
+_pending_edits = {}       # key -> latest edit waiting to be flushed
+_edit_timers = {}         # key -> threading.Timer that will flush the key
+_last_edit_hash = {}      # key -> content hash of the last edit Telegram accepted
+_last_edit_time = {}      # key -> time.time() of the last flush
+_dead_edit_keys = set()   # keys whose message can no longer be edited (deleted etc.)
+edit_lock = threading.Lock()
+# Only these mean the message itself is gone for good; anything else may be a one-off
+EDIT_DEAD_ERRORS = ("message to edit not found", "message can't be edited")
+
+
+def _edit_content_hash(text, reply_markup, parse_mode):
+    """Hashes everything that makes an edit visible, so identical edits can be skipped."""
+    markup_json = reply_markup.to_json() if reply_markup else ''
+    return hash((text, markup_json, parse_mode))
+
+
+def _prune_edit_state():
+    """Drops bookkeeping for messages that have not been edited recently. Call with edit_lock held."""
+    cutoff = time.time() - EDIT_STATE_TTL
+    for key in [k for k, t in _last_edit_time.items() if t < cutoff and k not in _pending_edits]:
+        _last_edit_time.pop(key, None)
+        _last_edit_hash.pop(key, None)
+        _dead_edit_keys.discard(key)
+
+
+def coalesced_edit(chat_id, message_id, text, reply_markup=None, parse_mode=None, min_interval=EDIT_MIN_INTERVAL, on_error=None):
+    """
+    Queues an edit_message_text for (chat_id, message_id) and returns immediately.
+    Returns False if the message is known to be un-editable, True otherwise.
+    on_error(exception) is called from the flush if Telegram rejects the edit.
+    """
+    key = (chat_id, message_id)
+    content_hash = _edit_content_hash(text, reply_markup, parse_mode)
+
+    with edit_lock:
+        if key in _dead_edit_keys:
+            return False
+        # Same content as what is already on screen and nothing newer queued -> nothing to do
+        if content_hash == _last_edit_hash.get(key) and key not in _pending_edits:
+            return True
+
+        _pending_edits[key] = {
+            'text': text, 'reply_markup': reply_markup,
+            'parse_mode': parse_mode, 'hash': content_hash, 'on_error': on_error
+        }
+        if key in _edit_timers:
+            return True  # A flush is already scheduled; it will pick up this latest content
+
+        wait = max(0, _last_edit_time.get(key, 0) + min_interval - time.time())
+        timer = threading.Timer(wait, _flush_edit, args=[key])
+        timer.daemon = True
+        _edit_timers[key] = timer
+
+    timer.start()
+    return True
+
+
+def _flush_edit(key):
+    """Sends the latest pending edit for a message, if it still changes anything."""
+    with edit_lock:
+        _edit_timers.pop(key, None)
+        edit = _pending_edits.pop(key, None)
+        if not edit or edit['hash'] == _last_edit_hash.get(key):
+            return
+        _last_edit_time[key] = time.time()
+        if len(_last_edit_time) > 1000:
+            _prune_edit_state()
+
+    chat_id, message_id = key
+    try:
+        bot.edit_message_text(edit['text'], chat_id, message_id,
+                              reply_markup=edit['reply_markup'], parse_mode=edit['parse_mode'])
+        with edit_lock:
+            _last_edit_hash[key] = edit['hash']
+    except ApiTelegramException as e:
+        if "message is not modified" in e.description:
+            with edit_lock:
+                _last_edit_hash[key] = edit['hash']
+            return
+        if e.error_code == 429:
+            # Flood control: put the edit back (unless a newer one arrived) and retry later
+            retry_after = (e.result_json or {}).get('parameters', {}).get('retry_after', 5)
+            with edit_lock:
+                _pending_edits.setdefault(key, edit)
+                if key not in _edit_timers:
+                    timer = threading.Timer(retry_after, _flush_edit, args=[key])
+                    timer.daemon = True
+                    _edit_timers[key] = timer
+                    timer.start()
+            return
+        if any(reason in e.description for reason in EDIT_DEAD_ERRORS):
+            print(f"⚠️ Coalesced edit failed for {key}, giving up on this message. Error: {e.description}")
+            with edit_lock:
+                _dead_edit_keys.add(key)
+                _pending_edits.pop(key, None)
+            return
+        # Anything else (bad HTML, a transient API error...) only loses this edit
+        print(f"⚠️ Coalesced edit failed for {key}: {e.description}")
+        if edit['on_error']:
+            edit['on_error'](e)
+    except Exception as e:
+        print(f"⚠️ Coalesced edit failed for {key}: {e}")
+        if edit['on_error']:
+            edit['on_error'](e)
+
 
 # NEW: Live Countdown Helper (More Efficient Version, now using SAFE HTML)
 def live_countdown(chat_id, message_id, duration_seconds):
@@ -357,17 +1751,10 @@ def live_countdown(chat_id, message_id, duration_seconds):
                     # THE FIX: Converted from Markdown to safe HTML
                     text = "⏰ <b>Time's up! The quiz is starting now!</b> 🔥"
 
-                try:
-                    # THE FIX: Using parse_mode="HTML"
-                    bot.edit_message_text(text,
-                                          chat_id,
-                                          message_id,
-                                          parse_mode="HTML")
-                except Exception as edit_error:
-                    print(
-                        f"Could not edit message for countdown, it might be deleted. Error: {edit_error}"
-                    )
-                    break 
+                # Edits go through the coalescer so a slow Telegram never stacks them up
+                if not coalesced_edit(chat_id, message_id, text, parse_mode="HTML"):
+                    print(f"Could not edit message {message_id} for countdown, it might be deleted.")
+                    break
 
             time.sleep(1)
 
@@ -389,8 +1776,7 @@ def permission_required(command_name: str):
             
             # Check for specific permission in the database
             try:
-                res = supabase.rpc('check_user_permission', {'p_user_id': user_id, 'p_command_name': command_name}).execute()
-                if res.data:
+                if check_user_permission(user_id, command_name):
                     return func(msg, *args, **kwargs)
             except Exception as e:
                 print(f"Error checking permission for {user_id} on '{command_name}': {e}")
@@ -433,18 +1819,148 @@ def is_bot_mentioned(message):
     if not message.text:
         return False
     return f'@{BOT_USERNAME.lower()}' in message.text.lower()
+# --- In-Memory Member Directory ---
+# track_users and membership_required see every active member's ID, username
+# and name anyway, so they keep this directory current. Username lookups for
+# /dm, /promote, /viewperms etc. and mention rendering are then served
+# locally, with group_members queried only on a miss. Local matches are
+# case-insensitive, as Telegram's are. When someone renames, their old
+# username stops resolving to them.
+member_directory = {'by_id': {}, 'by_username': {}}  # user_id -> member dict; lowercased username -> user_id
+member_directory_lock = threading.Lock()
+MEMBER_FIELDS = 'user_id, username, first_name, last_name'
+
+
+def _directory_put(member):
+    """Caller holds member_directory_lock. Returns True if anything changed."""
+    user_id = member['user_id']
+    old = member_directory['by_id'].get(user_id)
+    if old == member:
+        return False
+    if old and old.get('username') and member_directory['by_username'].get(old['username'].lower()) == user_id:
+        del member_directory['by_username'][old['username'].lower()]
+    if member.get('username'):
+        # Usernames can move between accounts; the latest owner wins
+        previous_owner = member_directory['by_username'].get(member['username'].lower())
+        if previous_owner is not None and previous_owner != user_id and previous_owner in member_directory['by_id']:
+            member_directory['by_id'][previous_owner] = dict(member_directory['by_id'][previous_owner], username=None)
+        member_directory['by_username'][member['username'].lower()] = user_id
+    member_directory['by_id'][user_id] = member
+    return True
+
+
+def _member_from_user(user):
+    return {'user_id': user.id, 'username': user.username, 'first_name': user.first_name, 'last_name': user.last_name}
+
+
+def remember_member(user):
+    """Records a Telegram user whose group_members row was just written. Returns True if anything changed."""
+    with member_directory_lock:
+        return _directory_put(_member_from_user(user))
+
+
+def sync_group_member(user):
+    """
+    Calls upsert_group_member when the directory doesn't already have this user's
+    current details. The directory is only updated once the write succeeded, so a
+    failed write is retried on the user's next update.
+    """
+    member = _member_from_user(user)
+    with member_directory_lock:
+        if member_directory['by_id'].get(user.id) == member:
+            return
+    supabase.rpc('upsert_group_member', {
+        'p_user_id': user.id,
+        'p_username': user.username,
+        'p_first_name': user.first_name,
+        'p_last_name': user.last_name
+    }).execute()
+    with member_directory_lock:
+        _directory_put(member)
+
+
+def forget_members(user_ids):
+    with member_directory_lock:
+        for user_id in user_ids:
+            member = member_directory['by_id'].pop(user_id, None)
+            if member and member.get('username') and member_directory['by_username'].get(member['username'].lower()) == user_id:
+                del member_directory['by_username'][member['username'].lower()]
+
+
+def load_member_directory():
+    """Warms the directory from group_members."""
+    try:
+        members = list(scan_table('group_members', MEMBER_FIELDS, key='user_id'))
+        with member_directory_lock:
+            for member in members:
+                # Don't let older database rows overwrite details seen live since startup
+                if member['user_id'] not in member_directory['by_id']:
+                    _directory_put(member)
+        print(f"✅ Member directory loaded ({len(members)} members).")
+    except Exception as e:
+        print(f"❌ Could not load member directory: {e}")
+
+
+def lookup_member(user_id):
+    """Member dict for a user ID, from the directory or (on a miss) group_members. None if unknown."""
+    with member_directory_lock:
+        member = member_directory['by_id'].get(user_id)
+    if member:
+        return member
+    rows = supabase.table('group_members').select(MEMBER_FIELDS).eq('user_id', user_id).limit(1).execute().data
+    if not rows:
+        return None
+    with member_directory_lock:
+        _directory_put(rows[0])
+    return rows[0]
+
+
+def lookup_member_by_username(username):
+    """Member dict for '@name' or 'name', from the directory or (on a miss) group_members. None if unknown."""
+    username = username.strip().lstrip('@')
+    with member_directory_lock:
+        user_id = member_directory['by_username'].get(username.lower())
+        member = member_directory['by_id'].get(user_id) if user_id is not None else None
+    if member:
+        return member
+    rows = supabase.table('group_members').select(MEMBER_FIELDS).eq('username', username).limit(1).execute().data
+    if not rows:
+        return None
+    with member_directory_lock:
+        _directory_put(rows[0])
+    return rows[0]
+
+
+def member_display_name(user):
+    """Current username (or first name) for a report row, falling back to the name stored in the row."""
+    with member_directory_lock:
+        member = member_directory['by_id'].get(user.get('user_id'))
+    if member:
+        return member.get('username') or member.get('first_name') or 'Unknown'
+    return user.get('user_name') or user.get('first_name') or 'Unknown'
+
+
+def member_mention(user):
+    """'@username' for a report row (user_id, user_name[, first_name]), using the member's current username if known."""
+    with member_directory_lock:
+        member = member_directory['by_id'].get(user.get('user_id'))
+    if member:
+        return f"@{escape(member['username'])}" if member.get('username') else escape(member.get('first_name') or 'Unknown User')
+    if user.get('user_name'):
+        return f"@{escape(user['user_name'])}"
+    return escape(user.get('first_name', 'Unknown User'))
+
+
 # This is the new helper function
 def get_user_by_username(username_str: str):
     """
-    Finds a user in the group_members table by their username.
+    Finds a user by their username (member directory first, then group_members).
     Returns the user data dictionary if found, otherwise None.
     """
     try:
-        username_to_find = username_str.lstrip('@')
-        response = supabase.table('group_members').select('user_id, first_name').eq('username', username_to_find).single().execute()
-        return response.data
+        return lookup_member_by_username(username_str)
     except Exception as e:
-        print(f"Error looking up user @{username_to_find}: {e}")
+        print(f"Error looking up user {username_str}: {e}")
         return None
 def safe_reply(message: types.Message, text: str, **kwargs):
     """
@@ -525,13 +2041,9 @@ def membership_required(func):
             return
 
         # --- NEW FIX: Always update/save user info after a successful membership check ---
+        # (only when the directory shows it changed since we last saw this user)
         try:
-            supabase.rpc('upsert_group_member', {
-                'p_user_id': user.id,
-                'p_username': user.username,
-                'p_first_name': user.first_name,
-                'p_last_name': user.last_name
-            }).execute()
+            sync_group_member(user)
         except Exception as e:
             print(f"[User Sync in Decorator Error]: Could not upsert user {user.id}. Reason: {e}")
         # --- End of New Fix ---
@@ -553,6 +2065,550 @@ def membership_required(func):
                     return
     return wrapper
 
+# =============================================================================
+# 5. HELPER FUNCTIONS (Continued) - IN-MEMORY RESOURCE CATALOG
+# =============================================================================
+# The Vault (/listfile), /allfiles and every getfile_ button used to hit the
+# 'resources' table (a count + a page per tap). The table is small and only
+# grows through /add_resource, so we keep slim rows in memory, pre-sorted per
+# (group, subject, resource_type, podcast_format) bucket. '*' in a key means
+# "any", matching how the Vault skips a filter when group is "None".
+RESOURCE_CATALOG_FIELDS = 'id, file_id, file_name, file_type, group_name, subject, resource_type, keywords, description, podcast_format, created_at'
+resource_catalog = {
+    'by_id': {},        # id -> slim row
+    'by_bucket': {},    # (group, subject, resource_type, podcast_format) -> rows sorted by file_name
+    'newest_first': [], # all rows, newest first (for /allfiles)
+    'loaded': False
+}
+catalog_lock = threading.RLock()
+
+
+def _catalog_bucket_keys(row):
+    """Returns every bucket a resource row belongs to."""
+    group, subject = row.get('group_name'), row.get('subject')
+    keys = [(group, subject, row.get('resource_type'), '*'), ('*', subject, row.get('resource_type'), '*')]
+    if row.get('podcast_format'):
+        keys += [(group, subject, '*', row['podcast_format']), ('*', subject, '*', row['podcast_format'])]
+    return keys
+
+
+def _catalog_sort_key(row):
+    return (row.get('file_name') or '', row.get('id') or 0)
+
+
+def _catalog_add(row):
+    """Adds a single row to every index. Call with catalog_lock held."""
+    resource_catalog['by_id'][row['id']] = row
+    for key in _catalog_bucket_keys(row):
+        bisect.insort(resource_catalog['by_bucket'].setdefault(key, []), row, key=_catalog_sort_key)
+
+
+def load_resource_catalog():
+    """(Re)builds the whole catalog from Supabase, page by page."""
+    try:
+        rows = list(scan_table('resources', RESOURCE_CATALOG_FIELDS))
+    except Exception as e:
+        print(f"❌ Could not load resource catalog: {e}")
+        return False
+
+    with catalog_lock:
+        resource_catalog['by_id'] = {}
+        resource_catalog['by_bucket'] = {}
+        for row in rows:
+            _catalog_add(row)
+        resource_catalog['newest_first'] = sorted(rows, key=lambda r: (r.get('created_at') or '', r['id']), reverse=True)
+        build_resource_search_index(rows)
+        resource_catalog['loaded'] = True
+    print(f"✅ Resource catalog loaded with {len(rows)} files.")
+    return True
+
+
+def _ensure_resource_catalog():
+    """Lazily loads the catalog the first time it is needed."""
+    if not resource_catalog['loaded']:
+        load_resource_catalog()
+    return resource_catalog['loaded']
+
+
+def catalog_add_resource(row):
+    """Incrementally indexes a freshly inserted resource row."""
+    if not row or 'id' not in row:
+        return
+    with catalog_lock:
+        if not resource_catalog['loaded'] or row['id'] in resource_catalog['by_id']:
+            return
+        _catalog_add(row)
+        _search_index_add(row)
+        resource_catalog['newest_first'].insert(0, row)
+
+
+def catalog_get_resource(resource_id):
+    """Returns the slim row for a resource id, falling back to Supabase on a miss."""
+    if _ensure_resource_catalog():
+        row = resource_catalog['by_id'].get(resource_id)
+        if row:
+            return row
+    response = supabase.table('resources').select(RESOURCE_CATALOG_FIELDS).eq('id', resource_id).limit(1).execute()
+    if not response.data:
+        return None
+    catalog_add_resource(response.data[0])
+    return response.data[0]
+
+
+def catalog_page(group, subject, resource_type, page=1, podcast_format=None):
+    """
+    Returns (total_files, rows_on_page) for a Vault category, or None if the
+    catalog could not be loaded.
+    """
+    if not _ensure_resource_catalog():
+        return None
+    group_key = group if group and group != "None" else '*'
+    if podcast_format:
+        key = (group_key, subject, '*', podcast_format)
+    else:
+        key = (group_key, subject, resource_type, '*')
+    offset = (page - 1) * FILES_PER_PAGE
+    with catalog_lock:
+        bucket = resource_catalog['by_bucket'].get(key, [])
+        return len(bucket), bucket[offset:offset + FILES_PER_PAGE]
+
+
+def catalog_newest_page(page=1):
+    """Returns (total_files, rows_on_page) for /allfiles, newest first, or None."""
+    if not _ensure_resource_catalog():
+        return None
+    offset = (page - 1) * FILES_PER_PAGE
+    with catalog_lock:
+        rows = resource_catalog['newest_first']
+        return len(rows), rows[offset:offset + FILES_PER_PAGE]
+
+# =============================================================================
+# 5. HELPER FUNCTIONS (Continued) - LOCAL SEARCH INDEX FOR /need
+# =============================================================================
+# An inverted index over file_name, keywords and description of every catalog
+# row. Queries are ranked with BM25; unknown words fall back to prefix and
+# difflib fuzzy matches, so "/need gst rtp" or "/need audt" work without a
+# round trip to the smart_search RPC.
+SEARCH_MAX_RESULTS = 10
+SEARCH_FIELD_WEIGHTS = {'file_name': 3, 'keywords': 2, 'description': 1}
+SEARCH_BM25_K1 = 1.2
+SEARCH_BM25_B = 0.75
+SEARCH_STOPWORDS = {'a', 'an', 'the', 'of', 'and', 'for', 'in', 'on', 'to', 'with', 'by', 'is', 'me', 'pls', 'please', 'chahiye', 'ka', 'ki', 'ke'}
+# Multi-word CA phrases are collapsed into the abbreviation people usually type
+CA_PHRASE_SYNONYMS = {
+    'integrated goods and services tax': 'igst',
+    'goods and services tax': 'gst',
+    'goods & services tax': 'gst',
+    'input tax credit': 'itc',
+    'tax deducted at source': 'tds',
+    'tax collected at source': 'tcs',
+    'foreign exchange management act': 'fema',
+    'limited liability partnership': 'llp',
+    'general clauses act': 'gca',
+    'companies auditor report order': 'caro',
+    "companies (auditor's report) order": 'caro',
+    'standards on auditing': 'sa',
+    'standard on auditing': 'sa',
+    'accounting standards': 'accountingstandard',
+    'accounting standard': 'accountingstandard',
+    'ind as': 'indas',
+    'revision test papers': 'rtp',
+    'revision test paper': 'rtp',
+    'mock test papers': 'mtp',
+    'mock test paper': 'mtp',
+    'previous year questions': 'pyq',
+    'previous year question': 'pyq',
+    'past year papers': 'pyq',
+    'financial management': 'fm',
+    'strategic management': 'sm',
+    'income tax': 'incometax',
+    'direct tax': 'incometax',
+    'indirect tax': 'gst',
+    'cost and management accounting': 'costing',
+    'cost accounting': 'costing',
+    'advanced accounting': 'accounts',
+}
+# Single-word spellings that mean the same thing
+CA_WORD_SYNONYMS = {
+    'auditing': 'audit', 'audits': 'audit', 'accounting': 'accounts', 'accnt': 'accounts', 'accountancy': 'accounts',
+    'cost': 'costing', 'dt': 'incometax', 'idt': 'gst', 'laws': 'law',
+    'rtps': 'rtp', 'mtps': 'mtp', 'pyqs': 'pyq', 'qp': 'paper', 'papers': 'paper', 'notes': 'note',
+    'modules': 'module', 'podcasts': 'podcast', 'videos': 'video', 'chapters': 'chapter',
+}
+_CA_PHRASE_PATTERN = re.compile('|'.join(re.escape(p) for p in sorted(CA_PHRASE_SYNONYMS, key=len, reverse=True)))
+resource_search_index = {
+    'postings': defaultdict(dict),  # token -> {resource_id: weighted term frequency}
+    'doc_len': {},                  # resource_id -> weighted document length
+    'total_len': 0,
+    'vocab': [],                    # sorted list of tokens, for prefix search
+    'vocab_by_initial': defaultdict(set)  # first letter -> tokens, to keep difflib cheap
+}
+
+
+def search_tokenize(text):
+    """Lower-cases, collapses CA phrases into abbreviations and normalises synonyms."""
+    if not text:
+        return []
+    text = _CA_PHRASE_PATTERN.sub(lambda m: f" {CA_PHRASE_SYNONYMS[m.group(0)]} ", str(text).lower())
+    tokens = []
+    for word in re.findall(r"[a-z0-9]+", text):
+        if word in SEARCH_STOPWORDS:
+            continue
+        tokens.append(CA_WORD_SYNONYMS.get(word, word))
+    return tokens
+
+
+def _search_index_add(row):
+    """Adds one resource row to the inverted index. Call with catalog_lock held."""
+    index = resource_search_index
+    doc_id = row['id']
+    if doc_id in index['doc_len']:
+        return
+    keywords = row.get('keywords') or []
+    fields = {
+        'file_name': row.get('file_name'),
+        'keywords': ' '.join(keywords) if isinstance(keywords, list) else keywords,
+        'description': row.get('description'),
+    }
+    term_freqs = defaultdict(int)
+    for field, text in fields.items():
+        for token in search_tokenize(text):
+            term_freqs[token] += SEARCH_FIELD_WEIGHTS[field]
+
+    for token, tf in term_freqs.items():
+        if token not in index['postings']:
+            bisect.insort(index['vocab'], token)
+            index['vocab_by_initial'][token[0]].add(token)
+        index['postings'][token][doc_id] = tf
+    doc_len = sum(term_freqs.values())
+    index['doc_len'][doc_id] = doc_len
+    index['total_len'] += doc_len
+
+
+def build_resource_search_index(rows):
+    """Rebuilds the whole index from catalog rows. Call with catalog_lock held."""
+    resource_search_index['postings'] = defaultdict(dict)
+    resource_search_index['doc_len'] = {}
+    resource_search_index['total_len'] = 0
+    resource_search_index['vocab'] = []
+    resource_search_index['vocab_by_initial'] = defaultdict(set)
+    for row in rows:
+        _search_index_add(row)
+
+
+def _expand_query_token(token):
+    """
+    Returns [(index_token, weight)] for a query token: the exact token, tokens it
+    is a prefix of, and (only if nothing else matched) close fuzzy spellings.
+    """
+    index = resource_search_index
+    matches = []
+    if token in index['postings']:
+        matches.append((token, 1.0))
+    if len(token) >= 3:
+        vocab = index['vocab']
+        i = bisect.bisect_left(vocab, token)
+        while i < len(vocab) and vocab[i].startswith(token) and len(matches) < 20:
+            if vocab[i] != token:
+                matches.append((vocab[i], 0.6))
+            i += 1
+    if not matches and len(token) >= 4:
+        candidates = [t for t in index['vocab_by_initial'].get(token[0], ()) if abs(len(t) - len(token)) <= 2]
+        for close in difflib.get_close_matches(token, candidates, n=3, cutoff=0.75):
+            matches.append((close, 0.7))
+    return matches
+
+
+def search_resources(query, limit=SEARCH_MAX_RESULTS):
+    """
+    Ranks catalog rows against a free-text query with BM25.
+    Returns a list of rows (best first), or None if the index is unavailable.
+    """
+    if not _ensure_resource_catalog():
+        return None
+    query_tokens = list(dict.fromkeys(search_tokenize(query)))
+    if not query_tokens:
+        return []
+
+    with catalog_lock:
+        index = resource_search_index
+        total_docs = len(index['doc_len'])
+        if total_docs == 0:
+            return []
+        avg_len = index['total_len'] / total_docs
+        scores = defaultdict(float)
+        for query_token in query_tokens:
+            for token, weight in _expand_query_token(query_token):
+                postings = index['postings'][token]
+                idf = math.log(1 + (total_docs - len(postings) + 0.5) / (len(postings) + 0.5))
+                for doc_id, tf in postings.items():
+                    norm = SEARCH_BM25_K1 * (1 - SEARCH_BM25_B + SEARCH_BM25_B * index['doc_len'][doc_id] / avg_len)
+                    scores[doc_id] += weight * idf * tf * (SEARCH_BM25_K1 + 1) / (tf + norm)
+
+        ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:limit]
+        return [resource_catalog['by_id'][doc_id] for doc_id, _ in ranked if doc_id in resource_catalog['by_id']]
+
+# =============================================================================
+# 5. HELPER FUNCTIONS (Continued) - LAW LIBRARY SECTION INDEX
+# =============================================================================
+# The nine LAW_LIBRARIES tables are small and almost never change, so they are
+# loaded once into memory. Lookups use a normalised section number so that
+# "80C", "80 c", "Sec. 80C" and "section 80-C" all hit the same entry, and
+# random sampling for /testme and the daily Legal Bite is done locally.
+_SECTION_PREFIX_PATTERN = re.compile(r'^(?:section|sec|rule|form|standard|std|no|number|sa|as|s)\b\.?\s*|^(?:sa|as|s)(?=\d)')
+law_section_index = {}  # table_name -> {'rows': [...], 'by_key': {normalised: row}, 'loaded_at': ts}
+law_index_lock = threading.RLock()
+
+
+def normalize_section_number(value):
+    """Reduces a section/standard reference to a comparable key, e.g. 'Sec. 80 C' -> '80c', '2 (41)' -> '2(41)'."""
+    text = str(value or '').lower().strip()
+    stripped = _SECTION_PREFIX_PATTERN.sub('', text)
+    key = re.sub(r'[\s\-\._:]', '', stripped)
+    return key or re.sub(r'[\s\-\._:]', '', text)
+
+
+def load_law_library(table_name):
+    """(Re)loads one law library table into memory. Returns True on success."""
+    try:
+        rows = list(scan_table(table_name))
+    except Exception as e:
+        print(f"❌ Could not load law library '{table_name}': {e}")
+        return False
+
+    by_key = {}
+    for row in rows:
+        by_key.setdefault(normalize_section_number(row.get('section_number')), row)
+    with law_index_lock:
+        law_section_index[table_name] = {'rows': rows, 'by_key': by_key, 'loaded_at': time.time()}
+    return True
+
+
+def load_all_law_libraries():
+    """Loads every table in LAW_LIBRARIES into the section index."""
+    loaded = [lib['table'] for lib in LAW_LIBRARIES.values() if load_law_library(lib['table'])]
+    total = sum(len(law_section_index[t]['rows']) for t in loaded)
+    print(f"✅ Law section index loaded: {total} entries across {len(loaded)}/{len(LAW_LIBRARIES)} libraries.")
+
+
+def _get_law_library(table_name):
+    """Returns the in-memory library for a table, loading it on first use (or None)."""
+    library = law_section_index.get(table_name)
+    if library is None and load_law_library(table_name):
+        library = law_section_index.get(table_name)
+    return library
+
+
+def law_lookup(table_name, search_term):
+    """Finds a section by its normalised number. Falls back to Supabase if the table isn't loaded."""
+    library = _get_law_library(table_name)
+    if library is not None:
+        return library['by_key'].get(normalize_section_number(search_term))
+    response = supabase.table(table_name).select('*').ilike('section_number', search_term).limit(1).execute()
+    return response.data[0] if response.data else None
+
+
+def law_suggestions(table_name, search_term, limit=3):
+    """Returns section numbers that start with, or closely resemble, the search term."""
+    library = _get_law_library(table_name)
+    if not library:
+        return []
+    key = normalize_section_number(search_term)
+    if not key:
+        return []
+    keys = [k for k in library['by_key'] if k.startswith(key) and k != key][:limit]
+    if len(keys) < limit:
+        for close in difflib.get_close_matches(key, list(library['by_key'].keys()), n=limit, cutoff=0.6):
+            if close not in keys:
+                keys.append(close)
+    return [library['by_key'][k].get('section_number') for k in keys[:limit]]
+
+
+def law_library_size(table_name):
+    """Number of entries in a law library (Supabase count if it isn't loaded)."""
+    library = _get_law_library(table_name)
+    if library is not None:
+        return len(library['rows'])
+    return supabase.table(table_name).select('id', count='exact').execute().count or 0
+
+
+def law_random_entries(table_name, count=4):
+    """Returns `count` distinct random entries, like the get_random_law_entries RPC."""
+    library = _get_law_library(table_name)
+    if library is None:
+        return supabase.rpc('get_random_law_entries', {'table_name_input': table_name}).execute().data or []
+    rows = library['rows']
+    return random.sample(rows, min(count, len(rows)))
+
+
+def build_law_quiz_questions(table_name, num_questions):
+    """
+    Generates a whole /testme session up front from the section index.
+    Answers are sampled without replacement and distractors never repeat the
+    answer or each other. Returns ready-to-send poll payloads ([] if the
+    library can't be loaded).
+    """
+    library = _get_law_library(table_name)
+    if not library:
+        return []
+    # One entry per normalised section number, so "80C" and "80 C" can't both appear as options
+    unique_entries = [row for row in library['by_key'].values() if row.get('section_number') and row.get('summary')]
+    if len(unique_entries) < 4:
+        return []
+
+    answers = random.sample(unique_entries, min(num_questions, len(unique_entries)))
+    total = len(answers)
+    questions = []
+    for position, correct_entry in enumerate(answers):
+        distractors = random.sample([row for row in unique_entries if row is not correct_entry], 3)
+        options = [str(row['section_number']) for row in distractors] + [str(correct_entry['section_number'])]
+        random.shuffle(options)
+        questions.append({
+            'question': f"**Q{position + 1}/{total}:** Which section/standard relates to this summary?\n\n<blockquote>{escape(correct_entry['summary'])}</blockquote>",
+            'options': options,
+            'correct_option_index': options.index(str(correct_entry['section_number'])),
+            'correct_section': correct_entry['section_number'],
+            'explanation': f"Correct Answer: {correct_entry['section_number']}\nTitle: {correct_entry.get('title', '')}"
+        })
+    return questions
+
+# =============================================================================
+# 5. HELPER FUNCTIONS (Continued) - QUESTION DECKS
+# =============================================================================
+# /randomquiz, /randomquizvisual and the auto quiz draw from pre-shuffled decks
+# of unused questions instead of an ORDER BY random() RPC per post. Rows are
+# validated when the deck is loaded, handed out in O(1), and the 'used' flags
+# are written back in batches by flush_used_questions().
+QUESTION_DECK_COLUMNS = ('id', 'question_text', 'options', 'correct_index', 'explanation', 'category', 'image_file_id')
+QUESTION_DECK_REFILL_THRESHOLD = 5
+QUESTION_DECK_EMPTY_RELOAD_INTERVAL = 10 * 60  # An empty deck re-checks the table at most this often
+USED_FLUSH_THRESHOLD = 20
+question_decks = {'random': deque(), 'visual': deque(), 'loaded': False, 'refilling': False,
+                  'loaded_at': 0, 'loaded_sizes': {'random': 0, 'visual': 0}}
+_deck_issued_ids = set()     # handed out but still used=False in the table; never dealt again
+_pending_used_ids = set()    # waiting to be written back as used=True
+deck_lock = threading.RLock()
+
+
+def is_valid_quiz_row(row, require_image=False):
+    """Same integrity check the quiz handlers used to run after every RPC."""
+    options = row.get('options')
+    valid = bool(row.get('question_text')) and isinstance(options, list) and len(options) == 4 and row.get('correct_index') is not None
+    return valid and (bool(row.get('image_file_id')) or not require_image)
+
+
+def load_question_decks():
+    """Loads all unused questions, drops malformed ones, and shuffles them into the decks."""
+    flush_used_questions()
+    try:
+        rows = list(scan_table('questions', ', '.join(QUESTION_DECK_COLUMNS), where=lambda q: q.eq('used', False)))
+    except Exception as e:
+        print(f"❌ Could not load question decks: {e}")
+        with deck_lock:
+            question_decks['refilling'] = False
+        return False
+
+    valid = [row for row in rows if is_valid_quiz_row(row)]
+    malformed_ids = [row.get('id') for row in rows if not is_valid_quiz_row(row)]
+    random.shuffle(valid)
+    visual = [row for row in valid if row.get('image_file_id')]
+    random.shuffle(visual)
+
+    with deck_lock:
+        question_decks['random'] = deque(row for row in valid if row.get('id') not in _deck_issued_ids)
+        question_decks['visual'] = deque(row for row in visual if row.get('id') not in _deck_issued_ids)
+        question_decks['loaded'] = True
+        question_decks['refilling'] = False
+        question_decks['loaded_at'] = time.time()
+        question_decks['loaded_sizes'] = {'random': len(question_decks['random']), 'visual': len(question_decks['visual'])}
+        # Issued ids the table no longer lists as unused are safely written; the rest
+        # (flush failed or still pending) must stay excluded from future loads too
+        _deck_issued_ids.intersection_update(row.get('id') for row in rows)
+
+    if malformed_ids:
+        report_error_to_admin(f"Question deck: {len(malformed_ids)} malformed question(s) marked as used and skipped: {malformed_ids[:50]}")
+        for question_id in malformed_ids:
+            mark_question_used(question_id)
+    print(f"✅ Question decks loaded: {len(question_decks['random'])} random, {len(question_decks['visual'])} visual.")
+    return True
+
+
+def _refill_question_decks_async():
+    """Starts a background reload unless one is already running."""
+    with deck_lock:
+        if question_decks['refilling']:
+            return
+        question_decks['refilling'] = True
+    threading.Thread(target=load_question_decks, daemon=True).start()
+
+
+def deck_next(deck_name='random'):
+    """Pops the next question from a deck ('random' or 'visual'), or None if it is empty."""
+    if not question_decks['loaded']:
+        load_question_decks()
+    row = None
+    with deck_lock:
+        deck = question_decks[deck_name]
+        while deck:
+            candidate = deck.popleft()
+            if candidate.get('id') not in _deck_issued_ids:
+                row = candidate
+                break
+        if row is not None:
+            _deck_issued_ids.add(row.get('id'))
+        # Refill when the deck has drained below the threshold since it was loaded. A deck
+        # that was already small (few image questions) only re-checks the table once it is
+        # empty, and then no more often than QUESTION_DECK_EMPTY_RELOAD_INTERVAL.
+        if question_decks['loaded_sizes'][deck_name] >= QUESTION_DECK_REFILL_THRESHOLD:
+            running_low = len(deck) < QUESTION_DECK_REFILL_THRESHOLD
+        else:
+            running_low = not deck and time.time() - question_decks['loaded_at'] > QUESTION_DECK_EMPTY_RELOAD_INTERVAL
+    if running_low:
+        _refill_question_decks_async()
+    return row
+
+
+def deck_update_question(row):
+    """Keeps deck copies in sync after a question is edited (e.g. an image is attached)."""
+    if not row or row.get('id') is None:
+        return
+    with deck_lock:
+        for deck_name in ('random', 'visual'):
+            for cached in question_decks[deck_name]:
+                if cached.get('id') == row['id']:
+                    cached.update({k: v for k, v in row.items() if k in QUESTION_DECK_COLUMNS})
+        if row.get('image_file_id') and not any(q.get('id') == row['id'] for q in question_decks['visual']):
+            cached = next((q for q in question_decks['random'] if q.get('id') == row['id']), None)
+            if cached:
+                question_decks['visual'].insert(random.randint(0, len(question_decks['visual'])), cached)
+
+
+def mark_question_used(question_id):
+    """Queues a question to be flagged used=True; flushed in batches."""
+    if question_id is None:
+        return
+    with deck_lock:
+        _pending_used_ids.add(question_id)
+        should_flush = len(_pending_used_ids) >= USED_FLUSH_THRESHOLD
+    if should_flush:
+        threading.Thread(target=flush_used_questions, daemon=True).start()
+
+
+def flush_used_questions():
+    """Writes all queued 'used' flags in a single UPDATE ... WHERE id IN (...)."""
+    with deck_lock:
+        if not _pending_used_ids:
+            return
+        ids = list(_pending_used_ids)
+        _pending_used_ids.clear()
+    try:
+        supabase.table('questions').update({'used': True}).in_('id', ids).execute()
+        print(f"✅ Marked {len(ids)} question(s) as used.")
+    except Exception as e:
+        print(f"⚠️ Could not flush used questions, will retry: {e}")
+        with deck_lock:
+            _pending_used_ids.update(ids)
+
 # =============================================================================
 # 5. HELPER FUNCTIONS (Continued) - NEW ADVANCED VAULT BROWSER
 # =============================================================================
@@ -568,37 +2624,37 @@ def create_compact_file_list_page(group, subject, resource_type, page=1, podcast
     """
     try:
         offset = (page - 1) * FILES_PER_PAGE
+        header_title = f"Podcasts - {podcast_format.capitalize()}" if podcast_format else resource_type
 
-        # Build the query dynamically
-        count_query = supabase.table('resources').select('id', count='exact').eq('subject', subject)
-        files_query = supabase.table('resources').select('*').eq('subject', subject)
-
-        # Only filter by group_name if it's not "None"
-        if group and group != "None":
-            count_query = count_query.eq('group_name', group)
-            files_query = files_query.eq('group_name', group)
-
-        header_title = resource_type # Default title
-
-        if podcast_format:
-            # If we are looking for podcasts, filter by the new column
-            count_query = count_query.eq('podcast_format', podcast_format)
-            files_query = files_query.eq('podcast_format', podcast_format)
-            header_title = f"Podcasts - {podcast_format.capitalize()}"
+        # Served from the in-memory catalog; the database is only a fallback
+        catalog_result = catalog_page(group, subject, resource_type, page=page, podcast_format=podcast_format)
+        if catalog_result is not None:
+            total_files, files_on_page = catalog_result
         else:
-            # Otherwise, filter by the old resource_type column
-            count_query = count_query.eq('resource_type', resource_type)
-            files_query = files_query.eq('resource_type', resource_type)
+            # Build the query dynamically
+            count_query = supabase.table('resources').select('id', count='exact').eq('subject', subject)
+            files_query = supabase.table('resources').select('*').eq('subject', subject)
+
+            # Only filter by group_name if it's not "None"
+            if group and group != "None":
+                count_query = count_query.eq('group_name', group)
+                files_query = files_query.eq('group_name', group)
+
+            if podcast_format:
+                # If we are looking for podcasts, filter by the new column
+                count_query = count_query.eq('podcast_format', podcast_format)
+                files_query = files_query.eq('podcast_format', podcast_format)
+            else:
+                # Otherwise, filter by the old resource_type column
+                count_query = count_query.eq('resource_type', resource_type)
+                files_query = files_query.eq('resource_type', resource_type)
 
-        count_res = count_query.execute()
-        total_files = count_res.count
+            total_files = count_query.execute().count
+            files_on_page = files_query.order('file_name').range(offset, offset + FILES_PER_PAGE - 1).execute().data if total_files else []
 
         if total_files == 0:
             return "📂 This category is currently empty. Check back later!", None
 
-        files_res = files_query.order('file_name').range(offset, offset + FILES_PER_PAGE - 1).execute()
-        files_on_page = files_res.data
-
         total_pages = (total_files + FILES_PER_PAGE - 1) // FILES_PER_PAGE
 
         # We keep the header emoji for a nice title
@@ -653,7 +2709,7 @@ def create_compact_file_list_page(group, subject, resource_type, page=1, podcast
     except Exception as e:
         report_error_to_admin(f"Error in create_compact_file_list_page: {traceback.format_exc()}")
         return "❌ An error occurred while fetching files.", None
-@bot.callback_query_handler(func=lambda call: call.data.startswith('v_'))
+@bot.callback_query_handler(func=callback_data_filter('v_'))
 def handle_vault_callbacks(call: types.CallbackQuery):
     """
     Master handler for all vault navigation with proactive error prevention.
@@ -667,12 +2723,9 @@ def handle_vault_callbacks(call: types.CallbackQuery):
     action = action_full.replace('v_', '') # Gets the 'subj', 'type', 'page' part
     
     def edit_if_changed(new_text, new_markup):
-        if call.message.text != new_text or call.message.reply_markup != new_markup:
-            try:
-                bot.edit_message_text(new_text, call.message.chat.id, call.message.message_id, reply_markup=new_markup, parse_mode="HTML")
-            except ApiTelegramException as e:
-                if "message is not modified" not in e.description:
-                    raise e
+        # The coalescer drops no-op edits by content hash and merges rapid taps
+        coalesced_edit(call.message.chat.id, call.message.message_id, new_text, reply_markup=new_markup, parse_mode="HTML",
+                       on_error=lambda e: report_error_to_admin(f"Error in vault navigation (edit rejected): {e}"))
 
     try:
         if action == 'main':
@@ -805,15 +2858,16 @@ def create_file_id_list_page(page=1):
     try:
         offset = (page - 1) * FILES_PER_PAGE
 
-        count_res = supabase.table('resources').select('id', count='exact').execute()
-        total_files = count_res.count
+        catalog_result = catalog_newest_page(page=page)
+        if catalog_result is not None:
+            total_files, files_on_page = catalog_result
+        else:
+            total_files = supabase.table('resources').select('id', count='exact').execute().count
+            # Fetch id as well for the callback
+            files_on_page = supabase.table('resources').select('id, file_name, file_id').order('created_at', desc=True).range(offset, offset + FILES_PER_PAGE - 1).execute().data if total_files else []
 
         if total_files == 0:
             return "📂 The 'resources' table is currently empty.", None
-
-        # Fetch id as well for the callback
-        files_res = supabase.table('resources').select('id, file_name, file_id').order('created_at', desc=True).range(offset, offset + FILES_PER_PAGE - 1).execute()
-        files_on_page = files_res.data
         total_pages = (total_files + FILES_PER_PAGE - 1) // FILES_PER_PAGE
 
         message_text = f"🗂️ <b>Master File List</b>\n"
@@ -855,7 +2909,7 @@ def create_file_id_list_page(page=1):
     except Exception as e:
         report_error_to_admin(f"Error in create_file_id_list_page: {traceback.format_exc()}")
         return "❌ An error occurred while fetching files.", None
-@bot.callback_query_handler(func=lambda call: call.data.startswith('fid_'))
+@bot.callback_query_handler(func=callback_data_filter('fid_'))
 def handle_file_id_list_callbacks(call: types.CallbackQuery):
     """
     Handles pagination and file fetching for the /allfiles list.
@@ -890,17 +2944,17 @@ def handle_file_id_list_callbacks(call: types.CallbackQuery):
             resource_id = int(resource_id_str)
             bot.answer_callback_query(call.id, text="✅ Fetching file...")
 
-            # Fetch file details from Supabase
-            response = supabase.table('resources').select('file_id, file_name, description').eq('id', resource_id).single().execute()
+            # Fetch file details from the catalog (Supabase only on a miss)
+            resource = catalog_get_resource(resource_id)
 
-            if not response.data:
+            if not resource:
                 bot.answer_callback_query(call.id, text="❌ File not found.", show_alert=True)
                 bot.edit_message_text("❌ Sorry, this file seems to have been deleted.", call.message.chat.id, call.message.message_id, reply_markup=None)
                 return
 
-            file_id_to_send = response.data['file_id']
-            file_name_to_send = response.data['file_name']
-            description = response.data.get('description', file_name_to_send)
+            file_id_to_send = resource['file_id']
+            file_name_to_send = resource['file_name']
+            description = resource.get('description') or file_name_to_send
 
             # Generate caption and send document
             stylish_caption = create_stylish_caption(file_name_to_send, description)
@@ -1039,11 +3093,77 @@ def record_quiz_participation(user_id, user_name, score_achieved, time_taken_sec
         }).execute()
 
         print(f"✅ Successfully recorded participation for user {user_id} ({user_name}).")
+        mark_user_stats_stale(user_id)
+        invalidate_score_leaderboards()
 
     except Exception as e:
         print(f"❌ Error in record_quiz_participation for user {user_id}: {e}")
         report_error_to_admin(f"Failed to record participation for {user_id}:\n{traceback.format_exc()}")
 # =============================================================================
+# CACHED LEADERBOARDS
+# =============================================================================
+# /rankers, /alltimerankers and /topicrankers are served by the ranking RPCs,
+# which stay the only definition of how scores are aggregated. Their results
+# are held in the reference cache and dropped whenever the bot records a new
+# score, so repeated requests cost no database round trip. The rendered
+# message is cached per board by a hash of its rows, so an unchanged board
+# is not re-formatted either.
+LEADERBOARD_SIZE = 10
+LeaderboardResult = namedtuple('LeaderboardResult', ['data', 'version'])
+rendered_leaderboards = {}  # cache key -> (version, text)
+leaderboard_lock = threading.Lock()
+
+
+def _leaderboard_result(rows):
+    rows = rows or []
+    return LeaderboardResult(rows, hashlib.sha256(json.dumps(rows, sort_keys=True, default=str).encode()).hexdigest())
+
+
+def invalidate_score_leaderboards():
+    """Drops the cached weekly and all-time boards; called by record_quiz_participation once the score rows are written."""
+    invalidate_cache('rankers', 'weekly')
+    invalidate_cache('rankers', 'all_time')
+
+
+def record_topic_result(library_name):
+    """Called once /testme results for a library are saved to section_mastery."""
+    invalidate_cache('rankers', ('topic', library_name))
+
+
+def get_weekly_rankers():
+    """Rows of the get_weekly_rankers RPC (rank, user_name, total_score)."""
+    return _leaderboard_result(cached_read('rankers', 'weekly', lambda: supabase.rpc('get_weekly_rankers').execute().data))
+
+
+def get_all_time_rankers():
+    """Rows of the get_all_time_rankers RPC (rank, user_name, total_score)."""
+    return _leaderboard_result(cached_read('rankers', 'all_time', lambda: supabase.rpc('get_all_time_rankers').execute().data))
+
+
+def get_topic_rankers(library_name):
+    """Rows of the get_topic_leaderboard RPC (user_name, average_accuracy, quiz_count)."""
+    return _leaderboard_result(cached_read('rankers', ('topic', library_name), lambda: supabase.rpc('get_topic_leaderboard', {'p_library_name': library_name}).execute().data))
+
+
+def get_random_quiz_leaderboard():
+    """Top random-quiz scorers. That table is written outside the bot, so it is only cached."""
+    return _leaderboard_result(cached_read('leaderboard', 'top', lambda: supabase.table('leaderboard').select('user_name, score').order('score', desc=True).limit(LEADERBOARD_SIZE).execute().data))
+
+
+def render_leaderboard(cache_key, version, build_text):
+    """Returns the cached message for this board version, building it only when the data changed."""
+    if version is None:
+        return build_text()
+    with leaderboard_lock:
+        cached = rendered_leaderboards.get(cache_key)
+        if cached and cached[0] == version:
+            return cached[1]
+    text = build_text()
+    with leaderboard_lock:
+        rendered_leaderboards[cache_key] = (version, text)
+    return text
+
+# =============================================================================
 # 6. BACKGROUND SCHEDULER & DATA MANAGEMENT
 # =============================================================================
 
@@ -1051,6 +3171,48 @@ def record_quiz_participation(user_id, user_name, score_achieved, time_taken_sec
 last_daily_check_day = -1
 last_schedule_announce_day = -1
 
+# --- Activity Tracking ---
+# The warning, reminder, removal and appreciation lists and the activity
+# report are all decided by their RPCs, which stay the single definition of
+# those rules. Two things are done in process: chat activity is written
+# through to quiz_activity at most once per CHAT_ACTIVITY_WRITE_INTERVAL per
+# member (the RPCs work in whole days, so a few minutes of lag changes
+# nothing), and the report's RPC result is held in the reference cache so
+# opening it repeatedly does not rescan quiz_activity.
+CHAT_ACTIVITY_WRITE_INTERVAL = 15 * 60
+chat_activity_written = {}  # user_id -> time of the last update_chat_activity write
+chat_activity_lock = threading.Lock()
+
+
+def record_chat_activity(user_id, user_name):
+    """Chat event: calls update_chat_activity unless this member was written recently."""
+    now = time.time()
+    with chat_activity_lock:
+        if now - chat_activity_written.get(user_id, 0) < CHAT_ACTIVITY_WRITE_INTERVAL:
+            return
+        chat_activity_written[user_id] = now
+    try:
+        supabase.rpc('update_chat_activity', {'p_user_id': user_id, 'p_user_name': user_name}).execute()
+    except Exception:
+        # Let the next message retry the write
+        with chat_activity_lock:
+            chat_activity_written.pop(user_id, None)
+        raise
+
+
+def prune_chat_activity_writes():
+    """Drops throttle entries old enough that they no longer suppress a write."""
+    cutoff = time.time() - CHAT_ACTIVITY_WRITE_INTERVAL
+    with chat_activity_lock:
+        for user_id in [u for u, ts in chat_activity_written.items() if ts < cutoff]:
+            del chat_activity_written[user_id]
+
+
+def get_activity_segments():
+    """The get_activity_report RPC result: core_active, quiz_champions, silent_observers, at_risk, ghosts."""
+    return cached_read('activity_report', 'segments', lambda: supabase.rpc('get_activity_report').execute().data)
+
+
 # --- Data-Fetching Functions for Daily Checks ---
 
 def find_inactive_users():
@@ -1058,12 +3220,13 @@ def find_inactive_users():
     Finds users for all daily notifications: warnings, reminders, and removal notices.
     """
     print("Finding users for daily notifications...")
-    final_warning_users = supabase.rpc('get_users_for_final_warning').execute().data or []
-    first_warning_users = supabase.rpc('get_users_to_warn').execute().data or []
-    reminder_users = supabase.rpc('get_users_for_daily_reminder').execute().data or []
-    removal_users = supabase.rpc('get_users_for_removal_notice').execute().data or []
-    
-    return final_warning_users, first_warning_users, reminder_users, removal_users
+    rpc_names = ['get_users_for_final_warning', 'get_users_to_warn', 'get_users_for_daily_reminder', 'get_users_for_removal_notice']
+    results, errors = run_concurrently({name: (lambda name=name: supabase.rpc(name).execute().data or []) for name in rpc_names})
+    if errors:
+        # A failed list only skips that stage; the other notifications still go out
+        report_error_to_admin("find_inactive_users: " + "; ".join(f"{name} failed: {e}" for name, e in errors.items()))
+
+    return tuple(results.get(name, []) for name in rpc_names)
 
 def find_users_to_appreciate():
     """
@@ -1073,7 +3236,7 @@ def find_users_to_appreciate():
     print("Finding users to appreciate...")
     # This first part is a data operation, so it stays here.
     supabase.rpc('reset_missed_streaks').execute()
-    
+
     users_to_appreciate = supabase.rpc('get_users_to_appreciate', {'streak_target': APPRECIATION_STREAK}).execute().data or []
     return users_to_appreciate
 
@@ -1086,9 +3249,9 @@ def fetch_and_announce_schedule(target_date):
     """
     try:
         date_str = target_date.strftime('%Y-%m-%d')
-        response = supabase.table('quiz_schedule').select('*').eq('quiz_date', date_str).order('quiz_no').execute()
+        schedule_rows = sorted(get_quiz_schedule(date_str), key=lambda q: q.get('quiz_no') or 0)
 
-        if not response.data:
+        if not schedule_rows:
             print(f"No schedule found for {date_str} to announce.")
             return False
 
@@ -1099,7 +3262,7 @@ def fetch_and_announce_schedule(target_date):
         message_text = f"📢 <b>Schedule Update for Tomorrow!</b> 📢\n\n"
         message_text += f"Hello everyone,\nTomorrow's (<b>{escape(formatted_date)}</b>) quiz schedule has been updated. Here is the lineup to help you prepare in advance:\n\n"
         
-        for quiz in response.data:
+        for quiz in schedule_rows:
             try:
                 time_obj = datetime.datetime.strptime(quiz['quiz_time'], '%H:%M:%S')
                 formatted_time = time_obj.strftime('%I:%M %p')
@@ -1232,22 +3395,12 @@ def run_daily_checks():
 def cleanup_stale_user_states():
     """
     A janitor function that runs periodically to clean up abandoned user states.
-    It removes any state that is older than 1 hour (3600 seconds).
+    It removes any state that hasn't been written or routed to for USER_STATE_TTL.
     """
     try:
-        current_time = time.time()
-        stale_users = []
-        for user_id, state in user_states.items():
-            # We will add the 'timestamp' key in the next step.
-            # This check ensures it doesn't crash before we do.
-            if 'timestamp' in state:
-                if (current_time - state['timestamp']) > 3600: # 1 hour
-                    stale_users.append(user_id)
-        
-        if stale_users:
-            for user_id in stale_users:
-                del user_states[user_id]
-            print(f"🧹 Janitor cleaned up {len(stale_users)} stale user state(s).")
+        removed = user_states.sweep()
+        if removed:
+            print(f"🧹 Janitor cleaned up {removed} stale user state(s).")
 
     except Exception as e:
         print(f"Error during user state cleanup: {e}")
@@ -1429,9 +3582,11 @@ def handle_auto_quiz():
 
     print("🎲 Starting automatic random quiz job...")
     try:
-        response = supabase.rpc('get_random_quiz', {}).execute()
-        if response.data:
-            quiz_data = response.data[0]
+        quiz_data = deck_next('random')
+        if quiz_data is None:
+            response = supabase.rpc('get_random_quiz', {}).execute()
+            quiz_data = response.data[0] if response.data else None
+        if quiz_data:
             question_id = quiz_data.get('id')
             question_text = quiz_data.get('question_text')
             options_data = quiz_data.get('options')
@@ -1440,8 +3595,8 @@ def handle_auto_quiz():
             category = quiz_data.get('category', 'General Knowledge')
             image_file_id = quiz_data.get('image_file_id')
 
-            if not all([question_text, isinstance(options_data, list), len(options_data) == 4, correct_index is not None]):
-                supabase.table('questions').update({'used': True}).eq('id', question_id).execute()
+            if not is_valid_quiz_row(quiz_data):
+                mark_question_used(question_id)
                 return
 
             if image_file_id:
@@ -1465,7 +3620,7 @@ def handle_auto_quiz():
                 explanation_parse_mode="HTML"
             )
             active_polls.append({'poll_id': sent_poll.poll.id, 'correct_option_id': correct_index, 'type': 'random_quiz', 'question_id': question_id})
-            supabase.table('questions').update({'used': True}).eq('id', question_id).execute()
+            mark_question_used(question_id)
             last_auto_quiz_time = time.time()
             print(f"✅ Sent auto quiz QID: {question_id}")
     except Exception as e:
@@ -1481,18 +3636,14 @@ def handle_daily_content():
         if choice == 'law':
             lib_key = random.choice(list(LAW_LIBRARIES.keys()))
             library = LAW_LIBRARIES[lib_key]
-            response = supabase.rpc('get_random_law_entries', {'table_name_input': library['table']}).execute()
-            if response.data:
-                entry = response.data[0]
+            entries = law_random_entries(library['table'], count=1)
+            if entries:
+                entry = entries[0]
                 message_to_send = f"🏛️ <b>Daily Legal Bite!</b>\n📚 <b>{library['name']}</b>\n🔑 <b>{escape(entry.get('section_number'))}: {escape(entry.get('title'))}</b>\n<blockquote>{escape(entry.get('summary'))}</blockquote>"
         elif choice == 'definition':
-            workbook = get_gsheet()
-            if workbook:
-                sheet = workbook.worksheet('Glossary')
-                all_values = sheet.get_all_values()
-                if len(all_values) > 1:
-                    row = random.choice(all_values[1:])
-                    message_to_send = f"📖 <b>Term of the Day!</b>\n🔑 <b>{escape(row[1])}</b>\n📚 <i>{escape(row[3] if len(row)>3 else 'General')}</i>\n<blockquote>{escape(row[2])}</blockquote>"
+            entry = glossary_random_entry()
+            if entry:
+                message_to_send = f"📖 <b>Term of the Day!</b>\n🔑 <b>{escape(entry['term'])}</b>\n📚 <i>{escape(entry['category'])}</i>\n<blockquote>{escape(entry['definition'])}</blockquote>"
         if message_to_send:
             bot.send_message(GROUP_ID, message_to_send, parse_mode="HTML", message_thread_id=CHATTING_TOPIC_ID)
     except Exception as e: print(f"❌ Daily content failed: {e}")
@@ -1559,6 +3710,25 @@ def start_scheduler():
     # Save bot state to DB every 5 minutes (Replacing the old loop's save)
     scheduler.add_job(save_data, 'interval', minutes=5, id='save_state')
 
+    # Rebuild the in-memory Vault catalog every hour (catches edits made on the dashboard)
+    scheduler.add_job(load_resource_catalog, 'interval', minutes=60, id='resource_catalog_refresh')
+
+    # Keep the in-memory glossary in sync with manual edits to the Google Sheet
+    scheduler.add_job(load_glossary, 'interval', seconds=GLOSSARY_REFRESH_SECONDS, kwargs={'force': True}, id='glossary_refresh')
+
+    # Law libraries rarely change outside /addsection, so a nightly reload is enough
+    scheduler.add_job(load_all_law_libraries, 'cron', hour=4, minute=0, id='law_index_refresh')
+
+    # Write back 'used' flags for questions handed out from the quiz decks
+    scheduler.add_job(flush_used_questions, 'interval', minutes=1, id='used_questions_flush')
+
+    # Forget chat-activity throttle entries that have expired
+    scheduler.add_job(prune_chat_activity_writes, 'interval', minutes=30, id='chat_activity_prune')
+
+    # Reclaim conversations users walked away from
+    scheduler.add_job(cleanup_stale_user_states, 'interval', minutes=5, id='user_state_janitor')
+    scheduler.add_job(purge_expired_next_steps, 'interval', hours=1, id='next_step_janitor')
+
     scheduler.start()
     print("✅ APScheduler started successfully with ALL tasks (News, Content, Resources, Quizzes).")
 # =============================================================================
@@ -1570,7 +3740,12 @@ def get_message():
     """Webhook endpoint to receive updates from Telegram."""
     try:
         update = types.Update.de_json(request.get_data().decode('utf-8'))
-        bot.process_new_updates([update])
+        start_next_step_batch()
+        try:
+            restore_next_step_handler(update.message)
+            bot.process_new_updates([update])
+        finally:
+            flush_next_step_batch()
         return "!", 200
     except Exception as e:
         print(f"Webhook Error: {e}")
@@ -1582,6 +3757,128 @@ def health_check():
     """Health check endpoint for Render to monitor service status."""
     return "<h1>Telegram Bot is alive and running</h1>", 200
 
+# =============================================================================
+# 7.1. ANALYSIS WEB APP API (SIGNED TOKENS, PRECOMPRESSED JSON)
+# =============================================================================
+# /my_analysis gives the Web App a short signed token instead of the data
+# itself. The dashboard fetches /api/analysis/<token>, which serves the JSON
+# built from the materialised stats record, gzipped once, with an ETag so
+# reopening the dashboard usually ends in a 304.
+ANALYSIS_TOKEN_TTL = 24 * 60 * 60
+ANALYSIS_TOKEN_SECRET = (os.getenv('ANALYSIS_TOKEN_SECRET') or BOT_TOKEN or '').encode()
+ANALYSIS_CACHE_CONTROL = 'private, max-age=300'
+analysis_payload_cache = {}  # user_id -> {'version': ..., 'body', 'gzip', 'etag'}
+analysis_payload_lock = threading.Lock()
+
+
+def _b64url(raw):
+    return base64.urlsafe_b64encode(raw).rstrip(b'=').decode()
+
+
+def _b64url_decode(text):
+    return base64.urlsafe_b64decode(text + '=' * (-len(text) % 4))
+
+
+def sign_analysis_token(user_id, ttl=ANALYSIS_TOKEN_TTL):
+    """Returns a short URL-safe token '<user_id.expiry>.<hmac>' for the analysis dashboard."""
+    payload = f"{user_id}.{int(time.time()) + ttl}".encode()
+    signature = hmac.new(ANALYSIS_TOKEN_SECRET, payload, hashlib.sha256).digest()[:12]
+    return f"{_b64url(payload)}.{_b64url(signature)}"
+
+
+def verify_analysis_token(token):
+    """Returns the user_id of a valid, unexpired token, otherwise None."""
+    try:
+        payload_part, signature_part = token.split('.', 1)
+        payload = _b64url_decode(payload_part)
+        expected = hmac.new(ANALYSIS_TOKEN_SECRET, payload, hashlib.sha256).digest()[:12]
+        if not hmac.compare_digest(expected, _b64url_decode(signature_part)):
+            return None
+        user_id, expires_at = payload.decode().split('.')
+        return int(user_id) if int(expires_at) >= time.time() else None
+    except (ValueError, TypeError, UnicodeDecodeError, binascii.Error):
+        return None
+
+
+def build_precompressed_json(data):
+    """Serialises once and keeps both the plain and gzipped bodies plus a strong ETag."""
+    body = json.dumps(data, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+    return {'body': body, 'gzip': gzip.compress(body, compresslevel=6), 'etag': hashlib.sha256(body).hexdigest()[:32]}
+
+
+def serve_precompressed_json(entry, cache_control):
+    """Answers with gzip when accepted, and with 304 when the client already has this version."""
+    use_gzip = 'gzip' in request.accept_encodings
+    # Each encoding is a different representation, so it gets its own strong ETag
+    etag = entry['etag'] + ('-gz' if use_gzip else '')
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        response = Response(entry['gzip'] if use_gzip else entry['body'], mimetype='application/json')
+        if use_gzip:
+            response.headers['Content-Encoding'] = 'gzip'
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = cache_control
+    response.headers['Vary'] = 'Accept-Encoding'
+    return response
+
+
+def build_analysis_webapp_payload(record, user_name):
+    """Shapes a materialised analysis record into the JSON the dashboard (webapp/script.js) renders."""
+    analysis = record.get('analysis') or {}
+    topic_items = [{
+        'topic': t.get('topic') or 'Unknown Topic',
+        'question_type': '',
+        'correct_answers': t.get('total_correct', 0) or 0,
+        'total_questions': t.get('total_attempted', 0) or 0
+    } for t in analysis.get('marathon_topic_stats') or []]
+    payload = format_analysis_for_webapp(topic_items, user_name)
+
+    type_stats = [t for t in analysis.get('marathon_type_stats') or [] if t.get('total_attempted')]
+    if payload.get('isDataAvailable') and type_stats:
+        payload['charts']['doughnut'] = {
+            'labels': [t.get('question_type', 'N/A') for t in type_stats],
+            'data': [t.get('total_attempted', 0) for t in type_stats]
+        }
+    return payload
+
+
+def get_analysis_payload(user_id):
+    """Returns the precompressed dashboard JSON for a user, rebuilt only when their record changed."""
+    record = get_user_analysis_record(user_id)
+    user_name = record.get('user_name') or 'Champion'
+    version = (record.get('analysis_generation'), user_name)
+    with analysis_payload_lock:
+        entry = analysis_payload_cache.get(user_id)
+        if entry and entry['version'] == version:
+            return entry
+    entry = dict(build_precompressed_json(build_analysis_webapp_payload(record, user_name)), version=version)
+    with analysis_payload_lock:
+        analysis_payload_cache[user_id] = entry
+    return entry
+
+
+def build_analysis_webapp_url(user_id):
+    """Web App URL for the dashboard, carrying only the signed token (and the API origin)."""
+    url = f"{ANALYSIS_WEBAPP_URL.rstrip('/')}/?t={sign_analysis_token(user_id)}"
+    if SERVER_URL:
+        url += f"&api={quote(SERVER_URL.rstrip('/'), safe='')}"
+    return url
+
+
+@app.route('/api/analysis/<token>')
+def get_analysis_data(token):
+    """Serves a user's analysis dashboard JSON for a signed token."""
+    user_id = verify_analysis_token(token)
+    if user_id is None:
+        return json.dumps({'status': 'error', 'message': 'This link is invalid or has expired. Please run /my_analysis again.'}), 403
+    try:
+        return serve_precompressed_json(get_analysis_payload(user_id), ANALYSIS_CACHE_CONTROL)
+    except Exception as e:
+        print(f"API Error in /api/analysis for {user_id}: {e}")
+        report_error_to_admin(f"Error in /api/analysis for {user_id}:\n{traceback.format_exc()}")
+        return json.dumps({'status': 'error', 'message': 'Could not load analysis.'}), 500
+
 # =============================================================================
 # 8. TELEGRAM BOT HANDLERS - VAULT UPLOAD FLOW (/add_resource)
 # =============================================================================
@@ -1611,55 +3908,126 @@ def check_uploader_role(user_id):
     except Exception as e:
         print(f"Error checking user role for {user_id}: {e}")
     return False
-@app.route('/api/save_result', methods=['POST'])
-def save_quiz_result():
-    """
-    API endpoint for the Web App to securely save a user's quiz result.
-    """
-    try:
-        data = request.json
-        # Basic validation
-        if not all(k in data for k in ['userId', 'userName', 'scorePercentage', 'correctAnswers', 'totalQuestions', 'quizSet']):
-            return json.dumps({'status': 'error', 'message': 'Missing required data fields.'}), 400
-
-        # --- SAVE TO SUPABASE ---
-        response = supabase.table('web_quiz_results').insert({
-            'user_id': data['userId'],
-            'user_name': data['userName'],
-            'quiz_set': data['quizSet'],
-            'score_percentage': data['scorePercentage'],
-            'correct_answers': data['correctAnswers'],
-            'total_questions': data['totalQuestions'],
-            'time_taken_seconds': data.get('timeTakenSeconds', 0),
-            'strongest_topic': data.get('strongestTopic', 'N/A'),
-            'weakest_topic': data.get('weakestTopic', 'N/A')
-        }).execute()
-        
-        new_result_id = response.data[0]['id']
-        print(f"API: Successfully saved web quiz result (ID: {new_result_id}) for {data['userName']}.")
-# --- NEW: Call central tracking function ---
+# =============================================================================
+# 7.2. WEB QUIZ RESULT INGESTION
+# =============================================================================
+# /api/save_result validates and inserts the result, then answers. The slow
+# side effects (participation tracking, the admin DM, the group post) run in
+# the background after the row exists. A client that sends an Idempotency-Key
+# header (or an idempotencyKey field) gets each side effect at most once per
+# key, so its retries don't create duplicate rows. Requests without a key are
+# never deduplicated: two identical results are two genuine attempts.
+WEB_RESULT_KEY_TTL = 24 * 60 * 60
+WEB_RESULT_MAX_KEYS = 5000
+WEB_RESULT_REQUIRED_FIELDS = ['userId', 'userName', 'scorePercentage', 'correctAnswers', 'totalQuestions', 'quizSet']
+web_result_keys = OrderedDict()  # idempotency key -> {'result_id', 'effects': set(), 'pending': [payload...], 'at'}
+web_result_lock = threading.Lock()
+
+
+def web_result_idempotency_key(data):
+    """The client-supplied key, or a fresh one so the attempt is treated as new."""
+    client_key = request.headers.get('Idempotency-Key') or data.get('idempotencyKey')
+    if client_key:
+        return str(client_key)[:128]
+    return f"auto:{uuid.uuid4().hex}"
+
+
+def validate_web_result(data):
+    """Returns an error message for a malformed result, or None."""
+    if not isinstance(data, dict) or not all(k in data for k in WEB_RESULT_REQUIRED_FIELDS):
+        return 'Missing required data fields.'
+    for field in ('scorePercentage', 'correctAnswers', 'totalQuestions'):
+        if not isinstance(data[field], (int, float)) or isinstance(data[field], bool):
+            return f"'{field}' must be a number."
+    return None
+
+
+def claim_web_result(key, data):
+    """
+    Registers a result for key. Returns True when the caller must insert it, False
+    when the key was already seen. A repeat call can still add a side effect
+    (e.g. postToGroup) that hasn't run yet.
+    """
+    now = time.time()
+    with web_result_lock:
+        while web_result_keys and (len(web_result_keys) > WEB_RESULT_MAX_KEYS or next(iter(web_result_keys.values()))['at'] < now - WEB_RESULT_KEY_TTL):
+            web_result_keys.popitem(last=False)
+
+        entry = web_result_keys.get(key)
+        if entry is not None:
+            if entry['result_id'] is None:
+                entry['pending'].append(data)
+            else:
+                background_pool.submit(run_web_result_side_effects, key, data)
+            return False
+
+        web_result_keys[key] = {'result_id': None, 'effects': set(), 'pending': [data], 'at': now}
+    return True
+
+
+def _web_result_row(data):
+    return {
+        'user_id': data['userId'],
+        'user_name': data['userName'],
+        'quiz_set': data['quizSet'],
+        'score_percentage': data['scorePercentage'],
+        'correct_answers': data['correctAnswers'],
+        'total_questions': data['totalQuestions'],
+        'time_taken_seconds': data.get('timeTakenSeconds', 0),
+        'strongest_topic': data.get('strongestTopic', 'N/A'),
+        'weakest_topic': data.get('weakestTopic', 'N/A')
+    }
+
+
+def save_web_result(key, data):
+    """Inserts a claimed result, then hands it (and any repeat that arrived meanwhile) to the side-effect runner."""
+    try:
+        result_id = supabase.table('web_quiz_results').insert(_web_result_row(data)).execute().data[0]['id']
+    except Exception:
+        with web_result_lock:
+            # Forget the key so the client's retry is accepted again
+            web_result_keys.pop(key, None)
+        raise
+    print(f"API: Successfully saved web quiz result (ID: {result_id}) for {data['userName']}.")
+
+    with web_result_lock:
+        entry = web_result_keys[key]
+        entry['result_id'] = result_id
+        pending, entry['pending'] = entry['pending'], []
+    for payload in pending:
+        background_pool.submit(run_web_result_side_effects, key, payload)
+    return result_id
+
+
+def _claim_web_result_effect(key, effect):
+    """True exactly once per (key, effect)."""
+    with web_result_lock:
+        entry = web_result_keys.get(key)
+        if entry is None or effect in entry['effects']:
+            return False
+        entry['effects'].add(effect)
+        return True
+
+
+def run_web_result_side_effects(key, data):
+    """Participation tracking plus the admin DM or group post for a saved result, each run once per key."""
+    result_id = web_result_keys.get(key, {}).get('result_id')
+    if _claim_web_result_effect(key, 'participation'):
         try:
-            user_id = data['userId']
-            user_name = data['userName']
-            # Score percentage is already provided
-            score_percentage = data['scorePercentage']
-            # Convert percentage back to score ratio (e.g., 80% -> 0.8) for the function if needed,
-            # or adjust the function. Assuming the function expects a percentage 0-100.
-            score_for_tracking = score_percentage
-            time_taken = data.get('timeTakenSeconds', 0)
-
-            record_quiz_participation(user_id, user_name, score_for_tracking, time_taken)
-            print(f"API: Also recorded participation in core tables for {user_name}.")
+            # Score percentage is already provided (0-100), which is what the function expects
+            record_quiz_participation(data['userId'], data['userName'], data['scorePercentage'], data.get('timeTakenSeconds', 0))
+            print(f"API: Also recorded participation in core tables for {data['userName']}.")
         except Exception as tracking_error:
             print(f"API Error: Failed to call record_quiz_participation for {data['userName']}: {tracking_error}")
             report_error_to_admin(f"Failed core tracking for Web Quiz user {data['userName']}:\n{tracking_error}")
-        # --- END NEW ---
-        # --- HANDLE ADMIN NOTIFICATION or GROUP POST ---
-        if data.get('postToGroup'):
-            # This block runs if the "Post Score to Group" button was clicked
+
+    if data.get('postToGroup'):
+        # This block runs if the "Post Score to Group" button was clicked
+        if _claim_web_result_effect(key, 'group_post'):
             process_post_score_request(data)
-        else:
-            # This block runs automatically when the quiz is completed
+    elif _claim_web_result_effect(key, 'admin_notification'):
+        # This block runs automatically when the quiz is completed
+        try:
             admin_summary = (
                 f"🔔 <b>New Web Quiz Submission!</b>\n\n"
                 f"👤 <b>User:</b> {escape(data['userName'])}\n"
@@ -1671,14 +4039,207 @@ def save_quiz_result():
                 f"<i>Do you want to post this result in the group?</i>"
             )
             markup = types.InlineKeyboardMarkup()
-            markup.add(types.InlineKeyboardButton("✅ Yes, Post to Group", callback_data=f"post_web_result_{new_result_id}"))
+            markup.add(types.InlineKeyboardButton("✅ Yes, Post to Group", callback_data=f"post_web_result_{result_id}"))
             bot.send_message(ADMIN_USER_ID, admin_summary, parse_mode="HTML", reply_markup=markup)
+        except Exception:
+            report_error_to_admin(f"Could not notify admin about web result {result_id}:\n{traceback.format_exc()}")
+
+
+@app.route('/api/save_result', methods=['POST'])
+def save_quiz_result():
+    """
+    API endpoint for the Web App to save a user's quiz result.
+    The row is written before answering; notifications happen in the background.
+    """
+    try:
+        data = request.get_json(silent=True)
+        error_message = validate_web_result(data)
+        if error_message:
+            return json.dumps({'status': 'error', 'message': error_message}), 400
 
+        key = web_result_idempotency_key(data)
+        if claim_web_result(key, data):
+            save_web_result(key, data)
         return json.dumps({'status': 'success', 'message': 'Result processed.'}), 200
 
     except Exception as e:
         report_error_to_admin(f"Error in /api/save_result: {traceback.format_exc()}")
         return json.dumps({'status': 'error', 'message': 'An internal server error occurred.'}), 500
+
+# =============================================================================
+# 7.3. ANALYSIS WEB APP STATIC ASSETS (FINGERPRINTED, PRECOMPRESSED)
+# =============================================================================
+# webapp/ is served from /webapp/. The assets are read, fingerprinted
+# (style.<hash>.css) and compressed once per process. The HTML shell is
+# rewritten to point at the hashed names, so it is the only file the
+# Telegram browser has to revalidate. Everything else is cached as immutable
+# and /my_analysis opens from cache after the first load. Chart.js is served
+# from here too once its build is committed in webapp/vendor/; until then
+# the shell keeps its pinned CDN tag. Nothing is downloaded at startup.
+WEBAPP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'webapp')
+WEBAPP_ASSET_FILES = ['style.css', 'script.js']
+CHARTJS_VERSION = '4.4.1'
+CHARTJS_VENDOR_FILE = os.path.join('vendor', 'chart.umd.min.js')
+WEBAPP_IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+WEBAPP_SHELL_CACHE_CONTROL = 'no-cache'
+WEBAPP_MIMETYPES = {'.css': 'text/css', '.js': 'application/javascript', '.html': 'text/html'}
+webapp_assets = {}  # served name -> {'body', 'gzip', 'br', 'etag', 'mimetype'}
+webapp_assets_lock = threading.Lock()
+chartjs_fallback_logged = threading.Event()
+
+try:
+    import brotli  # Optional: without it, gzip is the best encoding on offer
+except ImportError:
+    brotli = None
+
+
+def _build_webapp_asset(body, mimetype):
+    """One asset with its gzip (and, when available, brotli) variants."""
+    return {
+        'body': body,
+        'gzip': gzip.compress(body, compresslevel=9),
+        'br': brotli.compress(body, quality=11) if brotli else None,
+        'etag': hashlib.sha256(body).hexdigest()[:32],
+        'mimetype': mimetype,
+    }
+
+
+def _fingerprinted_name(name, body):
+    stem, ext = os.path.splitext(os.path.basename(name))
+    return f"{stem}.{hashlib.sha256(body).hexdigest()[:10]}{ext}"
+
+
+def _read_chartjs():
+    """The vendored Chart.js build, or None if it hasn't been committed."""
+    vendored = os.path.join(WEBAPP_DIR, CHARTJS_VENDOR_FILE)
+    if not os.path.exists(vendored):
+        return None
+    with open(vendored, 'rb') as f:
+        return f.read()
+
+
+def build_webapp_assets():
+    """Fingerprints and compresses webapp/ and rewrites the HTML shell to reference the hashed names."""
+    with open(os.path.join(WEBAPP_DIR, 'index.html'), encoding='utf-8') as f:
+        shell = f.read()
+
+    assets = {}
+    for name in WEBAPP_ASSET_FILES:
+        with open(os.path.join(WEBAPP_DIR, name), 'rb') as f:
+            body = f.read()
+        hashed_name = _fingerprinted_name(name, body)
+        assets[hashed_name] = _build_webapp_asset(body, WEBAPP_MIMETYPES[os.path.splitext(name)[1]])
+        shell = re.sub(rf'''(href|src)="{re.escape(name)}"''', rf'\1="{hashed_name}"', shell)
+
+    chartjs = _read_chartjs()
+    if chartjs:
+        hashed_name = _fingerprinted_name(CHARTJS_VENDOR_FILE, chartjs)
+        assets[hashed_name] = _build_webapp_asset(chartjs, WEBAPP_MIMETYPES['.js'])
+        shell = re.sub(r'src="https://cdn\.jsdelivr\.net/npm/chart\.js[^"]*"', f'src="{hashed_name}"', shell)
+    elif not chartjs_fallback_logged.is_set():
+        # The shell keeps its pinned CDN tag, so the dashboard still works. This is a known state
+        # until the file is committed, so it is logged once per process rather than paged to the admin.
+        chartjs_fallback_logged.set()
+        print(f"⚠️ webapp/{CHARTJS_VENDOR_FILE} is not vendored; the dashboard loads Chart.js {CHARTJS_VERSION} from the pinned CDN URL. See webapp/vendor/README.md.")
+
+    assets['index.html'] = _build_webapp_asset(shell.encode('utf-8'), WEBAPP_MIMETYPES['.html'])
+    with webapp_assets_lock:
+        webapp_assets.clear()
+        webapp_assets.update(assets)
+    print(f"✅ Built {len(assets)} web app assets ({'brotli + gzip' if brotli else 'gzip'}).")
+
+
+def serve_webapp_asset(name):
+    """Serves the best encoding the client accepts, or a 304 when its copy is current."""
+    with webapp_assets_lock:
+        built = bool(webapp_assets)
+    if not built:
+        # The startup build failed; build_webapp_assets takes the lock itself to swap the assets in
+        build_webapp_assets()
+    with webapp_assets_lock:
+        asset = webapp_assets.get(name)
+    if asset is None:
+        return "Not Found", 404
+
+    encoding = None
+    if asset['br'] and 'br' in request.accept_encodings:
+        encoding = 'br'
+    elif 'gzip' in request.accept_encodings:
+        encoding = 'gzip'
+    etag = asset['etag'] + (f'-{encoding}' if encoding else '')
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        response = Response(asset[encoding] if encoding else asset['body'], mimetype=asset['mimetype'])
+        if encoding:
+            response.headers['Content-Encoding'] = encoding
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = WEBAPP_SHELL_CACHE_CONTROL if name == 'index.html' else WEBAPP_IMMUTABLE_CACHE_CONTROL
+    response.headers['Vary'] = 'Accept-Encoding'
+    return response
+
+
+@app.route('/webapp/')
+@app.route('/webapp/<name>')
+def get_webapp_asset(name='index.html'):
+    """Serves the analysis dashboard shell and its fingerprinted assets."""
+    try:
+        return serve_webapp_asset(name)
+    except Exception as e:
+        print(f"Error serving web app asset '{name}': {e}")
+        report_error_to_admin(f"Error serving web app asset '{name}':\n{traceback.format_exc()}")
+        return "Internal Server Error", 500
+# =============================================================================
+# 7.4. WEB QUIZ QUESTION-SET API
+# =============================================================================
+# Every player of a web quiz needs the same question set, so each set is read
+# once (keyset-paged), serialised and gzipped once, and kept in the reference
+# cache. The answer key is never served: correct_index and explanation stay in
+# the database, and 'used' is dropped too since it flips during marathons. The
+# Web App URL carries the set's ETag as ?v=, so a versioned request is safe to
+# cache for a year; edits to a set drop its entry and new links get a new version.
+QUIZ_SET_IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+QUIZ_SET_REVALIDATE_CACHE_CONTROL = 'public, max-age=60, must-revalidate'
+QUIZ_SET_EXCLUDED_COLUMNS = frozenset({'correct_index', 'explanation', 'used'})
+
+
+def _load_quiz_set_entry(set_name):
+    questions = [
+        {k: v for k, v in row.items() if k not in QUIZ_SET_EXCLUDED_COLUMNS}
+        for row in scan_table('quiz_questions', where=lambda q: q.eq('quiz_set', set_name))
+    ]
+    print(f"✅ Web quiz set '{set_name}' cached ({len(questions)} questions).")
+    return dict(build_precompressed_json({'quizSet': set_name, 'questions': questions}), count=len(questions))
+
+
+def get_quiz_set_entry(set_name, force_refresh=False):
+    """Returns the precompressed JSON entry for a question set, loading it on the first request."""
+    return cached_read('quiz_sets', set_name, lambda: _load_quiz_set_entry(set_name), force_refresh)
+
+
+def invalidate_quiz_set(set_name=None):
+    """Drops a cached question set (or all of them) after its questions were edited."""
+    invalidate_cache('quiz_sets', set_name)
+
+
+@app.route('/api/quiz/<path:set_name>')
+def get_quiz_set(set_name):
+    """Serves a web quiz question set, without its answers, from the in-memory cache."""
+    try:
+        entry = get_quiz_set_entry(set_name)
+        if not entry['count']:
+            # Don't keep an empty set around; it may just not be uploaded yet
+            invalidate_quiz_set(set_name)
+            return json.dumps({'status': 'error', 'message': 'Quiz set not found.'}), 404
+        # Only a request for the current version may be cached forever
+        versioned = request.args.get('v') == entry['etag']
+        return serve_precompressed_json(entry, QUIZ_SET_IMMUTABLE_CACHE_CONTROL if versioned else QUIZ_SET_REVALIDATE_CACHE_CONTROL)
+    except Exception as e:
+        print(f"API Error in /api/quiz for '{set_name}': {e}")
+        report_error_to_admin(f"Error in /api/quiz for '{set_name}':\n{traceback.format_exc()}")
+        return json.dumps({'status': 'error', 'message': 'Could not load quiz set.'}), 500
+
+
 @bot.message_handler(commands=['add_resource'])
 @permission_required('add_resource')
 def handle_add_resource(msg: types.Message):
@@ -1699,10 +4260,7 @@ def handle_add_resource(msg: types.Message):
     prompt_text = "Okay, let's add a new resource to the Vault.\n\n<b>Step 1:</b> Please upload the document, audio, photo, or video file now."
     prompt = bot.send_message(user_id, prompt_text, parse_mode="HTML")
 
-@bot.message_handler(
-    func=lambda msg: user_states.get(msg.from_user.id, {}).get('step') == 'awaiting_file',
-    content_types=['document', 'photo', 'video', 'audio']
-)
+@conversation_step('awaiting_file', content_types=['document', 'photo', 'video', 'audio'], accepts_forwards=True)
 def process_resource_file_step_1(msg: types.Message):
     """
     Step 1: Receives the initial file upload from the admin.
@@ -1761,7 +4319,7 @@ def process_resource_file_step_1(msg: types.Message):
     bot.send_message(user_id, f"✅ File received: <code>{escape(file_name)}</code>\n\n<b>Step 2 of 7:</b> Which Group does this file belong to?", reply_markup=markup, parse_mode="HTML")
 
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith('add_'))
+@bot.callback_query_handler(func=callback_data_filter('add_'))
 def handle_add_resource_callbacks(call: types.CallbackQuery):
     """
     Handles all button-based steps for the resource addition flow,
@@ -1915,7 +4473,10 @@ def save_resource_to_db(user_id):
             'podcast_format': state.get('podcast_format') # Safely get the new value
         }
 
-        supabase.table('resources').insert(data_to_insert).execute()
+        response = supabase.table('resources').insert(data_to_insert).execute()
+        # Keep the in-memory Vault catalog in sync without a full reload
+        if response.data:
+            catalog_add_resource(response.data[0])
         
     except Exception as e:
         report_error_to_admin(f"Error saving resource to DB: {traceback.format_exc()}")
@@ -1956,7 +4517,7 @@ def _build_admin_main_menu():
     text = f"👑 <b>Admin Control Panel</b> 👑\n<i>Bot Status: {health_status}</i>\n\nWelcome, Admin. Please choose a category to manage:"
     return text, markup
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith('admin_'))
+@bot.callback_query_handler(func=callback_data_filter('admin_'))
 def handle_admin_callbacks(call: types.CallbackQuery):
     """
     Master handler for all admin dashboard navigation with a robust command router.
@@ -2149,7 +4710,7 @@ def handle_web_quiz_command(msg: types.Message):
     except Exception as e:
         report_error_to_admin(f"Error in /webquiz command: {traceback.format_exc()}")
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith('webquiz_select_'))
+@bot.callback_query_handler(func=callback_data_filter('webquiz_select_'))
 def handle_webquiz_set_selection(call: types.CallbackQuery):
     """
     Handles the preset selection and provides the final Web App button.
@@ -2166,6 +4727,13 @@ def handle_webquiz_set_selection(call: types.CallbackQuery):
 
         # Correctly constructs the full URL for the web app
         web_app_url = f"{WEBAPP_URL.rstrip('/')}/quiz/?user_id={user_id}&user_name={quote(user_name)}&quiz_set={quote(selected_set)}"
+        # Point the quiz at the cached question-set API, pinned to the set's current version
+        if SERVER_URL:
+            try:
+                version = get_quiz_set_entry(selected_set)['etag']
+                web_app_url += f"&api={quote(SERVER_URL.rstrip('/'), safe='')}&v={version}"
+            except Exception as e:
+                print(f"⚠️ Could not warm web quiz set '{selected_set}': {e}")
 
         markup = types.InlineKeyboardMarkup()
         
@@ -2191,7 +4759,7 @@ def handle_webquiz_set_selection(call: types.CallbackQuery):
         bot.answer_callback_query(call.id, "An error occurred.", show_alert=True)
 
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith('post_web_result_'))
+@bot.callback_query_handler(func=callback_data_filter('post_web_result_'))
 def handle_post_web_result_callback(call: types.CallbackQuery):
     """
     Handles the admin's decision to post a web quiz result to the group.
@@ -2316,6 +4884,7 @@ def process_single_photo(message, question_id):
 
         # Check karna ki update hua ya nahi
         if len(response.data) > 0:
+            deck_update_question(response.data[0])
             bot.reply_to(message, f"✅ Success! Image question ID {question_id} mein add ho gayi hai.")
         else:
             bot.reply_to(message, f"⚠️ Error! Question ID {question_id} database mein nahi mila. Please ID check karein.")
@@ -2326,95 +4895,167 @@ def process_single_photo(message, question_id):
 # 8. TELEGRAM BOT HANDLERS - BATCH IMAGE UPLOAD LOGIC
 # =============================================================================
 
-@bot.message_handler(content_types=['photo'])
+def _expire_media_batches():
+    """Drops batches past their TTL. Caller holds media_batch_lock."""
+    cutoff = time.time() - MEDIA_BATCH_TTL
+    for key in [k for k, batch in media_batches.items() if batch['created_at'] < cutoff]:
+        media_batches.pop(key)['timer'].cancel()
+        print(f"🧹 Dropped an abandoned media batch for user {key[0]}.")
+
+
+def add_to_media_batch(user_id, kind, message, on_complete, dedupe_key=None):
+    """
+    Collects a user's files into one batch per (user, kind), across however many
+    albums (media groups) Telegram splits them into. When no new file has arrived
+    for MEDIA_BATCH_QUIET_SECONDS, on_complete(user_id, messages) runs once with
+    the messages in the order they were sent. Timer and items share one key, so
+    a new album can't cancel another album's timer and strand its photos.
+    """
+    key = (user_id, kind)
+    with media_batch_lock:
+        _expire_media_batches()
+        batch = media_batches.get(key)
+        if batch is None:
+            batch = media_batches[key] = {'items': [], 'seen': set(), 'timer': None, 'created_at': time.time(), 'on_complete': on_complete}
+        if dedupe_key is not None:
+            if dedupe_key in batch['seen']:
+                return
+            batch['seen'].add(dedupe_key)
+        batch['items'].append(message)
+        if batch['timer']:
+            batch['timer'].cancel()
+        batch['timer'] = threading.Timer(MEDIA_BATCH_QUIET_SECONDS, _complete_media_batch, [key])
+        batch['timer'].start()
+
+
+def _complete_media_batch(key):
+    with media_batch_lock:
+        batch = media_batches.pop(key, None)
+    if batch:
+        batch['on_complete'](key[0], sorted(batch['items'], key=lambda m: m.message_id))
+
+
+def discard_media_batches(user_id):
+    """Cancels any pending batch for the user (e.g. when a photo restarts the flow)."""
+    with media_batch_lock:
+        for key in [k for k in media_batches if k[0] == user_id]:
+            media_batches.pop(key)['timer'].cancel()
+
+
+@conversation_action('adding_rq_photos', 'adding_qm_photos', content_types=['photo'], accepts_forwards=True)
 def handle_rq_photos(message):
     user_id = message.from_user.id
     
     # Check karein ki user photo add karne wale state mein hai ya nahi
     user_action = user_states.get(user_id, {}).get('action')
     if user_action in ['adding_rq_photos', 'adding_qm_photos']:
-        
-        # Agar koi purana timer chal raha hai, to use cancel karein
-        if user_id in batch_timers:
-            batch_timers[user_id].cancel()
+        # Saari albums ek hi batch mein jaati hain; 2 second tak koi nayi photo nahi aayi, to batch process hoga
+        add_to_media_batch(user_id, 'question_photos', message, process_photo_batch, dedupe_key=message.photo[-1].file_unique_id)
+
+
+# Attaching a batch of photos is one set-based UPDATE through this RPC
+# (defined in the database, not here):
+#
+#   create or replace function attach_question_images(p_table_name text, p_images jsonb, p_quiz_set text default null)
+#   returns setof bigint language plpgsql as $$
+#   begin
+#     if p_table_name not in ('questions', 'quiz_questions') then
+#       raise exception 'attach_question_images: unsupported table %', p_table_name;
+#     end if;
+#     return query execute format(
+#       'update %I as t set image_file_id = v.file_id
+#          from jsonb_to_recordset($1) as v(id bigint, file_id text)
+#         where t.id = v.id %s
+#        returning t.id',
+#       p_table_name, case when p_quiz_set is null then '' else 'and t.quiz_set = $2' end)
+#     using p_images, p_quiz_set;
+#   end $$;
+#
+# Until it is deployed, each row gets its own concurrent update instead.
+ATTACH_IMAGES_RPC = 'attach_question_images'
+
+
+def attach_question_images(table_name, assignments, quiz_set=None):
+    """
+    Sets image_file_id for {question_id: file_id} and returns (updated_ids, unconfirmed):
+    updated_ids are the rows the database reported as written, unconfirmed maps
+    question IDs whose write failed or timed out to the error. Anything in
+    neither was written without matching a row (wrong ID or quiz_set).
+    Only image_file_id is written, so columns other writers touch (like 'used')
+    are never written back.
+    """
+    images = [{'id': question_id, 'file_id': file_id} for question_id, file_id in assignments.items()]
+    try:
+        returned = supabase.rpc(ATTACH_IMAGES_RPC, {'p_table_name': table_name, 'p_images': images, 'p_quiz_set': quiz_set}).execute().data or []
+        return {int(row['id'] if isinstance(row, dict) else row) for row in returned}, {}
+    except APIError as e:
+        if getattr(e, 'code', None) != 'PGRST202':  # PGRST202: the function isn't deployed
+            return set(), {question_id: e for question_id in assignments}
+    except Exception as e:
+        # One statement: either every row was written or none was, and a timeout can't tell us which
+        return set(), {question_id: e for question_id in assignments}
 
-        # Album/batch ke liye key (media_group_id ya user_id)
-        batch_key = message.media_group_id or user_id
-        
-        # Photo ko batch mein add karein
-        if batch_key not in photo_batches:
-            photo_batches[batch_key] = []
-        
-        photo_file_id = message.photo[-1].file_id
-        if photo_file_id not in [p['file_id'] for p in photo_batches[batch_key]]:
-             photo_batches[batch_key].append({'file_id': photo_file_id, 'message': message})
-        
-        # Naya timer set karein. Agar 2 second tak koi nayi photo nahi aayi, to batch process hoga.
-        timer = threading.Timer(2.0, process_photo_batch, [batch_key, user_id])
-        batch_timers[user_id] = timer
-        timer.start()
+    def update_task(question_id, file_id):
+        def run():
+            query = supabase.table(table_name).update({'image_file_id': file_id}).eq('id', question_id)
+            if quiz_set is not None:
+                query = query.eq('quiz_set', quiz_set)
+            return query.execute().data or []
+        return run
 
-def process_photo_batch(batch_key, user_id):
+    results, errors = run_concurrently({question_id: update_task(question_id, file_id) for question_id, file_id in assignments.items()})
+    return {int(row['id']) for rows in results.values() for row in rows}, errors
+
+
+def process_photo_batch(user_id, batch_items):
+    """
+    Links the batch's photos to consecutive question IDs starting at the session's start_id
+    with one set-based write, and reports IDs that didn't match a row separately
+    from IDs whose write couldn't be confirmed.
+    """
     try:
-        if batch_key not in photo_batches:
+        state = user_states.get(user_id)
+        if not state or state.get('action') not in ['adding_rq_photos', 'adding_qm_photos']:
             return
-
-        batch_items = photo_batches[batch_key]
-        state = user_states[user_id]
         start_id = state['start_id']
         chat_id = state['chat_id']
         action = state.get('action')
 
         bot.send_message(chat_id, f"Processing {len(batch_items)} photos...")
-        
-        success_count = 0
-        fail_count = 0
-        failed_ids = []
 
         # Decide which table and conditions to use based on the action
-        table_name = ''
         if action == 'adding_rq_photos':
             table_name = 'questions'
-        elif action == 'adding_qm_photos':
+        else:
             # Yahan assume kar rahe hain ki marathon questions 'quiz_questions' table mein hain
             table_name = 'quiz_questions'
-
-        for i, item in enumerate(batch_items):
-            current_id = start_id + i
-            photo_file_id = item['file_id']
-            
-            try:
-                # Base query banayein
-                query = supabase.table(table_name).update({
-                    'image_file_id': photo_file_id
-                }).eq('id', str(current_id))
-
-                # Agar 'add_qm' hai, to quiz_set ki condition bhi add karein
-                if action == 'adding_qm_photos':
-                    set_name = state['set_name']
-                    query = query.eq('quiz_set', set_name)
-
-                # Query execute karein
-                response = query.execute()
-
-                if len(response.data) > 0:
-                    success_count += 1
-                else:
-                    fail_count += 1
-                    failed_ids.append(str(current_id))
-            
-            except Exception as db_error:
-                print(f"DB update error for ID {current_id}: {db_error}")
-                fail_count += 1
-                failed_ids.append(str(current_id))
+        assignments = {start_id + i: item.photo[-1].file_id for i, item in enumerate(batch_items)}
+
+        # Agar 'add_qm' hai, to quiz_set ki condition bhi lagti hai
+        quiz_set = state['set_name'] if action == 'adding_qm_photos' else None
+        updated_ids, unconfirmed = attach_question_images(table_name, assignments, quiz_set)
+        for question_id, e in unconfirmed.items():
+            print(f"❌ Could not confirm photo for {table_name} ID {question_id}: {e}")
+
+        not_found_ids = [str(question_id) for question_id in assignments if question_id not in updated_ids and question_id not in unconfirmed]
+        unconfirmed_ids = [str(question_id) for question_id in assignments if question_id in unconfirmed]
+        if table_name == 'questions':
+            for question_id in updated_ids:
+                deck_update_question({'id': question_id, 'image_file_id': assignments[question_id]})
+        if quiz_set is not None and (updated_ids or unconfirmed):
+            invalidate_quiz_set(quiz_set)
 
         # Final confirmation message
         summary_message = f"✅ **Batch Process Complete!**\n\n"
-        summary_message += f"• Successfully added: **{success_count}** photos.\n"
-        if fail_count > 0:
-            summary_message += f"• Failed to add: **{fail_count}** photos.\n"
-            summary_message += f"• Failed IDs: `{', '.join(failed_ids)}`\n"
-            summary_message += f"_(Reason: Question ID not found or quiz_set mismatch)_"
+        summary_message += f"• Successfully added: **{len(updated_ids)}** photos.\n"
+        if not_found_ids:
+            summary_message += f"• Not found: **{len(not_found_ids)}** photos.\n"
+            summary_message += f"• IDs: `{', '.join(not_found_ids)}`\n"
+            summary_message += f"_(Reason: Question ID not found or quiz_set mismatch)_\n"
+        if unconfirmed_ids:
+            summary_message += f"• Not confirmed: **{len(unconfirmed_ids)}** photos.\n"
+            summary_message += f"• IDs: `{', '.join(unconfirmed_ids)}`\n"
+            summary_message += f"_(Reason: the database write failed or timed out; check these IDs before resending)_"
         
         bot.send_message(chat_id, summary_message, parse_mode="HTML")
 
@@ -2423,16 +5064,12 @@ def process_photo_batch(batch_key, user_id):
         bot.send_message(user_states[user_id]['chat_id'], "❌ Photos process karte waqt ek critical error aa gaya.")
     
     finally:
-        # State aur temporary data ko clean up karna
-        if batch_key in photo_batches:
-            del photo_batches[batch_key]
-        if user_id in batch_timers:
-            del batch_timers[user_id]
+        # State ko clean up karna
         if user_id in user_states and user_states[user_id].get('action') in ['adding_rq_photos', 'adding_qm_photos']:
             del user_states[user_id]
 
 
-@bot.callback_query_handler(func=lambda call: call.data == 'delete_analysis_msg')
+@bot.callback_query_handler(func=callback_data_filter(exact=('delete_analysis_msg',)))
 def handle_delete_message_callback(call: types.CallbackQuery):
     """
     Deletes the analysis message and the original command,
@@ -2541,16 +5178,16 @@ def handle_add_qm(message):
         return
     try:
         # Step 1: Supabase se saare available quiz sets fetch karna
-        response = supabase.table('quiz_presets').select('set_name, button_label').order('id').execute()
+        presets = get_quiz_presets()
 
-        if not response.data:
+        if not presets:
             bot.reply_to(message, "❌ Database mein koi Quiz Marathon set nahi mila. Please pehle presets add karein.")
             return
 
         # Step 2: Har set ke liye Inline Keyboard Buttons banana
         markup = types.InlineKeyboardMarkup(row_width=2)
         buttons = []
-        for preset in response.data:
+        for preset in presets:
             buttons.append(
                 types.InlineKeyboardButton(
                     text=preset['button_label'],
@@ -2571,7 +5208,7 @@ def handle_add_qm(message):
     except Exception as e:
         bot.reply_to(message, "❌ Quiz sets fetch karte waqt ek error aa gaya.")
         report_error_to_admin(f"Error in /add_qm (fetching presets): {traceback.format_exc()}")
-@bot.callback_query_handler(func=lambda call: call.data.startswith('qm_set_'))
+@bot.callback_query_handler(func=callback_data_filter('qm_set_'))
 def handle_qm_set_selection(call: types.CallbackQuery):
     try:
         user_id = call.from_user.id
@@ -2588,13 +5225,12 @@ def handle_qm_set_selection(call: types.CallbackQuery):
             'timestamp': time.time()
         }
 
-        response = supabase.table('quiz_presets').select('start_id, end_id').eq('set_name', selected_set).single().execute()
+        set_info = get_quiz_preset(selected_set)
 
-        if not response.data:
+        if not set_info:
             bot.edit_message_text("❌ Error! Is set ki details database mein nahi mili. Please /cancel karke dobara try karein.", chat_id, call.message.message_id)
             return
         
-        set_info = response.data
         start_id = set_info['start_id']
         end_id = set_info['end_id']
 
@@ -2631,8 +5267,7 @@ def process_qm_start_id(message):
         start_id = int(message.text.strip())
 
         # Fetch set's ID range from DB for validation
-        set_response = supabase.table('quiz_presets').select('start_id, end_id').eq('set_name', set_name).single().execute()
-        set_info = set_response.data
+        set_info = get_quiz_preset(set_name)
         set_start_id = set_info['start_id']
         set_end_id = set_info['end_id']
 
@@ -2689,7 +5324,7 @@ def on_start(msg: types.Message):
         send_join_group_prompt(msg.chat.id)
 
 
-@bot.callback_query_handler(func=lambda call: call.data == "reverify")
+@bot.callback_query_handler(func=callback_data_filter(exact=('reverify',)))
 def reverify(call: types.CallbackQuery):
     """Handles the 'I Have Joined' button click after a user joins the group."""
     if check_membership(call.from_user.id):
@@ -2793,8 +5428,46 @@ Hello Admin! Here are your available tools.
 <code>/announce</code> - Create & pin a message.
 <code>/message</code> - Send content to group.
 <code>/reset_content</code> - Reset quotes/tips usage.
+
+<b>🛠️ Diagnostics</b>
+<code>/dbstats</code> - Slowest Supabase tables/RPCs since restart.
 """
     bot.send_message(msg.chat.id, help_text, parse_mode="HTML")
+
+
+@bot.message_handler(commands=['dbstats'])
+@admin_required
+def handle_dbstats_command(msg: types.Message):
+    """Shows the hottest Supabase tables/RPCs (by total time) recorded by the data-access layer."""
+    rows = get_db_metrics(limit=15)
+    if not rows:
+        bot.send_message(msg.chat.id, "📊 No database calls recorded since the last restart.")
+        return
+
+    lines = ["📊 <b>Supabase Hot Queries</b> (since restart)", "<i>name · op — calls | avg | p95 | max | errors | saved</i>", ""]
+    for row in rows:
+        avg_ms = row['total_ms'] / row['calls'] if row['calls'] else 0
+        p95 = db_latency_percentile(row)
+        p95_text = f"≤{p95}ms" if p95 is not None else f">{DB_LATENCY_BUCKETS_MS[-1]}ms"
+        lines.append(
+            f"<code>{escape(row['name'])}</code> · {row['operation']} — {row['calls']} | {avg_ms:.0f}ms | {p95_text} | "
+            f"{row['max_ms']:.0f}ms | {row['errors']} | {row['coalesced']}" + (f" (retries {row['retries']})" if row['retries'] else "")
+        )
+    with reference_cache_lock:
+        cache_lines = [f"<code>{escape(namespace)}</code> — {stats['hits']} hits / {stats['misses']} misses" for namespace, stats in reference_cache_stats.items()]
+    if cache_lines:
+        lines += ["", "🗃️ <b>Reference Cache</b>"] + cache_lines
+    with dispatch_stats_lock:
+        dispatch_lines = [
+            f"<code>{update_type}</code> — {stats['updates']} updates | {stats['total_us'] / stats['updates']:.1f}µs lookup | "
+            f"{stats['candidates'] / stats['updates']:.1f} of {stats['handlers']} handlers tested"
+            + (f" | saves {stats['skipped'] / stats['sampled']:.1f} filters, {stats['skipped_us'] / stats['sampled']:.1f}µs "
+               f"(net {(stats['skipped_us'] / stats['sampled']) - (stats['total_us'] / stats['updates']):.1f}µs)" if stats['sampled'] else "")
+            for update_type, stats in dispatch_stats.items() if stats['updates']
+        ]
+    if dispatch_lines:
+        lines += ["", "🧭 <b>Update Dispatch</b> (per update)"] + dispatch_lines
+    bot.send_message(msg.chat.id, "\n".join(lines), parse_mode="HTML")
 @bot.poll_answer_handler()
 def handle_poll_answer(poll_answer: types.PollAnswer):
     """
@@ -2985,12 +5658,62 @@ def handle_web_result_command(msg: types.Message):
         report_error_to_admin(f"Error in /webresult command: {traceback.format_exc()}")
         bot.send_message(msg.chat.id, "❌ An error occurred while fetching the results.")
 
+def _build_random_leaderboard_text(rows):
+    """Formats the random quiz champions message posted by /leaderboard."""
+    # Create mobile-optimized leaderboard
+    current_time = datetime.datetime.now().strftime("%d %b %Y")
+    
+    leaderboard_text = f"""🏆 <b>QUIZ CHAMPIONS</b> 🏆
+
+📅 <i>{current_time}</i>
+🎯 <i>Daily Quiz Leaders</i>
+
+━━━━━━━━━━━━━━━━━━━━━━━━━
+
+"""
+
+    # Mobile-optimized ranking display
+    for i, item in enumerate(rows):
+        user_name = escape(item.get('user_name', 'Unknown User'))
+        score = item.get('score', 0)
+        
+        if i == 0:  # Champion - compact but special
+            leaderboard_text += f"👑 <b>{user_name}</b>\n"
+            leaderboard_text += f"🥇 <b>{score} pts</b> • Champion!\n\n"
+            
+        elif i == 1:  # Runner-up
+            leaderboard_text += f"🥈 <b>{user_name}</b>\n"
+            leaderboard_text += f"⭐ <b>{score} pts</b>\n\n"
+            
+        elif i == 2:  # Third place
+            leaderboard_text += f"🥉 <b>{user_name}</b>\n"
+            leaderboard_text += f"🎖️ <b>{score} pts</b>\n\n"
+            
+        else:  # Rest - very compact
+            rank_emojis = ["4️⃣", "5️⃣", "6️⃣", "7️⃣", "8️⃣", "9️⃣", "🔟"]
+            rank_emoji = rank_emojis[i-3] if i-3 < len(rank_emojis) else f"{i+1}."
+            leaderboard_text += f"{rank_emoji} {user_name} • {score} pts\n"
+
+    leaderboard_text += f"""
+━━━━━━━━━━━━━━━━━━━━━━━━━
+
+📊 <b>STATS:</b>
+🎯 Champions: <b>{len(rows)}</b>
+🏆 Top Score: <b>{rows[0].get('score', 0)}</b>
+📈 Level: <b>{"🔥 Intense" if len(rows) >= 8 else "🌱 Growing"}</b>
+
+💡 <i>Hourly quizzes • Stay active!</i>
+
+<b>C.A.V.Y.A is here to help you 💝</b>"""
+    return leaderboard_text
+
+
 @bot.message_handler(commands=['leaderboard'])
 @admin_required
 def handle_leaderboard(msg: types.Message):
     """ Fetches and displays the top 10 random quiz scorers using HTML. """
     try:
-        response = supabase.table('leaderboard').select('user_name, score').order('score', desc=True).limit(10).execute()
+        response = get_random_quiz_leaderboard()
 
         if not response.data:
             empty_message = """🏆 <b>QUIZ LEADERBOARD</b> 🏆
@@ -3013,51 +5736,7 @@ def handle_leaderboard(msg: types.Message):
                 bot.send_message(msg.chat.id, "📢 Empty leaderboard message posted to the group! Time to get some quiz champions!")
             return
 
-        # Create mobile-optimized leaderboard
-        current_time = datetime.datetime.now().strftime("%d %b %Y")
-        
-        leaderboard_text = f"""🏆 <b>QUIZ CHAMPIONS</b> 🏆
-
-📅 <i>{current_time}</i>
-🎯 <i>Daily Quiz Leaders</i>
-
-━━━━━━━━━━━━━━━━━━━━━━━━━
-
-"""
-
-        # Mobile-optimized ranking display
-        for i, item in enumerate(response.data):
-            user_name = escape(item.get('user_name', 'Unknown User'))
-            score = item.get('score', 0)
-            
-            if i == 0:  # Champion - compact but special
-                leaderboard_text += f"👑 <b>{user_name}</b>\n"
-                leaderboard_text += f"🥇 <b>{score} pts</b> • Champion!\n\n"
-                
-            elif i == 1:  # Runner-up
-                leaderboard_text += f"🥈 <b>{user_name}</b>\n"
-                leaderboard_text += f"⭐ <b>{score} pts</b>\n\n"
-                
-            elif i == 2:  # Third place
-                leaderboard_text += f"🥉 <b>{user_name}</b>\n"
-                leaderboard_text += f"🎖️ <b>{score} pts</b>\n\n"
-                
-            else:  # Rest - very compact
-                rank_emojis = ["4️⃣", "5️⃣", "6️⃣", "7️⃣", "8️⃣", "9️⃣", "🔟"]
-                rank_emoji = rank_emojis[i-3] if i-3 < len(rank_emojis) else f"{i+1}."
-                leaderboard_text += f"{rank_emoji} {user_name} • {score} pts\n"
-
-        leaderboard_text += f"""
-━━━━━━━━━━━━━━━━━━━━━━━━━
-
-📊 <b>STATS:</b>
-🎯 Champions: <b>{len(response.data)}</b>
-🏆 Top Score: <b>{response.data[0].get('score', 0)}</b>
-📈 Level: <b>{"🔥 Intense" if len(response.data) >= 8 else "🌱 Growing"}</b>
-
-💡 <i>Hourly quizzes • Stay active!</i>
-
-<b>C.A.V.Y.A is here to help you 💝</b>"""
+        leaderboard_text = render_leaderboard(('random', datetime.date.today().isoformat()), response.version, lambda: _build_random_leaderboard_text(response.data))
 
         bot.send_message(GROUP_ID, leaderboard_text, parse_mode="HTML", message_thread_id=QUIZ_TOPIC_ID)
 
@@ -3099,7 +5778,7 @@ def load_data():
     global QUIZ_SESSIONS, QUIZ_PARTICIPANTS, active_polls
     print("Loading data from Supabase...")
     try:
-        response = supabase.table('bot_state').select("*").execute()
+        response = supabase.table('bot_state').select("key, value").in_('key', ['active_polls', 'quiz_sessions', 'quiz_participants']).execute()
 
         if hasattr(response, 'data') and response.data:
             db_data = response.data
@@ -3187,7 +5866,7 @@ def handle_info_command(msg: types.Message):
     """ Provides a beautifully formatted and categorized list of commands for members. """
     # Add activity tracking
     try:
-        supabase.rpc('update_chat_activity', {'p_user_id': msg.from_user.id, 'p_user_name': msg.from_user.username or msg.from_user.first_name}).execute()
+        record_chat_activity(msg.from_user.id, msg.from_user.username or msg.from_user.first_name)
     except Exception as e:
         print(f"Activity tracking failed for user {msg.from_user.id} in command: {e}")
     
@@ -3253,10 +5932,7 @@ def handle_message_command(msg: types.Message):
     bot.send_message(admin_id, "✅ Understood. Please send me the content (text, image, sticker, file, etc.) that you want to post in the group. You can also add a caption to media. Use /cancel to stop.")
 
 
-@bot.message_handler(
-    func=lambda msg: user_states.get(msg.from_user.id, {}).get('step') == 'awaiting_group_message_content',
-    content_types=['text', 'photo', 'video', 'document', 'audio', 'sticker', 'animation']
-)
+@conversation_step('awaiting_group_message_content', content_types=['text', 'photo', 'video', 'document', 'audio', 'sticker', 'animation'], accepts_forwards=True)
 def handle_group_message_content(msg: types.Message):
     """
     Receives the content from the admin and copies it to the main group.
@@ -3296,10 +5972,7 @@ def handle_smart_fileid_command(msg: types.Message):
     bot.reply_to(msg, "✅ Ready! Please send me any files. I will handle images and other file types (like PDFs) differently.")
 
 
-@bot.message_handler(
-    func=lambda msg: user_states.get(msg.from_user.id, {}).get('action') == 'getting_smart_file_ids',
-    content_types=['document', 'photo', 'video', 'audio']
-)
+@conversation_action('getting_smart_file_ids', content_types=['document', 'photo', 'video', 'audio'], accepts_forwards=True)
 def handle_smart_files(message: types.Message):
     """
     Acts as a router. If the file is a photo, it starts the quiz flow.
@@ -3309,25 +5982,12 @@ def handle_smart_files(message: types.Message):
 
     # --- BRANCH 1: Handle Images (Photos) ---
     if message.photo:
-        if user_id in batch_timers:
-            batch_timers[user_id].cancel()
+        discard_media_batches(user_id)
         start_image_to_quiz_flow(message)
 
     # --- BRANCH 2: Handle Other File Types (PDF, Video, Audio) ---
     else:
-        if user_id in batch_timers:
-            batch_timers[user_id].cancel()
-
-        batch_key = message.media_group_id or user_id
-        
-        if batch_key not in photo_batches:
-            photo_batches[batch_key] = []
-        
-        photo_batches[batch_key].append(message)
-        
-        timer = threading.Timer(2.0, process_generic_file_batch, [batch_key, user_id])
-        batch_timers[user_id] = timer
-        timer.start()
+        add_to_media_batch(user_id, 'file_ids', message, process_generic_file_batch)
 
 
 def start_image_to_quiz_flow(msg: types.Message):
@@ -3354,14 +6014,11 @@ def start_image_to_quiz_flow(msg: types.Message):
     bot.send_message(admin_id, message_text, reply_markup=markup, parse_mode="HTML")
 
 
-def process_generic_file_batch(batch_key, user_id):
+def process_generic_file_batch(user_id, batch_items):
     """Processes a batch of non-image files and sends a list of their IDs."""
     try:
         state = user_states.get(user_id, {})
         if not state: return
-
-        if batch_key not in photo_batches: return
-        batch_items = photo_batches[batch_key]
         if not batch_items: return
         
         chat_id = batch_items[0].chat.id
@@ -3385,13 +6042,11 @@ def process_generic_file_batch(batch_key, user_id):
     except Exception as e:
         report_error_to_admin(f"Error in process_generic_file_batch: {traceback.format_exc()}")
     finally:
-        if batch_key in photo_batches: del photo_batches[batch_key]
-        if user_id in batch_timers: del batch_timers[user_id]
         if user_id in user_states and user_states[user_id].get('action') == 'getting_smart_file_ids':
             del user_states[user_id]
 
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith('add_img_to_quiz_'))
+@bot.callback_query_handler(func=callback_data_filter('add_img_to_quiz_'))
 def handle_image_to_quiz_confirmation(call: types.CallbackQuery):
     """Handles the Yes/No confirmation for linking an image to a quiz."""
     admin_id = call.from_user.id
@@ -3412,7 +6067,7 @@ def handle_image_to_quiz_confirmation(call: types.CallbackQuery):
         bot.edit_message_text("👍 Okay, operation cancelled. You can copy the File ID above for manual use.", call.message.chat.id, call.message.message_id)
 
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith('link_img_to_'))
+@bot.callback_query_handler(func=callback_data_filter('link_img_to_'))
 def handle_image_quiz_type_choice(call: types.CallbackQuery):
     """Handles the quiz type choice and asks for the Question ID."""
     admin_id = call.from_user.id
@@ -3447,7 +6102,10 @@ def process_image_question_id(msg: types.Message):
         question_id = int(msg.text.strip())
         table_name = "questions" if state['quiz_type'] == "random" else "quiz_questions"
         
-        supabase.table(table_name).update({'image_file_id': state['image_file_id']}).eq('id', question_id).execute()
+        response = supabase.table(table_name).update({'image_file_id': state['image_file_id']}).eq('id', question_id).execute()
+        if table_name == 'quiz_questions':
+            for row in response.data or []:
+                invalidate_quiz_set(row.get('quiz_set'))
         
         success_message = f"✅ Success! The image has been linked to Question ID <b>{question_id}</b> in the <b>{state['quiz_type'].title()} Quiz</b> table."
         bot.send_message(admin_id, success_message, parse_mode="HTML")
@@ -3537,7 +6195,7 @@ def handle_promote_command(msg: types.Message):
         report_error_to_admin(f"Error in /promote: {traceback.format_exc()}")
         bot.reply_to(msg, "❌ An error occurred.")
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith('grant_'))
+@bot.callback_query_handler(func=callback_data_filter('grant_', ack_text="⏳ Saving permission..."))
 def handle_grant_permission_callback(call: types.CallbackQuery):
     """
     Handles the permission granting button click and announces it in the group.
@@ -3558,12 +6216,13 @@ def handle_grant_permission_callback(call: types.CallbackQuery):
             'command_name': command_name,
             'granted_by': admin_id
         }).execute()
+        invalidate_user_permissions(target_user_id)
         
         # --- NEW: Announce the promotion in the group ---
         try:
             # Get the user's name for a friendly message
-            user_res = supabase.table('group_members').select('first_name').eq('user_id', target_user_id).single().execute()
-            target_user_name = user_res.data.get('first_name', 'The user') if user_res.data else 'The user'
+            target_member = lookup_member(target_user_id)
+            target_user_name = target_member.get('first_name', 'The user') if target_member else 'The user'
 
             # Format the announcement message
             announcement_text = (
@@ -3603,13 +6262,13 @@ def handle_view_perms(msg: types.Message):
             bot.reply_to(msg, f"❌ User <code>{escape(parts[1])}</code> not found.", parse_mode="HTML")
             return
             
-        perms_response = supabase.table('user_permissions').select('command_name').eq('user_id', target_user['user_id']).execute()
+        permissions = get_user_permissions(target_user['user_id'])
         
-        if not perms_response.data:
+        if not permissions:
             bot.reply_to(msg, f"<b>{escape(target_user['first_name'])}</b> has no special permissions.", parse_mode="HTML")
             return
             
-        permissions_list = "\n".join([f"• <code>{p['command_name']}</code>" for p in perms_response.data])
+        permissions_list = "\n".join([f"• <code>{command_name}</code>" for command_name in permissions])
         bot.reply_to(msg, f"<b>Permissions for {escape(target_user['first_name'])}:</b>\n\n{permissions_list}", parse_mode="HTML")
 
     except Exception as e:
@@ -3645,15 +6304,14 @@ def handle_revoke_command(msg: types.Message):
             bot.reply_to(msg, f"❌ User not found. Please make sure you provide a valid @username or reply to their message.", parse_mode="HTML")
             return
 
-        perms_response = supabase.table('user_permissions').select('command_name').eq('user_id', target_user_info['user_id']).execute()
+        permissions = get_user_permissions(target_user_info['user_id'])
 
-        if not perms_response.data:
+        if not permissions:
             bot.reply_to(msg, f"<b>{escape(target_user_info['first_name'])}</b> has no permissions to revoke.", parse_mode="HTML")
             return
 
         markup = types.InlineKeyboardMarkup(row_width=2)
-        for perm in perms_response.data:
-            command_name = perm['command_name']
+        for command_name in permissions:
             callback_data = f"revoke_{msg.from_user.id}_{target_user_info['user_id']}_{command_name}"
             markup.add(types.InlineKeyboardButton(f"❌ Revoke {command_name}", callback_data=callback_data))
 
@@ -3662,7 +6320,7 @@ def handle_revoke_command(msg: types.Message):
     except Exception as e:
         report_error_to_admin(f"Error in /revoke: {traceback.format_exc()}")
         bot.reply_to(msg, "❌ An error occurred.")
-@bot.callback_query_handler(func=lambda call: call.data.startswith('revoke_'))
+@bot.callback_query_handler(func=callback_data_filter('revoke_', ack_text="⏳ Revoking permission..."))
 def handle_revoke_permission_callback(call: types.CallbackQuery):
     """Handles the permission revoking button click."""
     try:
@@ -3674,6 +6332,7 @@ def handle_revoke_permission_callback(call: types.CallbackQuery):
 
         # Revoke the permission from the database
         supabase.table('user_permissions').delete().match({'user_id': int(target_user_id), 'command_name': command_name}).execute()
+        invalidate_user_permissions(int(target_user_id))
         
         bot.answer_callback_query(call.id, f"✅ Permission '{command_name}' revoked!", show_alert=True)
         bot.edit_message_text(f"Permission <code>{command_name}</code> was revoked.", call.message.chat.id, call.message.message_id, parse_mode="HTML")
@@ -3706,6 +6365,7 @@ def handle_demote_command(msg: types.Message):
 
         # Delete all permissions from the user_permissions table
         supabase.table('user_permissions').delete().eq('user_id', target_user_id).execute()
+        invalidate_user_permissions(target_user_id)
         
         # Also reset their role in quiz_activity for good measure
         supabase.table('quiz_activity').update({'user_role': 'member'}).eq('user_id', target_user_id).execute()
@@ -3744,10 +6404,7 @@ def handle_forwarded_message(msg: types.Message):
         bot.send_message(admin_id, error_message, parse_mode="HTML")
 
 
-@bot.message_handler(
-    func=lambda msg: user_states.get(msg.from_user.id, {}).get('step') == 'awaiting_quoted_reply',
-    content_types=['text', 'photo', 'video', 'document', 'audio', 'sticker', 'animation']
-)
+@conversation_step('awaiting_quoted_reply', content_types=['text', 'photo', 'video', 'document', 'audio', 'sticker', 'animation'])
 def handle_quoted_reply_content(msg: types.Message):
     """
     Receives the admin's reply content and sends it as a quoted reply in the group.
@@ -3783,7 +6440,7 @@ def handle_today_quiz(msg: types.Message):
     Shows a "Digital Planner" style quiz schedule for the day with interactive buttons.
     """
     try:
-        supabase.rpc('update_chat_activity', {'p_user_id': msg.from_user.id, 'p_user_name': msg.from_user.username or msg.from_user.first_name}).execute()
+        record_chat_activity(msg.from_user.id, msg.from_user.username or msg.from_user.first_name)
     except Exception as e:
         print(f"Activity tracking failed for user {msg.from_user.id} in command: {e}")
 
@@ -3796,17 +6453,17 @@ def handle_today_quiz(msg: types.Message):
         now = datetime.datetime.now(ist_tz)
         today_date_str = now.strftime('%Y-%m-%d')
         
-        response = supabase.table('quiz_schedule').select('*').eq('quiz_date', today_date_str).order('quiz_time').execute()
+        schedule_rows = get_quiz_schedule(today_date_str)
         user_name = escape(msg.from_user.first_name)
         reply_params = types.ReplyParameters(message_id=msg.message_id, allow_sending_without_reply=True)
 
-        if not response.data:
+        if not schedule_rows:
             try:
                 tomorrow_date = now + timedelta(days=1)
                 tomorrow_date_str = tomorrow_date.strftime('%Y-%m-%d')
-                tomorrow_response = supabase.table('quiz_schedule').select('id', count='exact').eq('quiz_date', tomorrow_date_str).limit(1).execute()
+                tomorrow_rows = get_quiz_schedule(tomorrow_date_str)
                 
-                if tomorrow_response.count > 0:
+                if tomorrow_rows:
                     message_text = f"✅ Hey {user_name}, no quizzes are scheduled for today. But tomorrow's schedule is ready!\n\nUse <code>/kalkaquiz</code> to see what's planned! 🔮"
                 else:
                     message_text = f"✅ Hey {user_name}, no quizzes are scheduled for today. It might be a rest day! 🧘"
@@ -3828,8 +6485,8 @@ def handle_today_quiz(msg: types.Message):
         group1_subjects = ['Advanced Accounting', 'Law', 'Taxation (Income Tax)', 'Taxation (GST)']
         group2_subjects = ['Cost', 'Audit', 'Financial Management', 'Strategic Management']
 
-        group1_quizzes = [q for q in response.data if q.get('subject') in group1_subjects]
-        group2_quizzes = [q for q in response.data if q.get('subject') in group2_subjects]
+        group1_quizzes = [q for q in schedule_rows if q.get('subject') in group1_subjects]
+        group2_quizzes = [q for q in schedule_rows if q.get('subject') in group2_subjects]
 
         if group1_quizzes:
             message_text += "🔵 <b>GROUP 1</b>\n──────────────────\n"
@@ -3966,12 +6623,12 @@ def handle_exam_countdown(msg: types.Message):
         # Truly Random Study Tip
         study_tip = "Remember to take short breaks to stay fresh!" # Default tip
         try:
-            tip_response = supabase.table('study_tips').select('id, content').eq('used', False).execute()
-            if tip_response.data:
-                chosen_tip = random.choice(tip_response.data)
+            unused_tips = get_unused_study_tips()
+            if unused_tips:
+                chosen_tip = random.choice(unused_tips)
                 study_tip = chosen_tip['content']
                 # Mark the chosen tip as used so it doesn't repeat soon
-                supabase.table('study_tips').update({'used': True}).eq('id', chosen_tip['id']).execute()
+                mark_study_tip_used(chosen_tip['id'])
         except Exception as tip_error:
             print(f"Could not fetch a random study tip: {tip_error}")
 
@@ -4044,7 +6701,7 @@ def handle_tomorrow_quiz(msg: types.Message):
     Shows tomorrow's quiz schedule with greetings and interactive buttons.
     """
     try:
-        supabase.rpc('update_chat_activity', {'p_user_id': msg.from_user.id, 'p_user_name': msg.from_user.username or msg.from_user.first_name}).execute()
+        record_chat_activity(msg.from_user.id, msg.from_user.username or msg.from_user.first_name)
     except Exception as e:
         print(f"Activity tracking failed for user {msg.from_user.id} in command: {e}")
         
@@ -4057,7 +6714,7 @@ def handle_tomorrow_quiz(msg: types.Message):
         tomorrow_date = datetime.datetime.now(ist_tz) + datetime.timedelta(days=1)
         tomorrow_date_str = tomorrow_date.strftime('%Y-%m-%d')
         
-        response = supabase.table('quiz_schedule').select('*').eq('quiz_date', tomorrow_date_str).order('quiz_time').execute()
+        schedule_rows = get_quiz_schedule(tomorrow_date_str)
 
         reply_params = types.ReplyParameters(
             message_id=msg.message_id,
@@ -4065,7 +6722,7 @@ def handle_tomorrow_quiz(msg: types.Message):
         )
 
         user_name = escape(msg.from_user.first_name)
-        if not response.data:
+        if not schedule_rows:
             message_text = f"✅ Hey {user_name}, tomorrow's schedule has not been updated yet. Please check back later!"
             bot.send_message(msg.chat.id, message_text, parse_mode="HTML", reply_parameters=reply_params)
             return
@@ -4078,7 +6735,7 @@ def handle_tomorrow_quiz(msg: types.Message):
         ]
         
         # Get the formatted schedule from our helper function
-        schedule_text = format_kalkaquiz_message(response.data)
+        schedule_text = format_kalkaquiz_message(schedule_rows)
         
         # Combine greeting and schedule
         final_message = f"{random.choice(all_greetings)}\n\n{schedule_text}"
@@ -4111,7 +6768,7 @@ def handle_tomorrow_quiz(msg: types.Message):
             print(f"Failed to even send the error message for /kalkaquiz: {final_error}")
 # --- Callback Handler for Inline Buttons ---
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith('show_'))
+@bot.callback_query_handler(func=callback_data_filter('show_'))
 def handle_interlink_callbacks(call: types.CallbackQuery):
     """
     Handles button clicks from other commands to create an interactive flow.
@@ -4140,7 +6797,7 @@ def handle_parso_quiz(msg: types.Message):
     Shows the schedule for Day After Tomorrow in a Compact Snapshot style.
     """
     try:
-        supabase.rpc('update_chat_activity', {'p_user_id': msg.from_user.id, 'p_user_name': msg.from_user.username or msg.from_user.first_name}).execute()
+        record_chat_activity(msg.from_user.id, msg.from_user.username or msg.from_user.first_name)
     except Exception as e:
         print(f"Activity tracking failed for user {msg.from_user.id} in command: {e}")
 
@@ -4155,7 +6812,7 @@ def handle_parso_quiz(msg: types.Message):
         parso_date_str = parso_date.strftime('%Y-%m-%d')
         display_date = parso_date.strftime('%A, %d %B %Y') # e.g., Thursday, 05 December 2025
 
-        response = supabase.table('quiz_schedule').select('*').eq('quiz_date', parso_date_str).order('quiz_time').execute()
+        schedule_rows = get_quiz_schedule(parso_date_str)
         
         reply_params = types.ReplyParameters(
             message_id=msg.message_id,
@@ -4165,7 +6822,7 @@ def handle_parso_quiz(msg: types.Message):
         user_name = escape(msg.from_user.first_name)
         
         # If no schedule found
-        if not response.data:
+        if not schedule_rows:
             message_text = f"✅ Hey {user_name}, the schedule for <b>Parso ({display_date})</b> hasn't been updated yet. Focus on today and tomorrow! 🧘"
             bot.send_message(msg.chat.id, message_text, parse_mode="HTML", reply_parameters=reply_params)
             return
@@ -4186,7 +6843,7 @@ def handle_parso_quiz(msg: types.Message):
         message_text += "──────────────────\n"
 
         # Loop through quizzes
-        for quiz in response.data:
+        for quiz in schedule_rows:
             try:
                 # Format Time
                 time_obj = datetime.datetime.strptime(quiz['quiz_time'], '%H:%M:%S').time()
@@ -4250,7 +6907,7 @@ def handle_listfile_command(msg: types.Message):
     Shows the new "Subject-First" menu for the Advanced Vault Browser.
     """
     try:
-        supabase.rpc('update_chat_activity', {'p_user_id': msg.from_user.id, 'p_user_name': msg.from_user.username or msg.from_user.first_name}).execute()
+        record_chat_activity(msg.from_user.id, msg.from_user.username or msg.from_user.first_name)
     except Exception as e:
         print(f"Activity tracking failed for user {msg.from_user.id} in command: {e}")
     
@@ -4295,7 +6952,7 @@ def handle_need_command(msg: types.Message):
     Searches for resources and sends the file with the new stylish caption.
     """
     try:
-        supabase.rpc('update_chat_activity', {'p_user_id': msg.from_user.id, 'p_user_name': msg.from_user.username or msg.from_user.first_name}).execute()
+        record_chat_activity(msg.from_user.id, msg.from_user.username or msg.from_user.first_name)
     except Exception as e:
         print(f"Activity tracking failed for user {msg.from_user.id} in /need command: {e}")
 
@@ -4306,23 +6963,24 @@ def handle_need_command(msg: types.Message):
             return
 
         search_term = parts[1].strip()
-        response = supabase.rpc('smart_search', {'p_search_terms': search_term}).execute()
+        # Local BM25 index first; the smart_search RPC is only a fallback
+        results = search_resources(search_term)
+        if results is None:
+            results = supabase.rpc('smart_search', {'p_search_terms': search_term}).execute().data
 
-        if not response.data:
+        if not results:
             bot.reply_to(msg, f"😥 Sorry, I couldn't find any files matching '<code>{escape(search_term)}</code>'.\n\nTry using broader terms or browse with <code>/listfile</code>.", parse_mode="HTML")
             return
 
-        if len(response.data) == 1:
-            resource = response.data[0]
-            full_resource_res = supabase.table('resources').select('file_id, file_name, description').eq('id', resource['id']).single().execute()
-            if not full_resource_res.data:
+        if len(results) == 1:
+            full_resource = catalog_get_resource(results[0]['id'])
+            if not full_resource:
                 bot.reply_to(msg, "Sorry, the matched file seems to have been deleted.", parse_mode="HTML")
                 return
 
-            full_resource = full_resource_res.data
             file_id = full_resource['file_id']
             file_name = full_resource['file_name']
-            description = full_resource.get('description', file_name)
+            description = full_resource.get('description') or file_name
             
             # --- THIS IS THE CHANGE ---
             # Call the new caption generator
@@ -4332,9 +6990,9 @@ def handle_need_command(msg: types.Message):
         else:
             # ... (The rest of the function for displaying multiple results remains the same)
             markup = types.InlineKeyboardMarkup(row_width=1)
-            results_text = f"🔎 I found <b>{len(response.data)}</b> relevant files for '<code>{escape(search_term)}</code>'. Here are the top results:\n"
+            results_text = f"🔎 I found <b>{len(results)}</b> relevant files for '<code>{escape(search_term)}</code>'. Here are the top results:\n"
             subject_emojis = { "Law": "⚖️", "Taxation": "💰", "GST": "🧾", "Accounts": "📊", "Auditing": "🔍", "Costing": "🧮", "SM": "📈", "FM & SM": "📈", "Audio Notes": "🎧", "General": "🌟"}
-            for resource in response.data:
+            for resource in results:
                 emoji = subject_emojis.get(resource.get('subject'), "📄")
                 button_text = f"{emoji} {resource['file_name']}  ({escape(resource['subject'])})"
                 button = types.InlineKeyboardButton(text=button_text, callback_data=f"getfile_{resource['id']}")
@@ -4346,7 +7004,7 @@ def handle_need_command(msg: types.Message):
         bot.reply_to(msg, "❌ A critical error occurred while searching. The admin has been notified.")
 
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith('getfile_'))
+@bot.callback_query_handler(func=callback_data_filter('getfile_'))
 def handle_getfile_callback(call: types.CallbackQuery):
     """
     Handles a file request, using the new stylish caption generator.
@@ -4361,16 +7019,16 @@ def handle_getfile_callback(call: types.CallbackQuery):
         resource_id = int(resource_id_str)
         bot.answer_callback_query(call.id, text="✅ Fetching your file from the Vault...")
         
-        response = supabase.table('resources').select('file_id, file_name, description').eq('id', resource_id).single().execute()
+        resource = catalog_get_resource(resource_id)
 
-        if not response.data:
+        if not resource:
             bot.answer_callback_query(call.id, text="❌ File not found in database.", show_alert=True)
             bot.edit_message_text("❌ Sorry, this file seems to have been deleted.", call.message.chat.id, call.message.message_id, reply_markup=None)
             return
 
-        file_id_to_send = response.data['file_id']
-        file_name_to_send = response.data['file_name']
-        description = response.data.get('description', file_name_to_send)
+        file_id_to_send = resource['file_id']
+        file_name_to_send = resource['file_name']
+        description = resource.get('description') or file_name_to_send
 
         # --- THIS IS THE CHANGE ---
         # Call the new caption generator
@@ -4423,7 +7081,7 @@ def handle_dm_command(msg: types.Message):
     bot.send_message(user_id, prompt_text, reply_markup=markup, parse_mode="HTML")
 
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith('dm_'))
+@bot.callback_query_handler(func=callback_data_filter('dm_'))
 def handle_dm_callbacks(call: types.CallbackQuery):
     """
     Handles the button presses during the /dm setup.
@@ -4480,10 +7138,7 @@ def handle_dm_callbacks(call: types.CallbackQuery):
         bot.edit_message_text("❌ Operation cancelled.", chat_id=user_id, message_id=message_id)
 
 
-@bot.message_handler(
-    func=lambda msg: user_states.get(msg.from_user.id, {}).get('step') in ['awaiting_username', 'awaiting_user_id', 'awaiting_message_content'],
-    content_types=['text', 'photo', 'video', 'document', 'audio', 'sticker', 'animation']
-)
+@conversation_step('awaiting_username', 'awaiting_user_id', 'awaiting_message_content', content_types=['text', 'photo', 'video', 'document', 'audio', 'sticker', 'animation'])
 def handle_dm_conversation_steps(msg: types.Message):
     """
     Continues the /dm conversation, processing user input and sending messages.
@@ -4498,8 +7153,7 @@ def handle_dm_conversation_steps(msg: types.Message):
             bot.send_message(admin_id, "⚠️ Please make sure the username starts with an <code>@</code> symbol. Or use /cancel to restart.", parse_mode="HTML")
             return
         try:
-            response = supabase.table('group_members').select('user_id, first_name').eq('username', username_to_find.lstrip('@')).limit(1).single().execute()
-            target_user = response.data
+            target_user = lookup_member_by_username(username_to_find)
             if not target_user:
                 bot.send_message(admin_id, f"❌ I couldn't find a user with the username <code>{escape(username_to_find)}</code> in my records.", parse_mode="HTML")
                 return
@@ -4523,8 +7177,7 @@ def handle_dm_conversation_steps(msg: types.Message):
         
         user_id_to_find = int(user_id_str)
         try:
-            response = supabase.table('group_members').select('user_id, first_name').eq('user_id', user_id_to_find).limit(1).single().execute()
-            target_user = response.data
+            target_user = lookup_member(user_id_to_find)
             if not target_user:
                 bot.send_message(admin_id, f"❌ I couldn't find a user with the ID <code>{user_id_to_find}</code> in my records.", parse_mode="HTML")
                 return
@@ -4565,12 +7218,10 @@ def handle_dm_conversation_steps(msg: types.Message):
         elif target_type == 'all':
             bot.send_message(admin_id, "🚀 Starting to broadcast... This may take a while.")
             try:
-                response = supabase.table('group_members').select('user_id, first_name').execute()
-                all_users = response.data
                 success_count = 0
                 fail_count = 0
                 
-                for user in all_users:
+                for user in scan_table('group_members', 'user_id, first_name', key='user_id'):
                     if send_message_to_user(user['user_id'], user['first_name']):
                         success_count += 1
                     else:
@@ -4590,7 +7241,9 @@ def handle_dm_conversation_steps(msg: types.Message):
 # --- Handler to Forward User DMs to Admin ---
 
 @bot.message_handler(
-    func=lambda msg: msg.chat.id == msg.from_user.id and not is_admin(msg.from_user.id) and not has_any_permission(msg.from_user.id),
+    # Cheap checks first: group messages never reach the lookup, and has_any_permission
+    # is served from the reference cache (empty results included), so a DM costs no query
+    func=lambda msg: msg.chat.type == 'private' and msg.chat.id == msg.from_user.id and not is_admin(msg.from_user.id) and not has_any_permission(msg.from_user.id),
     content_types=['text', 'photo', 'video', 'document', 'audio', 'sticker']
 )
 def forward_user_reply_to_admin(msg: types.Message):
@@ -4625,15 +7278,11 @@ def _prune_dms_task(admin_id):
     It will not block the main web worker.
     """
     try:
-        response = supabase.table('group_members').select('user_id').execute()
-        all_users = response.data
         unreachable_ids = []
+        checked_count = 0
 
-        if not all_users:
-            bot.send_message(admin_id, "✅ The group members list is currently empty. Nothing to prune.")
-            return
-
-        for i, user in enumerate(all_users):
+        for user in scan_table('group_members', 'user_id', key='user_id'):
+            checked_count += 1
             user_id = user['user_id']
             try:
                 # The 'sendChatAction' method is a lightweight way to check.
@@ -4643,16 +7292,22 @@ def _prune_dms_task(admin_id):
                 if 'Forbidden' in str(e) or 'user is deactivated' in str(e) or 'bot was blocked by the user' in str(e):
                     unreachable_ids.append(user_id)
             
-            if (i + 1) % 20 == 0:
-                print(f"Background Prune check progress: {i+1}/{len(all_users)}")
+            if checked_count % 20 == 0:
+                print(f"Background Prune check progress: {checked_count} checked")
             time.sleep(0.25) # Slightly increased to be safer with API limits
 
+        if not checked_count:
+            bot.send_message(admin_id, "✅ The group members list is currently empty. Nothing to prune.")
+            return
+
         if not unreachable_ids:
             bot.send_message(admin_id, "✅ Pruning complete! All users in the database are reachable. No one was removed.")
             return
 
-        # Remove the unreachable users from the database
-        supabase.table('group_members').delete().in_('user_id', unreachable_ids).execute()
+        # Remove the unreachable users from the database (in chunks, to keep the request URL short)
+        for start in range(0, len(unreachable_ids), 200):
+            supabase.table('group_members').delete().in_('user_id', unreachable_ids[start:start + 200]).execute()
+        forget_members(unreachable_ids)
         
         success_message = f"✅ Pruning complete!\n\nRemoved <b>{len(unreachable_ids)}</b> unreachable users from the DM list."
         bot.send_message(admin_id, success_message, parse_mode="HTML")
@@ -4715,6 +7370,121 @@ def handle_admin_reply_to_forward(msg: types.Message):
                       "1. The user has blocked the bot.\n"
                       "2. The user has never started a private chat with the bot.")
         bot.reply_to(msg, error_text, parse_mode="HTML")
+# =============================================================================
+# 5. HELPER FUNCTIONS (Continued) - MATERIALISED USER STATS
+# =============================================================================
+# /mystats and /my_analysis read a per-user record kept in memory instead of
+# calling the stats RPCs every time. record_quiz_participation() only marks the
+# player's record stale; it is rebuilt the next time that player asks for it, so
+# people who never run /mystats cost nothing. Ranks also move when other people
+# play, so records expire after USER_STATS_TTL as well.
+USER_STATS_TTL = 15 * 60
+GROUP_STATS_TTL = 30 * 60
+user_stats_store = {}  # user_id -> {'stats': {...}, 'analysis': {...}, 'summary': {...}, 'mastery': [...], 'stats_at': ts, 'analysis_at': ts, 'analysis_generation': n}
+group_stats_record = {'data': {}, 'refreshed_at': 0}
+stats_lock = threading.RLock()
+
+
+def summarise_topic_stats(topic_stats):
+    """Pre-computes the /my_analysis aggregates (overall accuracy, avg time, strongest/weakest topics)."""
+    if not topic_stats:
+        return None
+
+    def safe_accuracy(t):
+        return (t.get('total_correct', 0) / t.get('total_attempted', 1)) * 100
+
+    total_correct = sum(t.get('total_correct', 0) for t in topic_stats)
+    total_attempted = sum(t.get('total_attempted', 0) for t in topic_stats)
+    total_time = sum(t.get('total_correct', 0) * t.get('avg_time_per_question', 0) for t in topic_stats)
+    return {
+        'overall_accuracy': (total_correct / total_attempted * 100) if total_attempted > 0 else 0,
+        'overall_avg_time': (total_time / total_correct) if total_correct > 0 else 0,
+        'topic_count': len(topic_stats),
+        'total_attempted': total_attempted,
+        'strongest': [dict(t, accuracy=safe_accuracy(t)) for t in sorted([t for t in topic_stats if safe_accuracy(t) >= 80], key=safe_accuracy, reverse=True)[:7]],
+        'weakest': [dict(t, accuracy=safe_accuracy(t)) for t in sorted([t for t in topic_stats if safe_accuracy(t) < 65], key=safe_accuracy)[:7]],
+    }
+
+
+def _is_fresh(record, field):
+    return record is not None and record.get(field) is not None and time.time() - record.get(f'{field}_at', 0) < USER_STATS_TTL
+
+
+def refresh_user_stats(user_id):
+    """Re-materialises a user's /mystats record (and the group averages that come with it)."""
+    data = supabase.rpc('get_unified_user_stats', {'p_user_id': user_id}).execute().data or {}
+    with stats_lock:
+        record = user_stats_store.setdefault(user_id, {})
+        record['stats'] = data.get('user') or {}
+        record['stats_at'] = time.time()
+        if data.get('group'):
+            group_stats_record['data'] = data['group']
+            group_stats_record['refreshed_at'] = time.time()
+    return record['stats']
+
+
+def refresh_user_analysis(user_id):
+    """Re-materialises a user's /my_analysis record (unified analysis, aggregates and law-quiz mastery)."""
+    results, errors = run_concurrently({
+        'analysis': lambda: supabase.rpc('get_unified_user_analysis', {'p_user_id': user_id}).execute().data,
+        'mastery': lambda: supabase.table('section_mastery').select('*').eq('user_id', user_id).order('quiz_date', desc=True).limit(5).execute().data
+    })
+    if len(errors) == 2:
+        raise errors['analysis']
+    for name, error in errors.items():
+        print(f"⚠️ Stats refresh for {user_id}: '{name}' unavailable ({error}), keeping the rest.")
+
+    with stats_lock:
+        record = user_stats_store.setdefault(user_id, {})
+        if 'analysis' in results:
+            record['analysis'] = results['analysis'] or {}
+            record['summary'] = summarise_topic_stats(record['analysis'].get('marathon_topic_stats'))
+        if 'mastery' in results:
+            record['mastery'] = results['mastery'] or []
+        # Only a complete refresh counts as fresh; a partial one is retried next time
+        record['analysis_at'] = time.time() if not errors else 0
+        # Every refresh, partial or not, may change what the dashboard shows
+        record['analysis_generation'] = record.get('analysis_generation', 0) + 1
+        record.setdefault('analysis', {})
+        record.setdefault('mastery', [])
+    return record
+
+
+def get_user_stats_record(user_id):
+    """Returns {'user': ..., 'group': ...} for /mystats, refreshing only when the record is stale."""
+    with stats_lock:
+        record = user_stats_store.get(user_id)
+        fresh = _is_fresh(record, 'stats')
+    user_stats = record['stats'] if fresh else refresh_user_stats(user_id)
+    if time.time() - group_stats_record['refreshed_at'] > GROUP_STATS_TTL and fresh:
+        # The group averages piggyback on any user's RPC call
+        refresh_user_stats(user_id)
+    return {'user': user_stats, 'group': group_stats_record['data']}
+
+
+def get_user_analysis_record(user_id):
+    """Returns the materialised /my_analysis record, refreshing only when it is stale."""
+    with stats_lock:
+        record = user_stats_store.get(user_id)
+        if _is_fresh(record, 'analysis'):
+            return record
+    return refresh_user_analysis(user_id)
+
+
+def mark_user_stats_stale(user_id):
+    """Called whenever participation is recorded; the record is rebuilt lazily on the user's next read."""
+    try:
+        user_id = int(user_id)  # web results send the id as a string
+    except (TypeError, ValueError):
+        pass
+    with stats_lock:
+        record = user_stats_store.get(user_id)
+        if record:
+            record['stats_at'] = record['analysis_at'] = 0
+        # Another player's score moves the group averages too
+        group_stats_record['refreshed_at'] = 0
+
+
 # =============================================================================
 # 8. TELEGRAM BOT HANDLERS - STATS & ANALYSIS
 # =============================================================================
@@ -4821,11 +7591,13 @@ def handle_my_analysis_command(msg: types.Message):
     user_name = escape(msg.from_user.first_name)
     
     try:
-        marathon_analysis_res = supabase.rpc('get_unified_user_analysis', {'p_user_id': user_id}).execute()
-        section_mastery_res = supabase.table('section_mastery').select('*').eq('user_id', user_id).order('quiz_date', desc=True).limit(5).execute()
-
-        analysis_data = marathon_analysis_res.data
-        mastery_data = section_mastery_res.data
+        # Materialised record: a dict lookup unless this user's stats changed since the last read
+        record = get_user_analysis_record(user_id)
+        with stats_lock:
+            record['user_name'] = msg.from_user.first_name
+        analysis_data = record.get('analysis')
+        mastery_data = record.get('mastery')
+        summary = record.get('summary')
 
         if not (analysis_data and (analysis_data.get('marathon_topic_stats') or analysis_data.get('web_quiz_stats'))) and not mastery_data:
             bot.reply_to(msg, f"📊 <b>{user_name}'s Analysis</b>\n\nNo quiz data found yet. Participate in quizzes to generate your report!", parse_mode="HTML")
@@ -4839,16 +7611,9 @@ def handle_my_analysis_command(msg: types.Message):
             type_stats = analysis_data.get('marathon_type_stats')
             weakest_topic_for_suggestion = None
 
-            if topic_stats:
-                total_correct = sum(t.get('total_correct', 0) for t in topic_stats)
-                total_attempted = sum(t.get('total_attempted', 0) for t in topic_stats)
-                total_time = sum(t.get('total_correct', 0) * t.get('avg_time_per_question', 0) for t in topic_stats)
-                
-                overall_accuracy = (total_correct / total_attempted * 100) if total_attempted > 0 else 0
-                overall_avg_time = (total_time / total_correct) if total_correct > 0 else 0
-
-                message_parts.append(f"🎯 {overall_accuracy:.0f}% Accuracy | 📚 {len(topic_stats)} Topics | ❓ {total_attempted} Ques\n")
-                message_parts.append(f" • <b>Avg. Time / Ques:</b> {overall_avg_time:.1f}s\n\n")
+            if topic_stats and summary:
+                message_parts.append(f"🎯 {summary['overall_accuracy']:.0f}% Accuracy | 📚 {summary['topic_count']} Topics | ❓ {summary['total_attempted']} Ques\n")
+                message_parts.append(f" • <b>Avg. Time / Ques:</b> {summary['overall_avg_time']:.1f}s\n\n")
                 
                 if type_stats:
                     message_parts.append("🧠 <b>Theory vs. Practical</b>\n")
@@ -4857,18 +7622,15 @@ def handle_my_analysis_command(msg: types.Message):
                         message_parts.append(f" • <b>{q_type.get('question_type', 'N/A')}:</b> {type_accuracy:.0f}% Accuracy\n")
                     message_parts.append("\n")
 
-                def safe_accuracy(t):
-                    return (t.get('total_correct', 0) / t.get('total_attempted', 1)) * 100
-
-                strongest = sorted([t for t in topic_stats if safe_accuracy(t) >= 80], key=safe_accuracy, reverse=True)[:7]
-                weakest = sorted([t for t in topic_stats if safe_accuracy(t) < 65], key=safe_accuracy)[:7]
+                strongest = summary['strongest']
+                weakest = summary['weakest']
                 if weakest:
                     weakest_topic_for_suggestion = weakest[0]
 
                 message_parts.append("🏆 <b>Top 7 Strongest Topics</b>\n")
                 if strongest:
                     for i, t in enumerate(strongest, 1):
-                        message_parts.append(f"  {i}. {escape(t.get('topic','N/A'))} ({safe_accuracy(t):.0f}%)\n")
+                        message_parts.append(f"  {i}. {escape(t.get('topic','N/A'))} ({t['accuracy']:.0f}%)\n")
                 else:
                     message_parts.append("  Keep playing to identify your strengths!\n")
                 message_parts.append("\n")
@@ -4877,7 +7639,7 @@ def handle_my_analysis_command(msg: types.Message):
                 if weakest:
                     for i, t in enumerate(weakest, 1):
                         avg_time = t.get('avg_time_per_question', 0)
-                        message_parts.append(f"  {i}. {escape(t.get('topic','N/A'))} ({safe_accuracy(t):.0f}% | {avg_time:.1f}s)\n")
+                        message_parts.append(f"  {i}. {escape(t.get('topic','N/A'))} ({t['accuracy']:.0f}% | {avg_time:.1f}s)\n")
                 else:
                     message_parts.append("  No specific areas for improvement found yet. Great work!\n")
 
@@ -4905,6 +7667,9 @@ def handle_my_analysis_command(msg: types.Message):
         
         final_message = "".join(message_parts)
         markup = types.InlineKeyboardMarkup()
+        if msg.chat.type == 'private' and ANALYSIS_WEBAPP_URL:
+            # Web App buttons only work in private chats; the URL carries just a signed token
+            markup.add(types.InlineKeyboardButton("📈 Open Interactive Dashboard", web_app=types.WebAppInfo(build_analysis_webapp_url(user_id))))
         markup.add(types.InlineKeyboardButton("🗑️ Delete This Analysis", callback_data="delete_analysis_msg"))
         reply_params = types.ReplyParameters(message_id=msg.message_id, allow_sending_without_reply=True)
         bot.send_message(msg.chat.id, final_message, parse_mode="HTML", reply_markup=markup, reply_parameters=reply_params)
@@ -4922,14 +7687,8 @@ def handle_mystats_command(msg: types.Message):
     user_id = msg.from_user.id
     user_name = escape(msg.from_user.first_name)
     try:
-        response = supabase.rpc('get_unified_user_stats', {'p_user_id': user_id}).execute()
-        
-        if not response.data:
-            error_message = f"❌ <b>No Stats Found</b>\n👋 Hi <b>{user_name}</b>!\n🎯 <i>No quiz data found for you yet.</i>\n💡 Participate in quizzes and practice sessions to generate your snapshot!"
-            safe_reply(msg, error_message, parse_mode="HTML")
-            return
-
-        data = response.data
+        # Materialised per-user record + cached group averages (refreshed only after the user plays)
+        data = get_user_stats_record(user_id)
         user_stats = data.get('user', {})
         group_stats = data.get('group', {})
 
@@ -5006,7 +7765,7 @@ def handle_mystats_command(msg: types.Message):
         safe_reply(msg, "❌ <i>Unable to fetch your stats right now. Please try again later.</i>", parse_mode="HTML")
 
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith('delete_stats_msg'))
+@bot.callback_query_handler(func=callback_data_filter('delete_stats_msg'))
 def handle_delete_stats_callback(call: types.CallbackQuery):
     """
     Robustly deletes stats messages and the original command.
@@ -5099,10 +7858,13 @@ def handle_random_quiz(msg: types.Message):
     admin_chat_id = msg.chat.id
     
     try:
-        # Naya Supabase function ab image_file_id bhi laayega
-        response = supabase.rpc('get_random_quiz', {}).execute()
+        # Pre-shuffled deck first; the RPC is only a fallback when the deck is empty
+        quiz_data = deck_next('random')
+        if quiz_data is None:
+            response = supabase.rpc('get_random_quiz', {}).execute()
+            quiz_data = response.data[0] if response.data else None
         
-        if not response.data:
+        if not quiz_data:
             no_quiz_message = """😔 <b>Quiz Bank Empty</b>
 
 🎯 <i>No unused quizzes available right now.</i>
@@ -5128,7 +7890,6 @@ def handle_random_quiz(msg: types.Message):
             bot.send_message(admin_chat_id, admin_message, parse_mode="HTML")
             return
 
-        quiz_data = response.data[0]
         question_id = quiz_data.get('id')
         question_text = quiz_data.get('question_text')
         options_data = quiz_data.get('options')
@@ -5138,7 +7899,7 @@ def handle_random_quiz(msg: types.Message):
         image_file_id = quiz_data.get('image_file_id')
 
         # Validate quiz data integrity
-        if not question_text or not isinstance(options_data, list) or len(options_data) != 4 or correct_index is None:
+        if not is_valid_quiz_row(quiz_data):
             error_detail = f"Question ID {question_id} has malformed or missing data."
             report_error_to_admin(error_detail)
             
@@ -5152,7 +7913,7 @@ def handle_random_quiz(msg: types.Message):
 📝 <i>Check database integrity for this question</i>"""
 
             bot.send_message(admin_chat_id, admin_error_message, parse_mode="HTML")
-            supabase.table('questions').update({'used': True}).eq('id', question_id).execute()
+            mark_question_used(question_id)
             return
 
         if image_file_id:
@@ -5246,8 +8007,8 @@ def handle_random_quiz(msg: types.Message):
             'category': category
         })
         
-        supabase.table('questions').update({'used': True}).eq('id', question_id).execute()
-        print(f"✅ Marked question ID {question_id} as used.")
+        mark_question_used(question_id)
+        print(f"✅ Queued question ID {question_id} to be marked as used.")
         
         # FIX #2: Restored the detailed admin confirmation message.
         admin_success_message = f"""✅ <b>Quiz Posted Successfully!</b>
@@ -5282,10 +8043,13 @@ def handle_randomquizvisual(msg: types.Message):
     admin_chat_id = msg.chat.id
     
     try:
-        # Step 1: Naya Supabase function call karein jo sirf image waale question laata hai
-        response = supabase.rpc('get_random_visual_quiz', {}).execute()
+        # Step 1: Visual deck se agla question lein (RPC sirf fallback hai)
+        quiz_data = deck_next('visual')
+        if quiz_data is None:
+            response = supabase.rpc('get_random_visual_quiz', {}).execute()
+            quiz_data = response.data[0] if response.data else None
         
-        if not response.data:
+        if not quiz_data:
             no_quiz_message = """😔 <b>No Visual Quizzes Found</b>
 
 🎯 <i>No unused quizzes with images are available right now.</i>
@@ -5299,7 +8063,6 @@ def handle_randomquizvisual(msg: types.Message):
             bot.send_message(admin_chat_id, no_quiz_message, parse_mode="HTML")
             return
 
-        quiz_data = response.data[0]
         question_id = quiz_data.get('id')
         question_text = quiz_data.get('question_text')
         options_data = quiz_data.get('options')
@@ -5309,12 +8072,12 @@ def handle_randomquizvisual(msg: types.Message):
         image_file_id = quiz_data.get('image_file_id') # Image ID zaroor milega
 
         # Validate quiz data integrity
-        if not all([question_text, isinstance(options_data, list), len(options_data) == 4, correct_index is not None, image_file_id]):
+        if not is_valid_quiz_row(quiz_data, require_image=True):
             error_detail = f"Visual Question ID {question_id} has malformed or missing data."
             report_error_to_admin(error_detail)
             admin_error_message = f"❌ <b>Visual Quiz Data Error</b> for Question ID: {question_id}. Marked as used and skipped."
             bot.send_message(admin_chat_id, admin_error_message, parse_mode="HTML")
-            supabase.table('questions').update({'used': True}).eq('id', question_id).execute()
+            mark_question_used(question_id)
             return
 
         # Step 2: Hamesha pehle image bhejein
@@ -5401,8 +8164,8 @@ def handle_randomquizvisual(msg: types.Message):
             'category': category
         })
         
-        supabase.table('questions').update({'used': True}).eq('id', question_id).execute()
-        print(f"✅ Marked question ID {question_id} as used.")
+        mark_question_used(question_id)
+        print(f"✅ Queued question ID {question_id} to be marked as used.")
         
         # FIX #2: Added detailed admin confirmation message
         admin_success_message = f"""✅ <b>Visual Quiz Posted Successfully!</b>
@@ -5462,9 +8225,7 @@ def handle_announce_command(msg: types.Message):
 
     bot.send_message(msg.chat.id, welcome_message, parse_mode="HTML")
 
-@bot.message_handler(func=lambda msg: msg.chat.type == 'private' and
-                     msg.from_user.id in user_states and
-                     user_states[msg.from_user.id].get('action') == 'create_announcement')
+@conversation_action('create_announcement', func=lambda msg: msg.chat.type == 'private')
 def handle_announcement_steps(msg: types.Message):
     """Handle multi-step announcement creation process."""
     user_id = msg.from_user.id
@@ -5617,7 +8378,7 @@ def handle_announcement_steps(msg: types.Message):
         # Send the preview message with buttons to the admin
         bot.send_message(msg.chat.id, preview_message, reply_markup=markup, parse_mode="HTML")
         
-@bot.callback_query_handler(func=lambda call: call.data.startswith('announce_confirm_'))
+@bot.callback_query_handler(func=callback_data_filter('announce_confirm_'))
 def handle_announcement_confirmation(call: types.CallbackQuery):
     """Handles the final Yes/No confirmation for an announcement via buttons."""
     user_id = call.from_user.id
@@ -5757,8 +8518,8 @@ def format_user_list(user_list):
 
     formatted_list = ""
     for i, user in enumerate(user_list[:30]):
-        # THE FIX: Converted to safe HTML and used html.escape()
-        user_name = escape(user.get('user_name', 'Unknown'))
+        # Current name from the member directory, so renamed members show up as they are now
+        user_name = escape(member_display_name(user))
         formatted_list += f"<code>{i + 1}.</code> {user_name}\n"
         
     return formatted_list
@@ -5770,18 +8531,8 @@ def format_user_mention_list(user_list):
     if not user_list:
         return "<i>None</i>"
     
-    mentions = []
-    for user in user_list:
-        # 'user_name' key now holds the real username from the database
-        username = user.get('user_name')
-        if username:
-            mentions.append(f"@{escape(username)}")
-        else:
-            # If no username, use the first name without the '@'
-            first_name = user.get('first_name', 'Unknown User')
-            mentions.append(escape(first_name))
-            
-    return ", ".join(mentions)
+    # Uses the member's current username from the directory, so renamed members still get pinged
+    return ", ".join(member_mention(user) for user in user_list)
 # =============================================================================
 # 8. TELEGRAM BOT HANDLERS - ADMIN REPORTS
 # =============================================================================
@@ -5800,8 +8551,7 @@ def handle_activity_report(msg: types.Message):
     bot.send_message(admin_id, "📊 Generating group activity report... This might take a moment.")
     
     try:
-        response = supabase.rpc('get_activity_report').execute()
-        report_data = response.data
+        report_data = get_activity_segments()
         
         # THE FIX: Converted the entire admin report to safe HTML.
         admin_report = "🤫 <b><i>Admin's Detailed Activity Report</i></b> 🤫\n\n"
@@ -5844,7 +8594,7 @@ def handle_activity_report(msg: types.Message):
         bot.send_message(admin_id, "❌ An error occurred while generating the report.")
 
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith('post_public_report_'))
+@bot.callback_query_handler(func=callback_data_filter('post_public_report_'))
 def handle_public_report_confirmation(call: types.CallbackQuery):
     """
     Handles the admin's choice to post the public summary.
@@ -6188,14 +8938,14 @@ def handle_motivation_command(msg: types.Message):
 def handle_study_tip_command(msg: types.Message):
     """Sends a study tip from the Supabase database using safe HTML."""
     try:
-        response = supabase.table('study_tips').select('id, content, category').eq('used', False).limit(1).execute()
+        unused_tips = get_unused_study_tips()
         
-        if not response.data:
+        if not unused_tips:
             # THE FIX: Converted to safe HTML
             bot.send_message(msg.chat.id, "⚠️ All study tips have been used. Please use <code>/reset_content</code> to use them again.", parse_mode="HTML")
             return
 
-        tip = response.data[0]
+        tip = unused_tips[0]
         tip_id = tip['id']
         # THE FIX: Escaped all data from the database
         content = escape(tip['content'])
@@ -6206,7 +8956,7 @@ def handle_study_tip_command(msg: types.Message):
         
         bot.send_message(GROUP_ID, message_to_send, parse_mode="HTML", message_thread_id=CHATTING_TOPIC_ID)
         
-        supabase.table('study_tips').update({'used': True}).eq('id', tip_id).execute()
+        mark_study_tip_used(tip_id)
         
         bot.send_message(msg.chat.id, "✅ Study tip sent to the group from the database.")
 
@@ -6233,29 +8983,24 @@ def handle_define_command(msg: types.Message):
 
         search_term = parts[1].strip()
         
+        suggestions = []
         try:
-            workbook = get_gsheet()
-            if workbook:
-                sheet = workbook.worksheet('Glossary')
-                # Find a case-insensitive match for the term
-                cell = sheet.find(search_term, in_column=2, case_sensitive=False)
-
-                if cell:
-                    row_values = sheet.row_values(cell.row)
-                    term_data = {
-                        'term': row_values[1],
-                        'definition': row_values[2],
-                        'category': row_values[3] if len(row_values) > 3 else 'General'
-                    }
-                    message_text = (
-                        f"📖 <b>Term:</b> <code>{escape(term_data['term'])}</code>\n"
-                        f"━━━━━━━━━━━━━━━━━━\n"
-                        f"<blockquote>{escape(term_data['definition'])}</blockquote>\n"
-                        f"━━━━━━━━━━━━━━━━━━\n"
-                        f"📚 <b>Category:</b> <i>{escape(term_data['category'])}</i>"
-                    )
-                    bot.reply_to(msg, message_text, parse_mode="HTML")
-                    return # Term found and sent, so we stop here.
+            if not load_glossary():
+                raise RuntimeError("Glossary index is not available.")
+            # Case/space-insensitive match from the in-memory index
+            term_data = glossary_lookup(search_term)
+
+            if term_data:
+                message_text = (
+                    f"📖 <b>Term:</b> <code>{escape(term_data['term'])}</code>\n"
+                    f"━━━━━━━━━━━━━━━━━━\n"
+                    f"<blockquote>{escape(term_data['definition'])}</blockquote>\n"
+                    f"━━━━━━━━━━━━━━━━━━\n"
+                    f"📚 <b>Category:</b> <i>{escape(term_data['category'])}</i>"
+                )
+                bot.reply_to(msg, message_text, parse_mode="HTML")
+                return # Term found and sent, so we stop here.
+            suggestions = glossary_suggestions(search_term)
 
         except Exception as gsheet_error:
             print(f"⚠️ GSheet Error in /define: {gsheet_error}")
@@ -6265,6 +9010,8 @@ def handle_define_command(msg: types.Message):
 
         # --- This part runs ONLY if the term was not found ---
         not_found_text = f"😥 Lo siento, '{escape(search_term)}' ki definition hamare database mein nahi hai."
+        if suggestions:
+            not_found_text += "\n\n🤔 <b>Did you mean:</b> " + ", ".join(f"<code>{escape(s)}</code>" for s in suggestions)
         markup = types.InlineKeyboardMarkup()
         markup.add(types.InlineKeyboardButton("✍️ Add This Definition Now", callback_data=f"start_newdef_{search_term}"))
         bot.reply_to(msg, not_found_text, parse_mode="HTML", reply_markup=markup)
@@ -6291,10 +9038,9 @@ def generate_law_library_response(msg: types.Message, command: str, table_name:
         search_term = parts[1].strip()
         user_name = msg.from_user.first_name
 
-        response = supabase.table(table_name).select('*').ilike('section_number', search_term).limit(1).execute()
+        section_data = law_lookup(table_name, search_term)
 
-        if response.data:
-            section_data = response.data[0]
+        if section_data:
             example_text = (section_data.get('example') or "No example available.").replace("{user_name}", user_name)
 
             message_text = (
@@ -6321,6 +9067,9 @@ def generate_law_library_response(msg: types.Message, command: str, table_name:
             return
         else:
             not_found_text = f"Sorry, Section '<code>{escape(search_term)}</code>' {escape(act_name)} ke database mein nahi mila. 😕\nEither it is not in the CA Inter syllabus or we missed adding it."
+            suggestions = law_suggestions(table_name, search_term)
+            if suggestions:
+                not_found_text += "\n\n🤔 <b>Did you mean:</b> " + ", ".join(f"<code>{escape(str(s))}</code>" for s in suggestions)
             bot.reply_to(msg, not_found_text, parse_mode="HTML")
 
             admin_notification = f"FYI: User {escape(msg.from_user.first_name)} searched for a non-existent section in {act_name}: '{escape(search_term)}'."
@@ -6402,7 +9151,7 @@ def handle_testme_command(msg: types.Message):
     bot.reply_to(msg, prompt_text, reply_markup=markup)
 
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith('quiz_lib_'))
+@bot.callback_query_handler(func=callback_data_filter('quiz_lib_'))
 def handle_quiz_library_choice(call: types.CallbackQuery):
     """Handles the user's choice of library and asks for the number of questions."""
     user_id = call.from_user.id
@@ -6419,8 +9168,7 @@ def handle_quiz_library_choice(call: types.CallbackQuery):
 
         # --- CRITICAL: Error Handling for Not Enough Data ---
         # Check if the table has at least 4 entries to create a valid quiz question
-        count_response = supabase.table(table_name).select('id', count='exact').execute()
-        if count_response.count < 4:
+        if law_library_size(table_name) < 4:
             bot.edit_message_text(f"Sorry, the '{selected_library['name']}' library doesn't have enough entries (at least 4) to create a quiz yet. Please add more sections first!", call.message.chat.id, call.message.message_id)
             del user_states[user_id] # End conversation
             return
@@ -6439,7 +9187,7 @@ def handle_quiz_library_choice(call: types.CallbackQuery):
         bot.edit_message_text("Sorry, an unexpected error occurred. Please try again from /testme.", call.message.chat.id, call.message.message_id)
         if user_id in user_states:
             del user_states[user_id]
-@bot.callback_query_handler(func=lambda call: call.data.startswith('start_quiz_for_'))
+@bot.callback_query_handler(func=callback_data_filter('start_quiz_for_'))
 def handle_start_law_quiz_callback(call: types.CallbackQuery):
     """Integrates law library with the quiz feature."""
     user_id = call.from_user.id
@@ -6448,13 +9196,12 @@ def handle_start_law_quiz_callback(call: types.CallbackQuery):
         return
 
     try:
-        lib_key = call.data.replace('quiz_lib_', '')
+        lib_key = call.data.replace('start_quiz_for_', '', 1)
         selected_library = LAW_LIBRARIES[lib_key]
         table_name = selected_library['table']
 
         # --- Perform the same check as the /testme command ---
-        count_response = supabase.table(table_name).select('id', count='exact').execute()
-        if count_response.count < 4:
+        if law_library_size(table_name) < 4:
             bot.edit_message_text(f"Sorry, the '{selected_library['name']}' library doesn't have enough entries (at least 4) to create a quiz yet.", call.message.chat.id, call.message.message_id)
             return
 
@@ -6481,7 +9228,7 @@ def handle_start_law_quiz_callback(call: types.CallbackQuery):
 # 8. TELEGRAM BOT HANDLERS - LAW LIBRARY REVISION QUIZ (/testme) (Continued)
 # =============================================================================
 
-@bot.message_handler(func=lambda msg: user_states.get(msg.from_user.id, {}).get('step') == 'awaiting_question_count')
+@conversation_step('awaiting_question_count')
 def process_quiz_question_count(msg: types.Message):
     """
     Receives the number of questions and starts the quiz waiting room.
@@ -6503,6 +9250,13 @@ def process_quiz_question_count(msg: types.Message):
             bot.register_next_step_handler(msg, process_quiz_question_count)
             return
 
+        # --- Generate every question now, so the quiz itself never waits on the database ---
+        prepared_questions = build_law_quiz_questions(state['table_name'], num_questions)
+        if not prepared_questions:
+            bot.reply_to(msg, "Sorry, I couldn't prepare questions for this library right now. Please try again later.")
+            return
+        num_questions = len(prepared_questions)
+
         # --- Setup the Quiz Session in a global dictionary ---
         # Using the message ID as a unique session ID
         session_id = str(msg.message_id)
@@ -6512,6 +9266,7 @@ def process_quiz_question_count(msg: types.Message):
             'table_name': state['table_name'],
             'num_questions': num_questions,
             'participants': {user_id: {'name': msg.from_user.first_name, 'score': 0}},
+            'prepared_questions': prepared_questions,
             'questions': [],
             'current_question': 0,
             'is_active': False
@@ -6541,7 +9296,7 @@ def process_quiz_question_count(msg: types.Message):
             del user_states[user_id] # Clean up the initial state
 
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith('quiz_join_'))
+@bot.callback_query_handler(func=callback_data_filter('quiz_join_'))
 def handle_quiz_join(call: types.CallbackQuery):
     """Handles other users joining the quiz."""
     session_id = call.data.split('_')[-1]
@@ -6577,13 +9332,11 @@ def handle_quiz_join(call: types.CallbackQuery):
     markup.add(types.InlineKeyboardButton("✅ Join this Quiz!", callback_data=f"quiz_join_{session_id}"))
     markup.add(types.InlineKeyboardButton("▶️ Start Quiz (Creator Only)", callback_data=f"quiz_start_{session_id}"))
     
-    try:
-        bot.edit_message_text(updated_text, call.message.chat.id, call.message.message_id, reply_markup=markup, parse_mode="HTML")
-    except Exception:
-        pass # Ignore "message not modified" errors
+    # A burst of joins collapses into a single edit of the waiting room
+    coalesced_edit(call.message.chat.id, call.message.message_id, updated_text, reply_markup=markup, parse_mode="HTML")
 
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith('quiz_start_'))
+@bot.callback_query_handler(func=callback_data_filter('quiz_start_'))
 def handle_quiz_start(call: types.CallbackQuery):
     """Starts the quiz if the creator clicks the button."""
     session_id = call.data.split('_')[-1]
@@ -6600,14 +9353,15 @@ def handle_quiz_start(call: types.CallbackQuery):
         return
         
     session['is_active'] = True
-    bot.edit_message_text(f"The quiz is starting now with {len(session['participants'])} players! Get ready...", call.message.chat.id, call.message.message_id)
+    # Goes through the coalescer too, so a pending waiting-room edit can't overwrite it
+    coalesced_edit(call.message.chat.id, call.message.message_id, f"The quiz is starting now with {len(session['participants'])} players! Get ready...")
     
     # Start the quiz loop
     send_law_quiz_question(call.message.chat.id, session_id)
 
 
 def send_law_quiz_question(chat_id, session_id):
-    """Fetches data, creates, and sends a single law quiz question."""
+    """Sends the next pre-generated law quiz question (builds one on the fly for older sessions)."""
     session = QUIZ_SESSIONS.get(session_id)
     if not session or not session['is_active'] or session['current_question'] >= session['num_questions']:
         # End the quiz if it's over
@@ -6616,39 +9370,35 @@ def send_law_quiz_question(chat_id, session_id):
         return
 
     try:
-        # Fetch 4 random entries using our Supabase function
-        response = supabase.rpc('get_random_law_entries', {'table_name_input': session['table_name']}).execute()
-        if not response.data or len(response.data) < 4:
-            bot.send_message(chat_id, "Could not fetch enough unique questions to continue the quiz. Ending now.")
-            display_law_quiz_results(chat_id, session_id)
-            return
-
-        question_data = response.data
-        correct_entry = question_data[0]
-        
-        # Prepare options and shuffle them
-        options = [entry['section_number'] for entry in question_data]
-        random.shuffle(options)
-        correct_option_index = options.index(correct_entry['section_number'])
+        prepared_questions = session.get('prepared_questions') or []
+        if session['current_question'] < len(prepared_questions):
+            payload = prepared_questions[session['current_question']]
+        else:
+            # Sessions restored from before questions were pre-generated
+            generated = build_law_quiz_questions(session['table_name'], 1)
+            if not generated:
+                bot.send_message(chat_id, "Could not fetch enough unique questions to continue the quiz. Ending now.")
+                display_law_quiz_results(chat_id, session_id)
+                return
+            payload = generated[0]
+            payload['question'] = payload['question'].replace("**Q1/1:**", f"**Q{session['current_question'] + 1}/{session['num_questions']}:**", 1)
 
-        question_text = f"**Q{session['current_question'] + 1}/{session['num_questions']}:** Which section/standard relates to this summary?\n\n<blockquote>{escape(correct_entry['summary'])}</blockquote>"
-        
         poll_message = bot.send_poll(
             chat_id=chat_id,
-            question=question_text,
-            options=options,
+            question=payload['question'],
+            options=payload['options'],
             type='quiz',
-            correct_option_id=correct_option_index,
+            correct_option_id=payload['correct_option_index'],
             is_anonymous=False,
             open_period=28, # 28 seconds per question
-            explanation=f"Correct Answer: {correct_entry['section_number']}\nTitle: {correct_entry['title']}",
+            explanation=payload['explanation'],
             explanation_parse_mode="HTML"
         )
 
         session['questions'].append({
             'poll_id': poll_message.poll.id,
-            'correct_section': correct_entry['section_number'],
-            'correct_option_index': correct_option_index
+            'correct_section': payload['correct_section'],
+            'correct_option_index': payload['correct_option_index']
         })
         session['current_question'] += 1
         
@@ -6715,6 +9465,7 @@ def display_law_quiz_results(chat_id, session_id):
         if records_to_insert:
             supabase.table('section_mastery').insert(records_to_insert).execute()
             print(f"Successfully saved {len(records_to_insert)} law quiz results.")
+            record_topic_result(session['library_name'])
 
     except Exception as e:
         report_error_to_admin(f"Error saving law quiz results: {traceback.format_exc()}")
@@ -6723,26 +9474,6 @@ def display_law_quiz_results(chat_id, session_id):
     if session_id in QUIZ_SESSIONS:
         del QUIZ_SESSIONS[session_id]
 
-
-@bot.message_handler(commands=['gca'])
-@membership_required
-def handle_gca_command(msg: types.Message):
-    generate_law_library_response(msg, '/gca', 'gca_sections', 'General Clauses Act, 1897', '📜')
-
-@bot.message_handler(commands=['caro'])
-@membership_required
-def handle_caro_command(msg: types.Message):
-    generate_law_library_response(msg, '/caro', 'caro_rules', 'CARO, 2020', '📋')
-
-@bot.message_handler(commands=['sa'])
-@membership_required
-def handle_sa_command(msg: types.Message):
-    generate_law_library_response(msg, '/sa', 'auditing_standards', 'Standards on Auditing', '🔍')
-
-@bot.message_handler(commands=['as'])
-@membership_required
-def handle_as_command(msg: types.Message):
-    generate_law_library_response(msg, '/as', 'accounting_standards', 'Accounting Standards', '📊')
 # =============================================================================
 # 8. TELEGRAM BOT HANDLERS - NEW DEFINITION SUBMISSION FLOW
 # =============================================================================
@@ -6788,7 +9519,7 @@ def handle_newdef_command(msg: types.Message):
             parse_mode="Markdown"
         )
 
-@bot.message_handler(func=lambda msg: user_states.get(msg.from_user.id, {}).get('step') == 'awaiting_term')
+@conversation_step('awaiting_term')
 def process_newdef_term(msg: types.Message):
     """Step 2: Receives the term and checks for duplicates."""
     user_id = msg.from_user.id
@@ -6799,14 +9530,11 @@ def process_newdef_term(msg: types.Message):
         return
 
     try:
-        workbook = get_gsheet()
-        if workbook:
-            sheet = workbook.worksheet('Glossary')
-            # Case-insensitive check
-            if sheet.find(term, in_column=2, case_sensitive=False):
-                bot.reply_to(msg, "Yeh definition pehle se database mein hai, par aapke effort ke liye shukriya!")
-                del user_states[user_id] # End the conversation
-                return
+        # Case-insensitive check against the in-memory glossary index
+        if glossary_lookup(term):
+            bot.reply_to(msg, "Yeh definition pehle se database mein hai, par aapke effort ke liye shukriya!")
+            del user_states[user_id] # End the conversation
+            return
 
         # If term is new, proceed to the next step
         user_states[user_id]['term'] = term
@@ -6818,7 +9546,7 @@ def process_newdef_term(msg: types.Message):
         bot.reply_to(msg, "Sorry, database check karte waqt ek error aa gaya. Please thodi der baad try karein.")
         del user_states[user_id]
 
-@bot.message_handler(func=lambda msg: user_states.get(msg.from_user.id, {}).get('step') == 'awaiting_definition')
+@conversation_step('awaiting_definition')
 def process_newdef_definition(msg: types.Message):
     """Step 3: Receives the definition and asks for the category."""
     user_id = msg.from_user.id
@@ -6832,7 +9560,7 @@ def process_newdef_definition(msg: types.Message):
     user_states[user_id]['step'] = 'awaiting_category'
     bot.reply_to(msg, "Bahut acche! Ab bas aakhri cheez, yeh definition kaun se subject ya chapter se hai? (Jaise: Accounting, Law, etc.)")
 
-@bot.message_handler(func=lambda msg: user_states.get(msg.from_user.id, {}).get('step') == 'awaiting_category')
+@conversation_step('awaiting_category')
 def process_newdef_category(msg: types.Message):
     """Step 4: Receives category, confirms to user, and sends for admin approval."""
     user_id = msg.from_user.id
@@ -6864,6 +9592,7 @@ def process_newdef_category(msg: types.Message):
         # Store full data server-side
         pending_definitions[short_id] = {
             "user_id": user_id,
+            "user_name": user_info.first_name,
             "term": term,
             "definition": definition,
             "category": category
@@ -6894,7 +9623,7 @@ def process_newdef_category(msg: types.Message):
     finally:
         del user_states[user_id]
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith('def_'))
+@bot.callback_query_handler(func=callback_data_filter('def_'))
 def handle_definition_approval(call: types.CallbackQuery):
     """Handles the admin's approve/decline/edit decision."""
     try:
@@ -6932,19 +9661,13 @@ def handle_definition_approval(call: types.CallbackQuery):
         # --- HANDLE APPROVE & REJECT ACTIONS ---
         submission_data = pending_definitions.pop(short_id)
         user_id = submission_data['user_id']
-        user_name = submission_data['user_name']
+        user_name = submission_data.get('user_name', 'the contributor')
         term = submission_data['term']
         definition = submission_data['definition']
         category = submission_data['category']
 
         if action == "approve":
-            workbook = get_gsheet()
-            if workbook:
-                sheet = workbook.worksheet('Glossary')
-                all_ids = sheet.col_values(1)[1:]
-                next_id = max([int(i) for i in all_ids if i.isdigit()] or [0]) + 1
-                sheet.append_row([str(next_id), term, definition, category])
-
+            if glossary_append(term, definition, category):
                 bot.edit_message_text(f"✅ Submission from <b>{escape(user_name)}</b> for '<b>{escape(term)}</b>' has been approved.", call.message.chat.id, call.message.message_id, parse_mode="HTML")
                 bot.send_message(user_id, f"🎉 Good news! Your definition for '<b>{escape(term)}</b>' has been approved. Thank you!", parse_mode="HTML")
             else:
@@ -6977,13 +9700,7 @@ def process_edited_definition(message: types.Message):
         category = submission_data['category']
 
         # Save the EDITED version to Google Sheets
-        workbook = get_gsheet()
-        if workbook:
-            sheet = workbook.worksheet('Glossary')
-            all_ids = sheet.col_values(1)[1:]
-            next_id = max([int(i) for i in all_ids if i.isdigit()] or [0]) + 1
-            sheet.append_row([str(next_id), term, new_definition, category])
-
+        if glossary_append(term, new_definition, category):
             bot.send_message(admin_id, f"✅ Success! The definition for '<b>{escape(term)}</b>' has been edited and approved.", parse_mode="HTML")
             bot.send_message(user_id, f"🎉 Good news! Your definition for '<b>{escape(term)}</b>' has been approved by the admin (with some edits). Thank you for contributing!", parse_mode="HTML")
         else:
@@ -7027,7 +9744,7 @@ def format_section_message(section_data, user_name):
 # 8. TELEGRAM BOT HANDLERS - INTERACTIVE CONTRIBUTION FLOW
 # =============================================================================
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith('start_newdef_'))
+@bot.callback_query_handler(func=callback_data_filter('start_newdef_'))
 def handle_start_newdef_callback(call: types.CallbackQuery):
     """Starts the /newdef flow from a button, skipping the first step."""
     user_id = call.from_user.id
@@ -7054,7 +9771,7 @@ def handle_start_newdef_callback(call: types.CallbackQuery):
         bot.answer_callback_query(call.id, "An error occurred. Please try again.", show_alert=True)
 
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith('start_addsection_'))
+@bot.callback_query_handler(func=callback_data_filter('start_addsection_'))
 def handle_start_addsection_callback(call: types.CallbackQuery):
     """Starts the /addsection flow from a button, skipping several steps."""
     user_id = call.from_user.id
@@ -7106,7 +9823,7 @@ def handle_addsection_command(msg: types.Message):
     bot.reply_to(msg, prompt_text, reply_markup=markup)
 
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith('addsec_act_'))
+@bot.callback_query_handler(func=callback_data_filter('addsec_act_'))
 def handle_addsection_act_choice(call: types.CallbackQuery):
     """Step 2: Handles the user's choice of law library."""
     user_id = call.from_user.id
@@ -7148,7 +9865,7 @@ def handle_addsection_act_choice(call: types.CallbackQuery):
         bot.edit_message_text("Sorry, an unexpected error occurred. Please try again from /addsection.", call.message.chat.id, call.message.message_id)
         if user_id in user_states:
             del user_states[user_id]
-@bot.callback_query_handler(func=lambda call: call.data.startswith('addsec_type_'))
+@bot.callback_query_handler(func=callback_data_filter('addsec_type_'))
 def handle_addsection_type_choice(call: types.CallbackQuery):
     """Step 3: Handles the user's choice of entry type (Section, Rule, etc.)."""
     user_id = call.from_user.id
@@ -7175,7 +9892,7 @@ def handle_addsection_type_choice(call: types.CallbackQuery):
         if user_id in user_states:
             del user_states[user_id]
 
-@bot.message_handler(func=lambda msg: user_states.get(msg.from_user.id, {}).get('step') == 'awaiting_number')
+@conversation_step('awaiting_number')
 def process_addsection_number(msg: types.Message):
     """Step 4: Receives the entry number and checks if it exists in the database."""
     user_id = msg.from_user.id
@@ -7192,14 +9909,13 @@ def process_addsection_number(msg: types.Message):
         state['entry_number'] = entry_number
 
         # --- The "Check & Branch" Point ---
-        response = supabase.table(table_name).select('*').ilike('section_number', entry_number).limit(1).execute()
+        existing_data = law_lookup(table_name, entry_number)
 
         # Scenario A: The Entry ALREADY EXISTS
-        if response.data:
+        if existing_data:
             state['step'] = 'awaiting_edit_choice'
             state['action_type'] = 'UPDATE' # This will be an update if they proceed
-            
-            existing_data = response.data[0]
+
             display_text = (
                 f"Heads up! '{escape(entry_number)}' is already in our database:\n\n"
                 f"<b>Title:</b> {escape(existing_data.get('title', 'N/A'))}\n"
@@ -7241,7 +9957,7 @@ def handle_reset_content(msg: types.Message):
     bot.send_message(msg.chat.id, "Which content do you want to mark as 'unused' again?", reply_markup=markup)
 
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith('reset_'))
+@bot.callback_query_handler(func=callback_data_filter('reset_'))
 def handle_reset_confirmation(call: types.CallbackQuery):
     """
     Handles the reset action based on admin's choice.
@@ -7264,6 +9980,7 @@ def handle_reset_confirmation(call: types.CallbackQuery):
     try:
         if table_to_reset:
             supabase.rpc('reset_content_usage', {'table_name': table_to_reset}).execute()
+            invalidate_cache(table_to_reset)
             # THE FIX: Converted to safe HTML
             success_message = f"✅ Success! All <b>{escape(content_type)}</b> have been reset and can be used again."
             bot.send_message(call.message.chat.id, success_message, parse_mode="HTML")
@@ -7329,9 +10046,9 @@ def start_marathon_setup(msg: types.Message):
     """
     try:
         # Step 1: Silently fetch quiz presets from the database first.
-        presets_response = supabase.table('quiz_presets').select('set_name, button_label').order('id').execute()
+        presets = get_quiz_presets()
         
-        if not presets_response.data:
+        if not presets:
             no_presets_message = """❌ <b>No Quiz Presets Found</b>
 
 🎯 <b>Issue:</b> The quiz preset database is empty.
@@ -7358,7 +10075,7 @@ Hello Admin! Please select a quiz set from the options below to begin.
             types.InlineKeyboardButton(
                 f"🎯 {preset['button_label']}", 
                 callback_data=f"start_marathon_{preset['set_name']}"
-            ) for preset in presets_response.data
+            ) for preset in presets
         ]
         
         # Arrange buttons in pairs for better mobile display
@@ -7386,7 +10103,7 @@ Hello Admin! Please select a quiz set from the options below to begin.
 🔄 <i>Please try again in a moment...</i>"""
         bot.reply_to(msg, error_message, parse_mode="HTML")
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith('start_marathon_'))
+@bot.callback_query_handler(func=callback_data_filter('start_marathon_'))
 def handle_marathon_set_selection(call: types.CallbackQuery):
     """
     Handles quiz set selection with improved logic and error handling.
@@ -7470,7 +10187,7 @@ Could not verify question availability for the selected set due to a technical i
         bot.edit_message_text(error_message, chat_id, message_id, reply_markup=markup, parse_mode="HTML")
 
 # --- NEW: Add a callback handler for the 'back' button ---
-@bot.callback_query_handler(func=lambda call: call.data == 'back_to_marathon_setup')
+@bot.callback_query_handler(func=callback_data_filter(exact=('back_to_marathon_setup',)))
 def handle_back_to_marathon_setup(call: types.CallbackQuery):
     """Takes the admin back to the main marathon setup screen."""
     # We create a fake message object to re-run the original setup command
@@ -7486,7 +10203,7 @@ def handle_back_to_marathon_setup(call: types.CallbackQuery):
     start_marathon_setup(fake_message)
 
 
-@bot.callback_query_handler(func=lambda call: call.data == 'cancel_marathon')
+@bot.callback_query_handler(func=callback_data_filter(exact=('cancel_marathon',)))
 def handle_marathon_cancel(call: types.CallbackQuery):
     """Handle marathon setup cancellation."""
     bot.edit_message_reply_markup(call.message.chat.id, call.message.message_id)
@@ -7616,7 +10333,7 @@ def process_marathon_question_count(msg: types.Message):
         bot.edit_message_text("❌ A critical error occurred during the Pre-Flight Check.", msg.chat.id, state_data.get('setup_message_id'))
 
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith('preflight_') or call.data == 'back_to_marathon_setup')
+@bot.callback_query_handler(func=callback_data_filter('preflight_', exact=('back_to_marathon_setup',)))
 def handle_preflight_action_callback(call: types.CallbackQuery):
     """
     Handles the admin's choice after the Pre-Flight Check report.
@@ -7659,8 +10376,7 @@ def _launch_marathon_session(user_id, chat_id, message_id, questions_to_run):
         state_data = user_states.get(user_id, {})
         selected_set = state_data.get('selected_set', 'Custom Marathon')
         
-        preset_details_res = supabase.table('quiz_presets').select('quiz_title, quiz_description').eq('set_name', selected_set).single().execute()
-        preset_details = preset_details_res.data or {'quiz_title': selected_set, 'quiz_description': 'A custom quiz marathon.'}
+        preset_details = get_quiz_preset(selected_set) or {'quiz_title': selected_set, 'quiz_description': 'A custom quiz marathon.'}
         
         actual_count = len(questions_to_run)
         
@@ -8029,9 +10745,10 @@ def calculate_legend_tier(user_score, total_questions, all_scores):
         return {'tier': 'BRONZE', 'emoji': '🥉', 'title': 'Bronze Legend'}
     else:
         return None
-def _send_admin_marathon_summary(session, participants, update_response):
+def _send_admin_marathon_summary(session, participants, update_response, remaining_count=None):
     """
     Sends a detailed summary of the completed marathon to the admin via DM.
+    remaining_count can be passed in when it was already fetched alongside the 'used' update.
     """
     try:
         title = session.get('title', 'N/A')
@@ -8054,8 +10771,9 @@ def _send_admin_marathon_summary(session, participants, update_response):
 
         # Part 2: Check for remaining questions in the quiz set
         if selected_set != 'N/A':
-            remaining_res = supabase.table('quiz_questions').select('id', count='exact').eq('quiz_set', selected_set).eq('used', False).execute()
-            remaining_count = remaining_res.count
+            if remaining_count is None:
+                remaining_res = supabase.table('quiz_questions').select('id', count='exact').eq('quiz_set', selected_set).eq('used', False).execute()
+                remaining_count = remaining_res.count
             summary += f"\n<b>Content Status for '{escape(selected_set)}':</b>\n"
             summary += f"  🧠 There are <b>{remaining_count}</b> questions left in this set."
         
@@ -8085,13 +10803,24 @@ def send_marathon_results(session_id):
 
         # --- 1. Reliably update used questions and CAPTURE the response ---
         update_response = None
+        remaining_count = None
         try:
             # Correctly use numeric IDs for the query
             used_question_ids = [q['id'] for q in questions]
 
             if used_question_ids:
-                # Capture the result of the database operation for verification
-                update_response = supabase.table('quiz_questions').update({'used': True}).in_('id', used_question_ids).execute()
+                # Capture the result of the database operation for verification.
+                # The admin summary's "questions left" count excludes this marathon's IDs,
+                # so it doesn't have to wait for the update and runs alongside it.
+                selected_set = session.get('selected_set', 'N/A')
+                tasks = {'update': lambda: supabase.table('quiz_questions').update({'used': True}).in_('id', used_question_ids).execute()}
+                if selected_set != 'N/A':
+                    tasks['remaining'] = lambda: supabase.table('quiz_questions').select('id', count='exact').eq('quiz_set', selected_set).eq('used', False).not_.in_('id', used_question_ids).execute().count
+                results, errors = run_concurrently(tasks)
+                update_response = results.get('update')
+                remaining_count = results.get('remaining')
+                if 'update' in errors:
+                    raise errors['update']
                 print(f"Attempted to mark {len(used_question_ids)} questions as used.")
         except Exception as e:
             print(f"CRITICAL ERROR: Failed to mark marathon questions as used. Error: {e}")
@@ -8122,7 +10851,7 @@ def send_marathon_results(session_id):
             print(f"Error: Failed to record Marathon participation for session {session_id}: {tracking_error}")
             report_error_to_admin(f"Failed core tracking for Marathon session {session_id}:\n{tracking_error}")
         # --- END NEW ---
-            _send_admin_marathon_summary(session, participants, update_response)
+            _send_admin_marathon_summary(session, participants, update_response, remaining_count)
             return
         
         # --- 2. Process and Rank Participants ---
@@ -8240,7 +10969,7 @@ def send_marathon_results(session_id):
         bot.send_message(GROUP_ID, card2_text, parse_mode="HTML", message_thread_id=QUIZ_TOPIC_ID)
 
         # After all public messages are sent, trigger the admin DM.
-        _send_admin_marathon_summary(session, participants, update_response)
+        _send_admin_marathon_summary(session, participants, update_response, remaining_count)
 
     finally:
         # Guaranteed Session Cleanup
@@ -8280,37 +11009,95 @@ def handle_topic_rankers(msg: types.Message):
 
         library_name_db = library_info['name'] # Get the full name used in the DB
 
-        response = supabase.rpc('get_topic_leaderboard', {'p_library_name': library_name_db}).execute()
+        response = get_topic_rankers(library_name_db)
 
         if not response.data:
             safe_reply(msg, f"📊 No rankings available yet for <b>{escape(library_name_db)}</b>.\n\nBe the first to take the quiz at least twice using <code>/testme</code> or the library command!", parse_mode="HTML")
             return
 
-        leaderboard_text = f"🏆 <b>Top Rankers for {escape(library_name_db)}</b> 🏆\n"
-        leaderboard_text += "<i>Based on average accuracy in revision quizzes (/testme)</i>\n"
-        leaderboard_text += "━━━━━━━━━━━━━━━━━━\n\n"
+        def build_text():
+            leaderboard_text = f"🏆 <b>Top Rankers for {escape(library_name_db)}</b> 🏆\n"
+            leaderboard_text += "<i>Based on average accuracy in revision quizzes (/testme)</i>\n"
+            leaderboard_text += "━━━━━━━━━━━━━━━━━━\n\n"
 
-        rank_emojis = ["🥇", "🥈", "🥉"]
-        for i, ranker in enumerate(response.data):
-            rank = rank_emojis[i] if i < 3 else f"<b>{i + 1}.</b>"
-            user_name = escape(ranker.get('user_name', 'Unknown'))
-            avg_accuracy = ranker.get('average_accuracy', 0)
-            quiz_count = ranker.get('quiz_count', 0)
-            leaderboard_text += f"{rank} {user_name} - <b>{avg_accuracy:.1f}%</b> avg ({quiz_count} attempts)\n"
+            rank_emojis = ["🥇", "🥈", "🥉"]
+            for i, ranker in enumerate(response.data):
+                rank = rank_emojis[i] if i < 3 else f"<b>{i + 1}.</b>"
+                user_name = escape(ranker.get('user_name', 'Unknown'))
+                avg_accuracy = ranker.get('average_accuracy', 0)
+                quiz_count = ranker.get('quiz_count', 0)
+                leaderboard_text += f"{rank} {user_name} - <b>{avg_accuracy:.1f}%</b> avg ({quiz_count} attempts)\n"
+
+            leaderboard_text += "\n━━━━━━━━━━━━━━━━━━\nKeep practicing to improve your rank! 💪"
+            return leaderboard_text
 
-        leaderboard_text += "\n━━━━━━━━━━━━━━━━━━\nKeep practicing to improve your rank! 💪"
+        leaderboard_text = render_leaderboard(('topic', library_name_db), response.version, build_text)
         safe_reply(msg, leaderboard_text, parse_mode="HTML")
 
     except Exception as e:
         report_error_to_admin(f"Error in /topicrankers: {traceback.format_exc()}")
         safe_reply(msg, "❌ An error occurred while fetching the topic leaderboard.")
 
+def _build_weekly_rankers_text(rows):
+    """Formats the weekly rankers message posted by /rankers."""
+    # Create beautiful weekly leaderboard
+    current_week = datetime.datetime.now().strftime("Week of %B %d, %Y")
+    
+    leaderboard_text = f"""🏆 <b>WEEKLY RANKERS</b> 🏆
+
+📅 <i>{current_week}</i>
+🎯 <i>Top performers this week!</i>
+
+━━━━━━━━━━━━━━━━━━━━━━━━━
+
+"""
+
+    for item in rows:
+        rank = item.get('rank')
+        user_name = escape(item.get('user_name', 'Unknown User'))
+        total_score = item.get('total_score', 0)
+        
+        if rank == 1:  # Weekly Champion
+            leaderboard_text += f"👑 <b>WEEK CHAMPION</b>\n"
+            leaderboard_text += f"🥇 <b>{user_name}</b>\n"
+            leaderboard_text += f"⚡ <b>{total_score} points</b> • <i>Dominating!</i>\n\n"
+            
+        elif rank == 2:  # Runner-up
+            leaderboard_text += f"🥈 <b>WEEK RUNNER-UP</b>\n"
+            leaderboard_text += f"⭐ <b>{user_name}</b> • <b>{total_score} pts</b>\n\n"
+            
+        elif rank == 3:  # Third place
+            leaderboard_text += f"🥉 <b>WEEK THIRD</b>\n"
+            leaderboard_text += f"🎖️ <b>{user_name}</b> • <b>{total_score} pts</b>\n\n"
+            
+        elif rank <= 5:  # Top 5
+            leaderboard_text += f"🏅 <b>#{rank}</b> {user_name} • <b>{total_score} pts</b>\n"
+            
+        else:  # Others
+            rank_emojis = ["6️⃣", "7️⃣", "8️⃣", "9️⃣", "🔟"]
+            rank_emoji = rank_emojis[rank-6] if rank-6 < len(rank_emojis) else f"#{rank}"
+            leaderboard_text += f"{rank_emoji} {user_name} • {total_score} pts\n"
+
+    leaderboard_text += f"""
+━━━━━━━━━━━━━━━━━━━━━━━━━
+
+📊 <b>WEEK STATS:</b>
+🎯 Total Rankers: <b>{len(rows)}</b>
+🏆 Top Score: <b>{rows[0].get('total_score', 0)} pts</b>
+📈 Competition: <b>{"🔥 Intense" if len(rows) >= 8 else "📈 Growing"}</b>
+
+💡 <i>Keep participating to climb the weekly ranks!</i>
+
+<b>C.A.V.Y.A Weekly Challenge 💝</b>"""
+    return leaderboard_text
+
+
 @bot.message_handler(commands=['rankers'])
 @admin_required
 def handle_weekly_rankers(msg: types.Message):
     """Enhanced weekly rankers with beautiful mobile-optimized formatting."""
     try:
-        response = supabase.rpc('get_weekly_rankers').execute()
+        response = get_weekly_rankers()
 
         if not response.data:
             empty_weekly_message = """🏆 <b>WEEKLY LEADERBOARD</b> 🏆
@@ -8343,56 +11130,8 @@ def handle_weekly_rankers(msg: types.Message):
             bot.send_message(msg.chat.id, admin_message, parse_mode="HTML")
             return
 
-        # Create beautiful weekly leaderboard
-        current_week = datetime.datetime.now().strftime("Week of %B %d, %Y")
-        
-        leaderboard_text = f"""🏆 <b>WEEKLY RANKERS</b> 🏆
-
-📅 <i>{current_week}</i>
-🎯 <i>Top performers this week!</i>
-
-━━━━━━━━━━━━━━━━━━━━━━━━━
-
-"""
-
-        for item in response.data:
-            rank = item.get('rank')
-            user_name = escape(item.get('user_name', 'Unknown User'))
-            total_score = item.get('total_score', 0)
-            
-            if rank == 1:  # Weekly Champion
-                leaderboard_text += f"👑 <b>WEEK CHAMPION</b>\n"
-                leaderboard_text += f"🥇 <b>{user_name}</b>\n"
-                leaderboard_text += f"⚡ <b>{total_score} points</b> • <i>Dominating!</i>\n\n"
-                
-            elif rank == 2:  # Runner-up
-                leaderboard_text += f"🥈 <b>WEEK RUNNER-UP</b>\n"
-                leaderboard_text += f"⭐ <b>{user_name}</b> • <b>{total_score} pts</b>\n\n"
-                
-            elif rank == 3:  # Third place
-                leaderboard_text += f"🥉 <b>WEEK THIRD</b>\n"
-                leaderboard_text += f"🎖️ <b>{user_name}</b> • <b>{total_score} pts</b>\n\n"
-                
-            elif rank <= 5:  # Top 5
-                leaderboard_text += f"🏅 <b>#{rank}</b> {user_name} • <b>{total_score} pts</b>\n"
-                
-            else:  # Others
-                rank_emojis = ["6️⃣", "7️⃣", "8️⃣", "9️⃣", "🔟"]
-                rank_emoji = rank_emojis[rank-6] if rank-6 < len(rank_emojis) else f"#{rank}"
-                leaderboard_text += f"{rank_emoji} {user_name} • {total_score} pts\n"
-
-        leaderboard_text += f"""
-━━━━━━━━━━━━━━━━━━━━━━━━━
-
-📊 <b>WEEK STATS:</b>
-🎯 Total Rankers: <b>{len(response.data)}</b>
-🏆 Top Score: <b>{response.data[0].get('total_score', 0)} pts</b>
-📈 Competition: <b>{"🔥 Intense" if len(response.data) >= 8 else "📈 Growing"}</b>
-
-💡 <i>Keep participating to climb the weekly ranks!</i>
+        leaderboard_text = render_leaderboard(('weekly', datetime.date.today().isoformat()), response.version, lambda: _build_weekly_rankers_text(response.data))
 
-<b>C.A.V.Y.A Weekly Challenge 💝</b>"""
-        
         bot.send_message(GROUP_ID, leaderboard_text, parse_mode="HTML", message_thread_id=QUIZ_TOPIC_ID)
         
         # Admin confirmation
@@ -8540,7 +11279,7 @@ Run this sync periodically after adding new members to ensure complete tracking
 def handle_all_time_rankers(msg: types.Message):
     """Enhanced all-time rankers with legends status and comprehensive stats."""
     try:
-        response = supabase.rpc('get_all_time_rankers').execute()
+        response = get_all_time_rankers()
 
         if not response.data:
             empty_alltime_message = """🏆 <b>ALL-TIME LEGENDS</b> 🏆
@@ -8763,7 +11502,7 @@ def handle_questions_posted(msg: types.Message):
         bot.send_message(msg.chat.id, "❌ An error occurred.")
 
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith('setter_choice_'))
+@bot.callback_query_handler(func=callback_data_filter('setter_choice_'))
 def handle_setter_choice(call: types.CallbackQuery):
     """
     Handles the 'Yes'/'No' button press from the Question Setter.
@@ -8884,6 +11623,7 @@ def handle_submission(msg: types.Message):
         }).execute()
         submission_id = submission_insert_response.data[0]['submission_id']
 
+        # assign_checker writes and may read the submission row, so it must run after the insert
         checker_response = supabase.rpc('assign_checker', {'p_session_id': session_id, 'p_submitter_id': submitter_id}).execute()
 
         if not checker_response.data:
@@ -9011,7 +11751,7 @@ def process_simple_review_marks(message, submission_id, total_marks):
         print(f"Error in process_simple_review_marks: {traceback.format_exc()}")
 
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith('review_type_'))
+@bot.callback_query_handler(func=callback_data_filter('review_type_'))
 def handle_review_type_choice(call: types.CallbackQuery):
     """
     Handles the 'Both Questions' / 'A Single Question' button press.
@@ -9086,7 +11826,7 @@ def process_both_q2_marks(message, submission_id, marks_dist, marks_q1):
         print(f"Error in process_both_q2_marks: {traceback.format_exc()}")
 
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith('review_single_'))
+@bot.callback_query_handler(func=callback_data_filter('review_single_'))
 def handle_single_question_choice(call: types.CallbackQuery):
     """Handles the 'Question 1' / 'Question 2' button press."""
     bot.edit_message_reply_markup(call.message.chat.id, call.message.message_id, reply_markup=None)
@@ -9185,7 +11925,7 @@ def start_new_practice_session(chat_id):
         bot.send_message(chat_id, "❌ An error occurred while starting the practice session.")
 
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith('report_'))
+@bot.callback_query_handler(func=callback_data_filter('report_', ack_text="⏳ Preparing the report..."))
 def handle_report_confirmation(call: types.CallbackQuery):
     """
     Handles the admin's 'Yes' or 'No' choice for posting the report using safe HTML.
@@ -9376,7 +12116,7 @@ def handle_run_checks_command(msg: types.Message):
     except Exception as e:
         print(f"Error in /run_checks: {traceback.format_exc()}")
         bot.send_message(admin_id, "❌ An error occurred during the check.")
-@bot.callback_query_handler(func=lambda call: call.data.startswith('send_actions_'))
+@bot.callback_query_handler(func=callback_data_filter('send_actions_', ack_text="⏳ Processing..."))
 def handle_run_checks_confirmation(call: types.CallbackQuery):
     """Handles the admin's confirmation to send the messages."""
     admin_id = call.from_user.id
@@ -9466,6 +12206,7 @@ def handle_new_member(msg: types.Message):
                     'last_name': member.last_name
                 }
                 supabase.table('group_members').upsert(member_data).execute()
+                remember_member(member)
                 
                 print(f"✅ Successfully added/updated new member: {member.first_name} ({member.id})")
                 
@@ -9528,17 +12269,9 @@ def track_users(msg: types.Message):
     # --- 2. Standard Activity Tracking ---
     # (This will run for your messages during a lock, or for everyone's messages when unlocked)
     try:
-        supabase.rpc('update_chat_activity', {
-            'p_user_id': user.id,
-            'p_user_name': user.username or user.first_name
-        }).execute()
+        record_chat_activity(user.id, user.username or user.first_name)
         
-        supabase.rpc('upsert_group_member', {
-            'p_user_id': user.id,
-            'p_username': user.username,
-            'p_first_name': user.first_name,
-            'p_last_name': user.last_name
-        }).execute()
+        sync_group_member(user)
     except Exception as e:
         print(f"[User Tracking Error]: Could not update user {user.id}. Reason: {e}")
 
@@ -9566,7 +12299,7 @@ def handle_unknown_messages(msg: types.Message):
             "❌ I don't recognize that command. Please use /suru to see your options."
         )
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith('addsec_edit_'))
+@bot.callback_query_handler(func=callback_data_filter('addsec_edit_'))
 def handle_addsection_edit_choice(call: types.CallbackQuery):
     """Step 4b: Handles the user's choice to either edit an existing entry or cancel."""
     user_id = call.from_user.id
@@ -9587,7 +12320,7 @@ def handle_addsection_edit_choice(call: types.CallbackQuery):
     
     bot.answer_callback_query(call.id)
 
-@bot.message_handler(func=lambda msg: user_states.get(msg.from_user.id, {}).get('step') == 'awaiting_title')
+@conversation_step('awaiting_title')
 def process_addsection_title(msg: types.Message):
     """Step 5: Collects the Title and asks for the Summary."""
     user_id = msg.from_user.id
@@ -9598,7 +12331,7 @@ def process_addsection_title(msg: types.Message):
     state['step'] = 'awaiting_summary'
     bot.reply_to(msg, "Great. Now, please write a simple Hinglish **Summary** for this entry.")
 
-@bot.message_handler(func=lambda msg: user_states.get(msg.from_user.id, {}).get('step') == 'awaiting_summary')
+@conversation_step('awaiting_summary')
 def process_addsection_summary(msg: types.Message):
     """Step 6: Collects the Summary and asks for the Example."""
     user_id = msg.from_user.id
@@ -9609,7 +12342,7 @@ def process_addsection_summary(msg: types.Message):
     state['step'] = 'awaiting_example'
     bot.reply_to(msg, "Perfect. Lastly, please provide a practical Hinglish **Example**. Remember to use `{user_name}` where you want the user's name to appear.")
 
-@bot.message_handler(func=lambda msg: user_states.get(msg.from_user.id, {}).get('step') == 'awaiting_example')
+@conversation_step('awaiting_example')
 def process_addsection_example_and_submit(msg: types.Message):
     """Step 7: Collects the Example, confirms to user, and sends for admin approval."""
     user_id = msg.from_user.id
@@ -9664,7 +12397,7 @@ def process_addsection_example_and_submit(msg: types.Message):
     finally:
         del user_states[user_id] # Clean up state
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith('addsec_admin_'))
+@bot.callback_query_handler(func=callback_data_filter('addsec_admin_', ack_text="⏳ Saving your decision..."))
 def handle_addsection_admin_approval(call: types.CallbackQuery):
     """Handles the admin's final accept/decline decision."""
     action = call.data.split('_')[2]
@@ -9690,6 +12423,9 @@ def handle_addsection_admin_approval(call: types.CallbackQuery):
                 supabase.table(table_name).update(data_to_upsert).eq('section_number', entry_number).execute()
                 confirmation_text = f"✅ Accepted and **updated** in the `{table_name}` table."
 
+            # Refresh the in-memory section index so the change is visible immediately
+            load_law_library(table_name)
+
             bot.edit_message_text(confirmation_text, call.message.chat.id, call.message.message_id)
 
         except Exception as e:
@@ -9748,7 +12484,7 @@ def handle_schedule_manager(msg: types.Message):
         parse_mode="HTML"
     )
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith('sch_'))
+@bot.callback_query_handler(func=callback_data_filter('sch_'))
 def handle_schedule_callbacks(call: types.CallbackQuery):
     """Handles button clicks for the Schedule Manager."""
     user_id = call.from_user.id
@@ -9815,7 +12551,7 @@ def ask_for_time(chat_id, user_id):
     )
 
 # --- HANDLER FOR TIME BUTTONS (New) ---
-@bot.callback_query_handler(func=lambda call: call.data.startswith('sch_time_'))
+@bot.callback_query_handler(func=callback_data_filter('sch_time_'))
 def handle_time_buttons(call: types.CallbackQuery):
     user_id = call.from_user.id
     selected_time = call.data.split('_')[2]
@@ -9826,7 +12562,7 @@ def handle_time_buttons(call: types.CallbackQuery):
 
 # --- TEXT INPUT HANDLERS ---
 
-@bot.message_handler(func=lambda msg: user_states.get(msg.from_user.id, {}).get('action') == 'managing_schedule')
+@conversation_action('managing_schedule')
 def handle_schedule_inputs(msg: types.Message):
     """Handles text inputs for Date, Time, Chapter, Topics."""
     user_id = msg.from_user.id
@@ -9866,8 +12602,7 @@ def handle_schedule_inputs(msg: types.Message):
         # Calculate Quiz No (Next number for that day)
         date_str = state['data']['quiz_date']
         try:
-            res = supabase.table('quiz_schedule').select('quiz_no', count='exact').eq('quiz_date', date_str).execute()
-            next_no = res.count + 1
+            next_no = len(get_quiz_schedule(date_str, force_refresh=True)) + 1
         except:
             next_no = 1
         
@@ -9921,6 +12656,7 @@ def save_schedule_to_db(chat_id, user_id):
             'chapter_name': data['chapter_name'],
             'topics_covered': data['topics_covered']
         }).execute()
+        invalidate_cache('quiz_schedule', data['quiz_date'])
         
         bot.send_message(chat_id, "✅ <b>Success!</b> The quiz has been added to the schedule.", parse_mode="HTML")
         
@@ -9960,9 +12696,9 @@ except Exception as e:
 # --- STEP 3: SUPABASE HEALTH CHECK ---
 print("\n--- STEP 3: Checking Supabase Connection ---")
 try:
-    # Perform a simple, quick query to test the connection and credentials
-    response = supabase.table('quiz_presets').select('id', count='exact').limit(1).execute()
-    print(f"✅ Supabase connection successful. Found {response.count} quiz presets.")
+    # Perform a simple, quick query to test the connection and credentials (also warms the preset cache)
+    presets = get_quiz_presets(force_refresh=True)
+    print(f"✅ Supabase connection successful. Found {len(presets)} quiz presets.")
 except Exception as e:
     print(f"❌ FATAL: Could not connect to Supabase. Check URL/KEY and network access rules. Error: {e}")
     exit()
@@ -9975,6 +12711,20 @@ try:
 except Exception as e:
     print(f"⚠️ WARNING: Could not load persistent data from Supabase. Bot will start with a fresh state. Error: {e}")
 
+# --- STEP 4.5: WARMING IN-MEMORY INDEXES ---
+print("\n--- STEP 4.5: Warming In-Memory Indexes ---")
+load_resource_catalog()
+load_glossary(force=True)
+load_all_law_libraries()
+load_question_decks()
+load_member_directory()
+load_pending_next_steps()
+compile_dispatch_table()
+try:
+    build_webapp_assets()
+except Exception as e:
+    print(f"⚠️ Could not build web app assets at startup: {e}")
+
     
 # --- STEPS 5 & 6: (SKIPPED) ---
 # Background thread and Webhook are now managed by Render's service types.
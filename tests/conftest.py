@@ -0,0 +1,38 @@
+"""
+bot.py connects to Telegram and Supabase while it is imported, so the tests
+don't import it. load_from_bot() compiles just the top-level definitions a test
+needs out of bot.py's source, after running bot.py's own import lines, into a
+fresh namespace. Whatever else those definitions use (the database client, the
+TeleBot instance, module state) is passed in by the test.
+"""
+import ast
+import pathlib
+
+BOT_PATH = pathlib.Path(__file__).resolve().parent.parent / 'bot.py'
+_bot_tree = ast.parse(BOT_PATH.read_text(encoding='utf-8'), filename=str(BOT_PATH))
+
+
+def _defined_names(node):
+    if isinstance(node, (ast.FunctionDef, ast.ClassDef)):
+        return {node.name}
+    if isinstance(node, ast.Assign):
+        return {target.id for target in node.targets if isinstance(target, ast.Name)}
+    return set()
+
+
+def load_from_bot(*names, **namespace):
+    """
+    Returns a namespace holding bot.py's imports, the keyword arguments and the
+    named top-level functions, classes and assignments, defined in source order.
+    """
+    imports = [node for node in _bot_tree.body if isinstance(node, (ast.Import, ast.ImportFrom))]
+    definitions = [node for node in _bot_tree.body if _defined_names(node) & set(names)]
+    missing = set(names) - set().union(*map(_defined_names, definitions))
+    if missing:
+        raise LookupError(f"bot.py has no top-level {', '.join(sorted(missing))}")
+
+    scope = {'__name__': 'bot'}
+    exec(compile(ast.Module(body=imports, type_ignores=[]), str(BOT_PATH), 'exec'), scope)
+    scope.update(namespace)
+    exec(compile(ast.Module(body=definitions, type_ignores=[]), str(BOT_PATH), 'exec'), scope)
+    return scope
@@ -0,0 +1,41 @@
+import pytest
+
+from conftest import load_from_bot
+
+
+@pytest.fixture
+def bot_ns():
+    return load_from_bot('ANALYSIS_TOKEN_TTL', '_b64url', '_b64url_decode', 'sign_analysis_token', 'verify_analysis_token',
+                         ANALYSIS_TOKEN_SECRET=b'test-secret')
+
+
+def test_round_trip(bot_ns):
+    token = bot_ns['sign_analysis_token'](123456789)
+    assert bot_ns['verify_analysis_token'](token) == 123456789
+
+
+def test_token_is_url_safe(bot_ns):
+    token = bot_ns['sign_analysis_token'](-1001234567890)
+    assert set(token) <= set('ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789-_.')
+    assert bot_ns['verify_analysis_token'](token) == -1001234567890
+
+
+def test_expired_token_is_rejected(bot_ns):
+    assert bot_ns['verify_analysis_token'](bot_ns['sign_analysis_token'](42, ttl=-1)) is None
+
+
+def test_token_signed_with_another_secret_is_rejected(bot_ns):
+    other = load_from_bot('ANALYSIS_TOKEN_TTL', '_b64url', '_b64url_decode', 'sign_analysis_token',
+                          ANALYSIS_TOKEN_SECRET=b'another-secret')
+    assert bot_ns['verify_analysis_token'](other['sign_analysis_token'](42)) is None
+
+
+def test_changed_user_id_is_rejected(bot_ns):
+    _, signature = bot_ns['sign_analysis_token'](42).split('.')
+    forged_payload = bot_ns['_b64url'](b'43.9999999999')
+    assert bot_ns['verify_analysis_token'](f"{forged_payload}.{signature}") is None
+
+
+@pytest.mark.parametrize('token', ['', '.', 'abc', 'abc.def', '!!!.???', 'a.b.c'])
+def test_malformed_tokens_are_rejected(bot_ns, token):
+    assert bot_ns['verify_analysis_token'](token) is None
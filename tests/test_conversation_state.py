@@ -0,0 +1,103 @@
+import pytest
+
+from conftest import load_from_bot
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1_000_000.0
+
+    def time(self):
+        return self.now
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
+
+
+@pytest.fixture
+def states(clock):
+    ns = load_from_bot('ConversationStateStore', time=clock)
+    return ns['ConversationStateStore'](ttl=60)
+
+
+def test_conversation_expires_after_ttl(states, clock):
+    states[1] = {'step': 'awaiting_answer'}
+    clock.now += 59
+    assert states.get(1) == {'step': 'awaiting_answer'}
+    clock.now += 2
+    assert states.get(1) is None
+    assert 1 not in states
+    with pytest.raises(KeyError):
+        states[1]
+
+
+def test_data_only_entries_never_expire(states, clock):
+    states[1] = {'last_report_data': [1, 2, 3]}
+    clock.now += 10_000
+    assert states.sweep() == 0
+    assert states[1] == {'last_report_data': [1, 2, 3]}
+
+
+def test_touch_pushes_the_deadline_back(states, clock):
+    states[1] = {'action': 'adding_rq_photos'}
+    clock.now += 50
+    states.touch(1)
+    clock.now += 50
+    assert 1 in states
+    clock.now += 11
+    assert 1 not in states
+
+
+def test_sweep_removes_only_due_conversations(states, clock):
+    states[1] = {'step': 'a'}
+    states[2] = {'action': 'b'}
+    clock.now += 30
+    states[3] = {'step': 'c'}
+    clock.now += 31
+    assert states.sweep() == 2
+    assert states.keys() == [3]
+
+
+def test_rewriting_an_entry_restarts_its_ttl(states, clock):
+    states[1] = {'step': 'a'}
+    clock.now += 50
+    states[1] = {'step': 'b'}
+    clock.now += 50
+    assert states.sweep() == 0
+    assert states[1] == {'step': 'b'}
+
+
+def test_iteration_and_len_skip_expired_conversations(states, clock):
+    states[1] = {'step': 'a'}
+    states[2] = {'data': 'kept'}
+    clock.now += 61
+    assert len(states) == 1
+    assert list(states) == [2]
+    assert states.items() == [(2, {'data': 'kept'})]
+    assert states.values() == [{'data': 'kept'}]
+
+
+def test_setdefault_replaces_an_expired_conversation(states, clock):
+    states[1] = {'step': 'a'}
+    clock.now += 61
+    assert states.setdefault(1, {'step': 'new'}) == {'step': 'new'}
+    assert states.setdefault(1, {'step': 'ignored'}) == {'step': 'new'}
+
+
+def test_update_pop_and_clear(states, clock):
+    states.update({1: {'step': 'a'}})
+    states.update([(2, {'step': 'b'})])
+    assert states.pop(1) == {'step': 'a'}
+    assert states.pop(1, None) is None
+    states.clear()
+    assert len(states) == 0
+    clock.now += 61
+    assert states.sweep() == 0
+
+
+def test_is_not_a_dict(states):
+    # Unbound dict methods would skip the lock and the expiry check, so they must fail
+    with pytest.raises(TypeError):
+        dict.items(states)
@@ -0,0 +1,106 @@
+import pytest
+from telebot import TeleBot, types
+
+from conftest import load_from_bot
+
+USER = {'id': 1, 'is_bot': False, 'first_name': 'Test'}
+
+
+def message(**fields):
+    return types.Message.de_json({'message_id': 1, 'date': 0, 'chat': {'id': 1, 'type': 'private'}, 'from': USER, **fields})
+
+
+def callback(data):
+    return types.CallbackQuery.de_json({'id': '1', 'from': USER, 'chat_instance': '1', 'data': data})
+
+
+def names(handlers):
+    return [handler['function'].__name__ for handler in handlers]
+
+
+@pytest.fixture
+def dispatch():
+    bot = TeleBot('123456:TEST', threaded=False)
+    ns = load_from_bot(
+        'callback_ack_texts', 'callback_data_filter', '_handler_label', '_compile_message_handlers',
+        '_select_message_handlers', '_compile_callback_handlers', '_select_callback_handlers',
+        '_TrackedCandidates', '_time_skipped_filters', bot=bot,
+    )
+    ns['handled'] = []
+
+    def handler(name, register, **filters):
+        def run(update):
+            ns['handled'].append(name)
+        run.__name__ = name
+        register(**filters)(run)
+
+    handler('start', bot.message_handler, commands=['start'])
+    handler('photo', bot.message_handler, content_types=['photo'])
+    handler('help', bot.message_handler, commands=['help'])
+    handler('greeting', bot.message_handler, func=lambda m: m.text == 'hi')
+    handler('any_text', bot.message_handler, func=lambda m: m.text != 'nomatch')
+    handler('voice', bot.message_handler, content_types=['voice'])
+
+    handler('quiz', bot.callback_query_handler, func=ns['callback_data_filter']('quiz_'))
+    handler('delete', bot.callback_query_handler, func=ns['callback_data_filter'](exact=('delete',)))
+    handler('unindexed', bot.callback_query_handler, func=lambda call: call.data == 'other')
+    handler('quiz_set', bot.callback_query_handler, func=ns['callback_data_filter']('quiz_set_'))
+
+    ns['message_table'] = ns['_compile_message_handlers'](bot.message_handlers)
+    ns['callback_table'] = ns['_compile_callback_handlers'](bot.callback_query_handlers)
+    return ns
+
+
+def select(table, update):
+    return table['select'](table, update)
+
+
+@pytest.mark.parametrize('update, expected', [
+    (message(text='/help'), ['help', 'greeting', 'any_text']),
+    (message(text='/unknown'), ['greeting', 'any_text']),
+    (message(text='hi'), ['greeting', 'any_text']),
+    (message(photo=[{'file_id': 'f', 'file_unique_id': 'u', 'width': 1, 'height': 1}]), ['photo']),
+    (message(sticker={'file_id': 'f', 'file_unique_id': 'u', 'type': 'regular', 'width': 1, 'height': 1,
+                      'is_animated': False, 'is_video': False}), []),
+])
+def test_message_candidates_keep_registration_order(dispatch, update, expected):
+    assert names(select(dispatch['message_table'], update)) == expected
+
+
+@pytest.mark.parametrize('data, expected', [
+    ('quiz_set_7', ['quiz', 'unindexed', 'quiz_set']),
+    ('quiz_start', ['quiz', 'unindexed']),
+    ('delete', ['delete', 'unindexed']),
+    ('other', ['unindexed']),
+])
+def test_callback_candidates(dispatch, data, expected):
+    assert names(select(dispatch['callback_table'], callback(data))) == expected
+
+
+@pytest.mark.parametrize('update', [
+    message(text='/start'), message(text='/help'), message(text='hi'), message(text='hello'),
+    message(text='nomatch'), message(voice={'file_id': 'f', 'file_unique_id': 'u', 'duration': 1}),
+])
+def test_candidates_pick_the_same_handler_as_the_full_list(dispatch, update):
+    bot, table = dispatch['bot'], dispatch['message_table']
+
+    def first_match(handlers):
+        return next((handler for handler in handlers if bot._test_message_handler(handler, update)), None)
+    assert first_match(select(table, update)) is first_match(table['handlers'])
+
+
+@pytest.mark.parametrize('update, handled, skipped', [
+    # The loop stops at 'help': 'start' and 'photo' come before it and were skipped
+    (message(text='/help'), ['help'], 2),
+    # Nothing matched: the full loop would have tried all six, four of which weren't candidates
+    (message(text='nomatch'), [], 4),
+    (message(sticker={'file_id': 'f', 'file_unique_id': 'u', 'type': 'regular', 'width': 1, 'height': 1,
+                      'is_animated': False, 'is_video': False}), [], 6),
+])
+def test_skipped_filter_count(dispatch, update, handled, skipped):
+    candidates = dispatch['_TrackedCandidates'](select(dispatch['message_table'], update))
+    dispatch['bot']._notify_command_handlers(candidates, [update], 'message')
+
+    assert dispatch['handled'] == handled
+    assert candidates.matched == bool(handled)
+    assert dispatch['_time_skipped_filters'](dispatch['message_table'], candidates, update)[0] == skipped
@@ -0,0 +1,163 @@
+import threading
+import time
+
+import pytest
+
+from conftest import load_from_bot
+
+
+@pytest.fixture
+def bot_ns():
+    return load_from_bot(
+        'DB_LATENCY_BUCKETS_MS', 'db_metrics', 'db_metrics_lock', '_inflight_reads', '_write_generations',
+        'singleflight_lock', '_get_db_stats', 'note_db_write', 'run_singleflight',
+    )
+
+
+def _start_leader(ns, fetch, key='k', name='questions'):
+    """Starts a leader whose fetch blocks, and waits until its flight is registered."""
+    results = {}
+    thread = threading.Thread(target=lambda: results.setdefault('leader', ns['run_singleflight'](key, name, 'select', fetch, 5)))
+    thread.start()
+    while not ns['_inflight_reads']:
+        time.sleep(0.001)
+    return thread, results
+
+
+def _start_followers(ns, count, fetch, key='k', name='questions'):
+    results, threads = [], []
+    for _ in range(count):
+        thread = threading.Thread(target=lambda: results.append(ns['run_singleflight'](key, name, 'select', fetch, 5)))
+        thread.start()
+        threads.append(thread)
+    flight = next(iter(ns['_inflight_reads'].values()))
+    while flight['followers'] < count:
+        time.sleep(0.001)
+    return threads, results
+
+
+def test_followers_share_one_fetch_but_get_their_own_copy(bot_ns):
+    release = threading.Event()
+    calls = []
+
+    def fetch():
+        calls.append(1)
+        release.wait(5)
+        return {'rows': [1, 2]}
+
+    leader, leader_result = _start_leader(bot_ns, fetch)
+    followers, follower_results = _start_followers(bot_ns, 3, fetch)
+    release.set()
+    for thread in [leader, *followers]:
+        thread.join(5)
+
+    assert len(calls) == 1
+    assert follower_results == [{'rows': [1, 2]}] * 3
+    results = [leader_result['leader'], *follower_results]
+    assert len({id(result) for result in results}) == 4
+    assert bot_ns['db_metrics'][('questions', 'select')]['coalesced'] == 3
+
+
+def test_leader_mutating_its_result_does_not_reach_followers(bot_ns):
+    release = threading.Event()
+
+    def fetch():
+        release.wait(5)
+        return {'rows': [1]}
+
+    def mutating_leader():
+        result = bot_ns['run_singleflight']('k', 'questions', 'select', fetch, 5)
+        result['rows'].append('leader only')
+
+    leader = threading.Thread(target=mutating_leader)
+    leader.start()
+    while not bot_ns['_inflight_reads']:
+        time.sleep(0.001)
+    followers, follower_results = _start_followers(bot_ns, 2, fetch)
+    release.set()
+    for thread in [leader, *followers]:
+        thread.join(5)
+
+    assert follower_results == [{'rows': [1]}] * 2
+
+
+def test_followers_see_the_leaders_error(bot_ns):
+    release = threading.Event()
+
+    def fetch():
+        release.wait(5)
+        raise ValueError('boom')
+
+    errors = []
+
+    def call():
+        try:
+            bot_ns['run_singleflight']('k', 'questions', 'select', fetch, 5)
+        except ValueError as e:
+            errors.append(e)
+
+    leader = threading.Thread(target=call)
+    leader.start()
+    while not bot_ns['_inflight_reads']:
+        time.sleep(0.001)
+    follower = threading.Thread(target=call)
+    follower.start()
+    flight = next(iter(bot_ns['_inflight_reads'].values()))
+    while flight['followers'] < 1:
+        time.sleep(0.001)
+    release.set()
+    leader.join(5)
+    follower.join(5)
+
+    assert [str(e) for e in errors] == ['boom', 'boom']
+    assert not bot_ns['_inflight_reads']
+
+
+@pytest.mark.parametrize('name, operation', [('questions', 'update'), ('anything', 'rpc')])
+def test_a_write_starts_a_new_flight(bot_ns, name, operation):
+    release = threading.Event()
+    calls = []
+
+    def fetch():
+        calls.append(1)
+        release.wait(5)
+        return len(calls)
+
+    leader, _ = _start_leader(bot_ns, fetch)
+    bot_ns['note_db_write'](name, operation)
+    after_write = bot_ns['run_singleflight']('k', 'questions', 'select', lambda: 'fresh', 5)
+    release.set()
+    leader.join(5)
+
+    assert after_write == 'fresh'
+    assert calls == [1]
+
+
+def test_a_write_to_another_table_still_coalesces(bot_ns):
+    release = threading.Event()
+
+    def fetch():
+        release.wait(5)
+        return 'shared'
+
+    leader, _ = _start_leader(bot_ns, fetch)
+    bot_ns['note_db_write']('quiz_presets', 'update')
+    followers, follower_results = _start_followers(bot_ns, 1, lambda: 'separate')
+    release.set()
+    for thread in [leader, *followers]:
+        thread.join(5)
+
+    assert follower_results == ['shared']
+
+
+def test_a_follower_stops_waiting_after_its_timeout(bot_ns):
+    release = threading.Event()
+    leader, _ = _start_leader(bot_ns, lambda: release.wait(5) and 'slow')
+
+    started = time.monotonic()
+    result = bot_ns['run_singleflight']('k', 'questions', 'select', lambda: 'own', 0.05)
+    release.set()
+    leader.join(5)
+
+    assert result == 'own'
+    assert time.monotonic() - started < 1
@@ -0,0 +1,90 @@
+import gzip
+import pathlib
+import re
+import threading
+
+import pytest
+from flask import Flask
+
+from conftest import load_from_bot
+
+WEBAPP_DIR = pathlib.Path(__file__).resolve().parent.parent / 'webapp'
+
+
+@pytest.fixture
+def bot_ns():
+    return load_from_bot(
+        'WEBAPP_ASSET_FILES', 'CHARTJS_VERSION', 'CHARTJS_VENDOR_FILE', 'WEBAPP_IMMUTABLE_CACHE_CONTROL',
+        'WEBAPP_SHELL_CACHE_CONTROL', 'WEBAPP_MIMETYPES', 'webapp_assets', 'webapp_assets_lock', 'chartjs_fallback_logged',
+        '_build_webapp_asset', '_fingerprinted_name', '_read_chartjs', 'build_webapp_assets', 'serve_webapp_asset',
+        WEBAPP_DIR=str(WEBAPP_DIR), brotli=None,
+    )
+
+
+@pytest.fixture
+def app():
+    return Flask(__name__)
+
+
+def _serve(bot_ns, app, name, **headers):
+    with app.test_request_context(f'/webapp/{name}', headers=headers):
+        return bot_ns['serve_webapp_asset'](name)
+
+
+def _script_name(bot_ns):
+    return next(name for name in bot_ns['webapp_assets'] if name.startswith('script.'))
+
+
+def test_first_request_builds_the_assets_without_deadlocking(bot_ns, app):
+    served = {}
+    thread = threading.Thread(target=lambda: served.setdefault('response', _serve(bot_ns, app, 'index.html')), daemon=True)
+    thread.start()
+    thread.join(10)
+
+    assert not thread.is_alive(), "serve_webapp_asset deadlocked building the assets"
+    assert served['response'].status_code == 200
+    assert bot_ns['webapp_assets']
+
+
+def test_shell_references_fingerprinted_assets(bot_ns, app):
+    bot_ns['build_webapp_assets']()
+    shell = _serve(bot_ns, app, 'index.html').get_data(as_text=True)
+
+    for name in bot_ns['WEBAPP_ASSET_FILES']:
+        stem, ext = name.rsplit('.', 1)
+        hashed = re.search(rf'"({re.escape(stem)}\.[0-9a-f]{{10}}\.{ext})"', shell).group(1)
+        assert hashed in bot_ns['webapp_assets']
+    assert _serve(bot_ns, app, 'index.html').headers['Cache-Control'] == 'no-cache'
+
+
+def test_hashed_asset_is_gzipped_and_immutable(bot_ns, app):
+    bot_ns['build_webapp_assets']()
+    response = _serve(bot_ns, app, _script_name(bot_ns), **{'Accept-Encoding': 'gzip, deflate'})
+
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert 'immutable' in response.headers['Cache-Control']
+    assert response.headers['Vary'] == 'Accept-Encoding'
+    assert gzip.decompress(response.get_data()) == (WEBAPP_DIR / 'script.js').read_bytes()
+
+
+def test_client_without_gzip_gets_the_plain_body(bot_ns, app):
+    bot_ns['build_webapp_assets']()
+    response = _serve(bot_ns, app, _script_name(bot_ns))
+
+    assert 'Content-Encoding' not in response.headers
+    assert response.get_data() == (WEBAPP_DIR / 'script.js').read_bytes()
+
+
+def test_matching_etag_gets_304(bot_ns, app):
+    bot_ns['build_webapp_assets']()
+    name = _script_name(bot_ns)
+    etag = _serve(bot_ns, app, name, **{'Accept-Encoding': 'gzip'}).headers['ETag']
+    response = _serve(bot_ns, app, name, **{'Accept-Encoding': 'gzip', 'If-None-Match': etag})
+
+    assert response.status_code == 304
+    assert response.get_data() == b''
+
+
+def test_unknown_asset_is_404(bot_ns, app):
+    bot_ns['build_webapp_assets']()
+    assert _serve(bot_ns, app, 'missing.js') == ("Not Found", 404)
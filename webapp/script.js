@@ -7,28 +7,46 @@ document.addEventListener('DOMContentLoaded', function () {
     const loader = document.getElementById('loader');
     const appContainer = document.getElementById('app-container');
 
-    // Function to get data from URL
-    function getUrlData() {
+    function showLoadError(error) {
+        console.error("Data load karne mein error:", error);
+        loader.innerHTML = `<p style="color: #f85149;">Performance data load nahi ho saka. Please try again.</p>`;
+        return null;
+    }
+
+    // Older links embedded the whole payload in ?data=
+    function getUrlData(params) {
         try {
-            const dataParam = new URLSearchParams(window.location.search).get('data');
+            const dataParam = params.get('data');
             if (!dataParam) throw new Error("URL mein data nahi mila.");
             return JSON.parse(decodeURIComponent(dataParam));
         } catch (error) {
-            console.error("Data parse karne mein error:", error);
-            loader.innerHTML = `<p style="color: #f85149;">Performance data load nahi ho saka. Please try again.</p>`;
-            return null;
+            return showLoadError(error);
         }
     }
 
-    const userData = getUrlData();
+    // The bot now sends only a signed token (?t=...); the JSON comes from the bot's API
+    function loadUserData() {
+        const params = new URLSearchParams(window.location.search);
+        const token = params.get('t');
+        if (!token) return Promise.resolve(getUrlData(params));
 
-    if (userData) {
+        const apiBase = (params.get('api') || '').replace(/\/$/, '');
+        return fetch(`${apiBase}/api/analysis/${encodeURIComponent(token)}`)
+            .then(response => {
+                if (!response.ok) throw new Error(`HTTP ${response.status}`);
+                return response.json();
+            })
+            .catch(showLoadError);
+    }
+
+    loadUserData().then(userData => {
+        if (!userData) return;
         if (userData.isDataAvailable) {
             initializeDashboard(userData);
         } else {
             loader.innerHTML = `<p>${userData.coachInsight}</p>`;
         }
-    }
+    });
 
     function initializeDashboard(data) {
         // Populate header